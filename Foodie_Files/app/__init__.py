@@ -5,6 +5,7 @@ from flask_migrate import Migrate
 from flask_wtf.csrf import CSRFProtect
 from flask_admin import Admin
 from flask_babel import Babel
+from app.routing import RoutingSession
 
 
 
@@ -23,10 +24,11 @@ app.config.from_object('config')
 Bootstrap(app)
 csrf = CSRFProtect(app)
 
-db = SQLAlchemy(app)
+# db.session sends the reads of read only views to the replica bind, see app/database.py
+db = SQLAlchemy(app, session_options={'class_': RoutingSession})
 migrate = Migrate(app,db)
 
 
 
-from app import views,models
+from app import timing,database,metrics,views,models,commands,admin_views
 
@@ -0,0 +1,69 @@
+import tracemalloc
+from datetime import datetime
+from flask import request, redirect, url_for, abort, flash
+from flask_admin import BaseView, expose
+from flask_login import current_user
+from app import app, admin
+from .slowlog import slow_queries
+from .profiler import profile, unsupported_worker
+from .memprofile import routes as memory_by_route, max_rss
+
+###### DIAGNOSTICS PAGES ######
+# Admin pages for looking into performance, under Diagnostics in /admin. They show SQL
+# parameters and the like, so only the users in ADMIN_EMAILS can open them.
+
+class DiagnosticsView(BaseView):
+    def is_accessible(self):
+        return current_user.is_authenticated and current_user.email in app.config['ADMIN_EMAILS']
+
+    def inaccessible_callback(self, name, **kwargs):
+        if not current_user.is_authenticated:
+            return redirect(url_for('login', next=request.url))
+        abort(403)
+
+
+class SlowQueriesView(DiagnosticsView):
+    @expose('/')
+    def index(self):
+        return self.render('admin/slow_queries.html', queries=slow_queries.queries(),
+                           threshold=app.config['SLOW_QUERY_SECONDS'], datetime=datetime)
+
+    @expose('/clear', methods=['POST'])
+    def clear(self):
+        slow_queries.clear()
+        return redirect(url_for('.index'))
+
+
+class ProfilerView(DiagnosticsView):
+    @expose('/', methods=['GET', 'POST'])
+    def index(self):
+        result = None
+        unsupported = unsupported_worker()
+        if request.method == 'POST' and unsupported:
+            flash(f'The profiler needs gthread workers, {unsupported}.', 'error')
+        elif request.method == 'POST':
+            seconds = min(max(request.form.get('seconds', 10, type=float), 0.1), app.config['PROFILE_MAX_SECONDS'])
+            result = profile(seconds, all_threads='all_threads' in request.form)
+            if result is None:
+                flash('A profile is already running in this worker, try again when it is done.', 'error')
+        return self.render('admin/profiler.html', result=result, max_seconds=app.config['PROFILE_MAX_SECONDS'],
+                           unsupported=unsupported, datetime=datetime)
+
+
+class MemoryView(DiagnosticsView):
+    @expose('/')
+    def index(self):
+        by_peak = sorted(memory_by_route.items(), key=lambda item: item[1].peak_max, reverse=True)
+        traced = tracemalloc.get_traced_memory() if tracemalloc.is_tracing() else None
+        return self.render('admin/memory.html', routes=by_peak, enabled=app.config['MEMORY_PROFILE'],
+                           traced=traced, max_rss=max_rss())
+
+    @expose('/clear', methods=['POST'])
+    def clear(self):
+        memory_by_route.clear()
+        return redirect(url_for('.index'))
+
+
+admin.add_view(SlowQueriesView(name='Slow queries', endpoint='slow_queries', category='Diagnostics'))
+admin.add_view(ProfilerView(name='Profiler', endpoint='profiler', category='Diagnostics'))
+admin.add_view(MemoryView(name='Memory', endpoint='memory', category='Diagnostics'))
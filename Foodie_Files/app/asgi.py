@@ -0,0 +1,358 @@
+import asyncio
+import io
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from asgiref.sync import sync_to_async
+from asgiref.wsgi import WsgiToAsgi, WsgiToAsgiInstance
+from flask import request, session, jsonify, abort, request_started
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from sqlalchemy.orm import Session
+from werkzeug.exceptions import HTTPException
+from app import app, db
+from .models import User, Recipe, Like, SavedRecipe
+from .database import configure_sqlite, track_writes
+from .events import async_event_stream
+from .feed import page_query, cut_page, serialize_recipe, _chunks, PAGE_SIZE, MAX_PAGE_SIZE
+from .search import search_recipes
+from .views import (like, save, post_comment, cached_recipe_details, cache_recipe_details, recipe_details_body,
+                    recipe_details_response, recipe_events_response, events_response)
+
+###### ASGI SERVING ######
+# asgi.py next to run.py serves the app from an ASGI server (uvicorn asgi:app). The JSON
+# endpoints the pages call with AJAX run as coroutines on an async database connection
+# (aiosqlite on SQLite, asyncpg on PostgreSQL), so a request waiting on the database holds
+# no thread. At most ASYNC_DB_CONCURRENCY of them talk to the database at once, the rest
+# wait their turn.
+# The SSE streams (/events, /recipe_events) are async generators on the event loop, an open
+# stream holds no thread.
+# Every other route (the HTML pages, uploads) is the normal Flask app run through asgiref's
+# WSGI adapter, on a pool of ASGI_WSGI_THREADS threads. asgiref's default runs every one of
+# them on a single shared thread, so one slow page would hold up all the others.
+#
+# The async views run inside a Flask request context built from the ASGI request, so the
+# session cookie, CSRF check, before/after request hooks and error handlers are Flask's own.
+# The work itself is done by the same helpers in views.py, run on the async session's sync
+# side, and it always goes to the primary database (the replica bind in app/routing.py is
+# for db.session only).
+
+ASYNC_DRIVERS = {'sqlite': 'sqlite+aiosqlite', 'postgresql': 'postgresql+asyncpg'}
+
+async_views = {}
+
+_engine = None
+_sessions = None
+_db_slots = None
+
+
+def async_database_uri(uri):
+    # the same database through the async driver for its dialect
+    dialect, rest = uri.split('://', 1)
+    return f"{ASYNC_DRIVERS.get(dialect.split('+')[0], dialect)}://{rest}"
+
+
+def async_engine_options(uri):
+    # On PostgreSQL the pool settings of the sync engine, sized for the ASYNC_DB_CONCURRENCY
+    # slots. asyncpg takes the statement timeout as a server setting instead of 'options'.
+    if not uri.startswith('postgresql'):
+        return {}
+    options = {k: v for k, v in app.config['SQLALCHEMY_ENGINE_OPTIONS'].items() if k != 'connect_args'}
+    options.update(pool_size=app.config['ASYNC_DB_CONCURRENCY'], max_overflow=0, connect_args={
+        'server_settings': {
+            'statement_timeout': str(app.config['DB_STATEMENT_TIMEOUT']),
+            'application_name': 'foodie',
+        },
+    })
+    return options
+
+
+class ViewSession(Session):
+    # The sync session behind the async views' AsyncSession, their commits count as writes
+    # for read-your-writes like those of db.session
+    pass
+
+
+track_writes(ViewSession)
+
+
+def async_sessions():
+    # Created on first use, inside the server's event loop
+    global _engine, _sessions, _db_slots
+    if _sessions is None:
+        uri = app.config['ASYNC_DATABASE_URI'] or async_database_uri(app.config['SQLALCHEMY_DATABASE_URI'])
+        _engine = create_async_engine(uri, **async_engine_options(uri))
+        configure_sqlite(_engine.sync_engine)
+        # objects stay usable after commit, an expired attribute cant be lazy loaded here
+        _sessions = async_sessionmaker(_engine, expire_on_commit=False, sync_session_class=ViewSession)
+        _db_slots = asyncio.Semaphore(app.config['ASYNC_DB_CONCURRENCY'])
+    return _sessions
+
+
+async def close_database():
+    # the next use creates them again, in whatever event loop is running then
+    global _engine, _sessions, _db_slots
+    if _engine is not None:
+        await _engine.dispose()
+    _engine = _sessions = _db_slots = None
+
+
+@asynccontextmanager
+async def database():
+    # async with database() as db_session: ... waits for one of the ASYNC_DB_CONCURRENCY slots
+    sessions = async_sessions()
+    async with _db_slots:
+        async with sessions() as db_session:
+            yield db_session
+
+
+class PooledWsgiToAsgiInstance(WsgiToAsgiInstance):
+    executor = ThreadPoolExecutor(app.config['ASGI_WSGI_THREADS'], thread_name_prefix='wsgi')
+
+    async def run_wsgi_app(self, body):
+        # WsgiToAsgiInstance.run_wsgi_app is wrapped in a thread sensitive sync_to_async
+        run = vars(WsgiToAsgiInstance)['run_wsgi_app'].__wrapped__
+        await sync_to_async(run, thread_sensitive=False, executor=self.executor)(self, body)
+
+
+class PooledWsgiToAsgi(WsgiToAsgi):
+    async def __call__(self, scope, receive, send):
+        await PooledWsgiToAsgiInstance(self.wsgi_application, self.duplicate_header_limit)(scope, receive, send)
+
+
+wsgi_app = PooledWsgiToAsgi(app)
+
+
+def async_view(endpoint):
+    # Serve a Flask endpoint with this coroutine when running under ASGI
+    def register(view):
+        async_views[endpoint] = view
+        return view
+    return register
+
+
+###### REQUEST HANDLING ######
+
+async def asgi_app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+
+    endpoint = None
+    if scope['type'] == 'http':
+        try:
+            endpoint, _ = app.url_map.bind('localhost').match(scope['path'], method=scope['method'])
+        except HTTPException:
+            pass
+
+    if endpoint not in async_views:
+        return await wsgi_app(scope, receive, send)
+    await dispatch(async_views[endpoint], scope, receive, send)
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await close_database()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def dispatch(view, scope, receive, send):
+    # What Flask's wsgi_app does with the request, with the view awaited
+    body = io.BytesIO()
+    while True:
+        message = await receive()
+        body.write(message.get('body', b''))
+        if not message.get('more_body'):
+            break
+    body.seek(0)
+    # the same environ the WSGI adapter would hand to Flask
+    adapter = WsgiToAsgiInstance(app)
+    adapter.scope = scope
+    environ = adapter.build_environ(scope, body)
+
+    with app.request_context(environ):
+        try:
+            response = await full_dispatch_request(view)
+        except Exception as e:
+            response = app.handle_exception(e)
+
+        await send({
+            'type': 'http.response.start',
+            'status': response.status_code,
+            'headers': [(k.lower().encode('latin1'), v.encode('latin1')) for k, v in response.headers.items()],
+        })
+        if not hasattr(response.response, '__aiter__'):
+            await send({'type': 'http.response.body', 'body': response.get_data()})
+            return
+    # an async generator body is streamed after the request, as Flask does with a generator
+    await stream(response.response, receive, send)
+
+
+async def full_dispatch_request(view):
+    # Flask's full_dispatch_request with the view awaited, made of the same Flask methods so
+    # the signals, hooks and error handlers are the ones the WSGI views get
+    try:
+        request_started.send(app, _async_wrapper=app.ensure_sync)
+        response = app.preprocess_request()
+        if response is None:
+            response = await view()
+    except Exception as e:
+        response = app.handle_user_exception(e)
+    return app.finalize_request(response)
+
+
+async def stream(chunks, receive, send):
+    # Sends the chunks as they come until they run out or the client goes away
+    async def send_chunks():
+        async for chunk in chunks:
+            await send({'type': 'http.response.body', 'body': chunk.encode(), 'more_body': True})
+        await send({'type': 'http.response.body', 'body': b''})
+
+    async def disconnected():
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+
+    tasks = [asyncio.ensure_future(send_chunks()), asyncio.ensure_future(disconnected())]
+    try:
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        # runs the generator's finally, which unsubscribes
+        await chunks.aclose()
+
+
+async def load_user(db_session):
+    # The user Flask-Login stored in the session cookie, or None
+    user_id = session_user_id()
+    if user_id is None:
+        return None
+    return await db_session.get(User, user_id)
+
+
+def session_user_id():
+    user_id = session.get('_user_id')
+    return int(user_id) if user_id is not None else None
+
+
+async def get_or_404(db_session, model, ident, **kw):
+    obj = await db_session.get(model, ident, **kw) if ident is not None else None
+    if obj is None:
+        abort(404)
+    return obj
+
+
+###### ASYNC VIEWS ######
+# Same requests and responses as the views of the same name in views.py, which they share
+# the work with: the helpers there take a session and run here on the sync session behind
+# the AsyncSession (run_sync), where the ORM can still load lazily.
+
+async def load_recipe(db_session, recipe_id):
+    # The signed in user and the recipe, for the views that change it
+    user = await load_user(db_session)
+    if user is None:
+        abort(app.login_manager.unauthorized())
+    return user, await get_or_404(db_session, Recipe, recipe_id)
+
+
+@async_view('like_recipe')
+async def like_recipe():
+    recipe_id = request.get_json().get('recipe_id')
+    async with database() as db_session:
+        user, recipe = await load_recipe(db_session, recipe_id)
+        return jsonify(await db_session.run_sync(like, recipe, user))
+
+
+@async_view('save_recipe')
+async def save_recipe():
+    recipe_id = request.get_json().get('recipe_id')
+    async with database() as db_session:
+        user, recipe = await load_recipe(db_session, recipe_id)
+        return jsonify(await db_session.run_sync(save, recipe, user))
+
+
+@async_view('get_recipe_details')
+async def get_recipe_details():
+    recipe_id = request.args.get('recipe_id', type=int)
+    # as in views.py, the async engine is the primary
+    generation, cached = cached_recipe_details(recipe_id)
+    if cached is None:
+        async with database() as db_session:
+            details = await db_session.run_sync(recipe_details_body, recipe_id)
+        cached = cache_recipe_details(recipe_id, generation, details)
+    return recipe_details_response(*cached)
+
+
+@async_view('add_comment')
+async def add_comment():
+    data = request.get_json()
+    recipe_id = data.get('recipe_id')
+    content = data.get('content', '').strip()
+    if not content:
+        return jsonify({'status': 'error', 'message': 'Comment content cannot be empty.'}), 400
+
+    async with database() as db_session:
+        user, recipe = await load_recipe(db_session, recipe_id)
+        comment_data = await db_session.run_sync(post_comment, recipe, user, content)
+    return jsonify({'status': 'success', 'comment': comment_data})
+
+
+@async_view('recipe_events')
+async def recipe_events():
+    return recipe_events_response(async_event_stream)
+
+
+@async_view('events')
+async def events():
+    return events_response(async_event_stream)
+
+
+@async_view('filter_recipes')
+async def filter_recipes():
+    sort_option = request.args.get('sort', 'all')
+    search_query = request.args.get('q', '').strip()
+
+    query = db.select(Recipe)
+    rank, highlights = None, {}
+    if search_query:
+        # the Whoosh backend reads its index from disk, keep that off the event loop
+        query, rank, highlights = await asyncio.to_thread(search_recipes, query, search_query)
+
+    cursor = request.args.get('cursor')
+    limit = min(max(request.args.get('limit', PAGE_SIZE, type=int), 1), MAX_PAGE_SIZE)
+    try:
+        statement = page_query(query, sort_option, cursor, limit, rank)
+    except ValueError:
+        return jsonify({'status': 'error', 'message': 'Invalid cursor.'}), 400
+
+    async with database() as db_session:
+        recipes, next_cursor = cut_page((await db_session.execute(statement)).all(), limit)
+        user = await load_user(db_session)
+        recipe_ids = [r.id for r in recipes]
+        user_likes = await member_ids(db_session, Like, user, recipe_ids)
+        user_saves = await member_ids(db_session, SavedRecipe, user, recipe_ids)
+
+    recipe_data = [
+        serialize_recipe(r, r.like_count, r.id in user_likes, r.id in user_saves)
+        for r in recipes
+    ]
+    for r in recipe_data:
+        if r['id'] in highlights:
+            r['highlight'] = highlights[r['id']]
+
+    return jsonify({'recipes': recipe_data, 'next_cursor': next_cursor})
+
+
+async def member_ids(db_session, model, user, recipe_ids):
+    # see _member_ids in feed.py
+    member_ids = set()
+    if user is None:
+        return member_ids
+    for chunk in _chunks(recipe_ids):
+        member_ids.update(await db_session.scalars(
+            db.select(model.recipe_id).where(model.user_id == user.id, model.recipe_id.in_(chunk))
+        ))
+    return member_ids
@@ -0,0 +1,202 @@
+import hashlib
+import http.client
+import json
+import os
+import random
+import threading
+import time
+from urllib.parse import urlsplit
+from itsdangerous import URLSafeTimedSerializer
+from werkzeug.security import generate_password_hash
+from app import app, db
+from .models import User, Recipe
+from .bulk import bulk_insert
+from .seed import WORDS, sentence, recipe_text
+
+###### BENCHMARKS ######
+# Load generators for a running server (python run.py, uvicorn asgi:app, ...), started from
+# the `flask bench` commands. Each worker thread keeps one keep-alive connection and sends its
+# share of the requests back to back, so concurrency is the number of requests in flight.
+
+
+def login_headers(user):
+    # Cookie and CSRF headers for a request as user, signed with the apps SECRET_KEY the way
+    # Flask-Login and Flask-WTF would, so the benchmark doesnt go through the login form
+    raw_token = hashlib.sha1(os.urandom(64)).hexdigest()
+    cookie = app.session_interface.get_signing_serializer(app).dumps(
+        {'_user_id': str(user.id), '_fresh': True, 'csrf_token': raw_token}
+    )
+    csrf_serializer = URLSafeTimedSerializer(app.config.get('WTF_CSRF_SECRET_KEY') or app.secret_key,
+                                             salt='wtf-csrf-token')
+    return {
+        'Cookie': f"{app.config['SESSION_COOKIE_NAME']}={cookie}",
+        'X-CSRFToken': csrf_serializer.dumps(raw_token),
+    }
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def summarize(latencies, errors, seconds):
+    # latencies in milliseconds, sorted
+    return {
+        'requests': len(latencies),
+        'errors': len(errors),
+        'error_rate': len(errors) / len(latencies) if latencies else 0,
+        'error_statuses': sorted(set(map(str, errors))),
+        'seconds': seconds,
+        'throughput': len(latencies) / seconds if seconds else 0,
+        'p50': percentile(latencies, 0.50),
+        'p95': percentile(latencies, 0.95),
+        'p99': percentile(latencies, 0.99),
+    }
+
+
+def run_load(base_url, make_request, total, concurrency):
+    # make_request(i) returns (route, method, path, json body or None, headers) for request
+    # number i, route is the name it is reported under. Returns the throughput, error rate and
+    # latency percentiles (milliseconds) of the whole run, and of each route under 'routes'.
+    url = urlsplit(base_url)
+    connection_class = http.client.HTTPSConnection if url.scheme == 'https' else http.client.HTTPConnection
+    results = []
+    counter = iter(range(total))
+    lock = threading.Lock()
+
+    def worker():
+        connection = connection_class(url.hostname, url.port, timeout=30)
+        while True:
+            with lock:
+                i = next(counter, None)
+            if i is None:
+                break
+            route, method, path, body, headers = make_request(i)
+            headers = dict(headers, **({'Content-Type': 'application/json'} if body is not None else {}))
+            start = time.perf_counter()
+            # a kept alive connection the server has closed meanwhile (e.g. a recycled worker)
+            # is reopened and the request sent again once, like a browser does
+            for _ in range(2):
+                try:
+                    connection.request(method, url.path.rstrip('/') + path,
+                                       body=json.dumps(body) if body is not None else None, headers=headers)
+                    response = connection.getresponse()
+                    response.read()
+                    status = response.status
+                    break
+                except (OSError, http.client.HTTPException) as e:
+                    connection.close()
+                    status = type(e).__name__
+            elapsed = (time.perf_counter() - start) * 1000
+            with lock:
+                results.append((route, elapsed, status))
+        connection.close()
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    seconds = time.perf_counter() - started
+
+    by_route = {}
+    for route, elapsed, status in results:
+        latencies, errors = by_route.setdefault(route, ([], []))
+        latencies.append(elapsed)
+        if status != 200:
+            errors.append(status)
+
+    report = summarize(sorted(elapsed for _, elapsed, _ in results),
+                       [status for _, _, status in results if status != 200], seconds)
+    report['routes'] = {
+        route: summarize(sorted(latencies), errors, seconds)
+        for route, (latencies, errors) in sorted(by_route.items())
+    }
+    return report
+
+
+def format_report(result):
+    lines = [
+        f"{result['requests']} requests in {result['seconds']:.2f}s, {result['throughput']:.1f} req/s",
+    ]
+    if result['requests']:
+        lines.append(f"latency ms  p50 {result['p50']:.1f}  p95 {result['p95']:.1f}  p99 {result['p99']:.1f}")
+    if result['errors']:
+        lines.append(f"{result['errors']} failed ({', '.join(result['error_statuses'])})")
+    return '\n'.join(lines)
+
+
+###### FULL SITE LOAD ######
+# `flask bench load` tops the database up to a dataset of bench users and recipes, then sends
+# a mix of the requests a browsing user makes, as --users different logged in users.
+# Weights are per 100 requests, the filter_recipes sorts and searches are reported separately.
+# For production sized data run `flask seed` first, the bench recipes only top it up.
+
+BENCH_PASSWORD = 'bench-password'
+
+REQUEST_MIX = (
+    ('filter_recipes?sort=all', 15),
+    ('filter_recipes?sort=liked', 10),
+    ('filter_recipes?sort=saved', 5),
+    ('filter_recipes?sort=recent', 10),
+    ('filter_recipes?sort=relevance&q=', 10),
+    ('get_recipe_details', 20),
+    ('like_recipe', 10),
+    ('save_recipe', 5),
+    ('add_comment', 5),
+    ('saved_recipes', 5),
+    ('my_recipes', 5),
+)
+
+
+def seed_bench_data(users, recipes, seed=0):
+    # Adds bench users (bench0, bench1, ...) and recipes by them until there are users of
+    # the one and recipes of the other. Returns the bench users.
+    rng = random.Random(seed)
+    existing = {username for username, in db.session.execute(
+        db.select(User.username).where(User.username.like('bench%')))}
+    password_hash = generate_password_hash(BENCH_PASSWORD, method='pbkdf2:sha256')
+    new_users = [
+        {'username': f'bench{i}', 'email': f'bench{i}@example.com', 'password_hash': password_hash}
+        for i in range(users) if f'bench{i}' not in existing
+    ]
+    with db.engine.begin() as connection:
+        bulk_insert(connection, User.__table__, new_users)
+
+    bench_users = User.query.filter(User.username.in_([f'bench{i}' for i in range(users)])).order_by(User.id).all()
+    missing = recipes - db.session.scalar(db.select(db.func.count(Recipe.id)))
+    new_recipes = (
+        {'user_id': rng.choice(bench_users).id, **recipe_text(rng)}
+        for _ in range(max(missing, 0))
+    )
+    with db.engine.begin() as connection:
+        bulk_insert(connection, Recipe.__table__, new_recipes)
+    return bench_users
+
+
+def site_requests(users, recipe_ids, seed=0):
+    # make_request for run_load, request i is the same request in every run with this seed
+    logins = [login_headers(user) for user in users]
+    routes = [route for route, weight in REQUEST_MIX for _ in range(weight)]
+
+    def make_request(i):
+        rng = random.Random(f'{seed}:{i}')
+        route = rng.choice(routes)
+        headers = rng.choice(logins)
+        recipe_id = rng.choice(recipe_ids)
+        if route.endswith('&q='):
+            return route, 'GET', f'/{route}{rng.choice(WORDS)}', None, headers
+        if route.startswith('filter_recipes'):
+            return route, 'GET', '/' + route, None, headers
+        if route == 'get_recipe_details':
+            return route, 'GET', f'/get_recipe_details?recipe_id={recipe_id}', None, headers
+        if route in ('like_recipe', 'save_recipe'):
+            return route, 'POST', '/' + route, {'recipe_id': recipe_id}, headers
+        if route == 'add_comment':
+            return route, 'POST', '/add_comment', {'recipe_id': recipe_id, 'content': sentence(rng, 12)}, headers
+        return route, 'GET', '/' + route, None, headers
+
+    return make_request
@@ -0,0 +1,73 @@
+import io
+import json
+from datetime import datetime
+from itertools import islice
+
+###### BULK INSERTS ######
+# Writing many rows at once (`flask import-recipes`) without the ORM. On PostgreSQL each batch
+# is streamed in with COPY ... FROM STDIN, which skips parsing and planning an INSERT per row,
+# everywhere else it is one executemany INSERT per batch. Either way the database fills in
+# server side defaults and runs its triggers (the SQLite FTS index, the PostgreSQL
+# search_vector), the ORM session events (the Whoosh indexer) dont see these rows.
+
+BATCH_SIZE = 5000
+
+
+def batches(rows, size):
+    rows = iter(rows)
+    while batch := list(islice(rows, size)):
+        yield batch
+
+
+def with_defaults(table, row):
+    # The Python side column defaults (created_at=datetime.utcnow, ...) an INSERT would add,
+    # COPY only knows the server side ones
+    row = dict(row)
+    for column in table.columns:
+        default = column.default
+        if column.key in row or default is None or not default.is_scalar and not default.is_callable:
+            continue
+        row[column.key] = default.arg(None) if default.is_callable else default.arg
+    return row
+
+
+def copy_value(value):
+    # One field in COPY's text format
+    if value is None:
+        return '\\N'
+    if isinstance(value, datetime):
+        value = value.isoformat(sep=' ')
+    elif isinstance(value, (dict, list)):
+        value = json.dumps(value)
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+def copy_rows(connection, table, rows):
+    columns = list(rows[0])
+    data = io.StringIO()
+    for row in rows:
+        data.write('\t'.join(copy_value(row[column]) for column in columns))
+        data.write('\n')
+    data.seek(0)
+
+    quote = connection.dialect.identifier_preparer.quote
+    statement = f"COPY {quote(table.name)} ({', '.join(map(quote, columns))}) FROM STDIN"
+    # psycopg2's cursor, on the connection (and so in the transaction) SQLAlchemy is using
+    cursor = connection.connection.dbapi_connection.cursor()
+    try:
+        cursor.copy_expert(statement, data)
+    finally:
+        cursor.close()
+
+
+def bulk_insert(connection, table, rows, batch_size=BATCH_SIZE):
+    # rows are dicts with the same keys, returns how many were inserted
+    copy = connection.dialect.name == 'postgresql'
+    count = 0
+    for batch in batches(rows, batch_size):
+        if copy:
+            copy_rows(connection, table, [with_defaults(table, row) for row in batch])
+        else:
+            connection.execute(table.insert(), batch)
+        count += len(batch)
+    return count
@@ -0,0 +1,185 @@
+import threading
+import time
+from collections import OrderedDict
+from app import app
+from .metrics import count_cache
+
+###### RESPONSE CACHE ######
+# Two tier cache for serialized responses, used for the /get_recipe_details payloads:
+#   1. an in-process LRU, no network at all on a hit
+#   2. optionally a Redis (or anything speaking its protocol) shared by every worker
+# Writes go to both tiers and invalidation deletes from both. Other workers only learn about
+# an invalidation through Redis, so their local entries also expire after a few seconds
+# (RECIPE_CACHE_LOCAL_TTL), which bounds how stale a worker can be.
+# Every recipe has a generation that invalidation bumps, and it is part of the key. A request
+# that read the generation, missed and then loaded the recipe while an edit committed stores
+# the old payload under the old generation, where nobody looks for it any more. With Redis the
+# generations live there so every worker sees a bump, which costs one GET per lookup.
+
+
+class LRUCache:
+    name = 'local'
+
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires is not None and expires < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        expires = time.monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            self._entries[key] = (value, expires)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class RedisCache:
+    # Values are (body bytes, etag) pairs stored as a two field hash
+    name = 'redis'
+
+    def __init__(self, url, prefix='foodie:', ttl=None):
+        # redis is only needed when the shared tier is configured
+        import redis
+        self.client = redis.Redis.from_url(url, socket_timeout=0.5)
+        self.prefix = prefix
+        self.ttl = ttl
+        self._errors = redis.RedisError
+
+    def get(self, key):
+        try:
+            body, etag = self.client.hmget(self.prefix + key, 'body', 'etag')
+        except self._errors:
+            # a cache that is down is a miss, the database still has the answer
+            app.logger.warning('Redis cache unavailable for get %s', key)
+            return None
+        if body is None:
+            return None
+        return body, etag.decode()
+
+    def set(self, key, value):
+        body, etag = value
+        try:
+            pipe = self.client.pipeline()
+            pipe.hset(self.prefix + key, mapping={'body': body, 'etag': etag})
+            if self.ttl:
+                pipe.expire(self.prefix + key, self.ttl)
+            pipe.execute()
+        except self._errors:
+            app.logger.warning('Redis cache unavailable for set %s', key)
+
+    def delete(self, key):
+        try:
+            self.client.delete(self.prefix + key)
+        except self._errors:
+            app.logger.warning('Redis cache unavailable for delete %s', key)
+
+
+class TieredCache:
+    # name labels the hits and misses on /metrics (app/metrics.py)
+    def __init__(self, tiers, name):
+        self.tiers = tiers
+        self.name = name
+
+    def get(self, key):
+        for i, tier in enumerate(self.tiers):
+            value = tier.get(key)
+            if value is not None:
+                # fill the faster tiers we missed on the way down
+                for faster in self.tiers[:i]:
+                    faster.set(key, value)
+                count_cache(self.name, tier.name)
+                return value
+        count_cache(self.name, 'miss')
+        return None
+
+    def set(self, key, value):
+        for tier in self.tiers:
+            tier.set(key, value)
+
+    def delete(self, key):
+        for tier in self.tiers:
+            tier.delete(key)
+
+
+class Generations:
+    # recipe id: number of invalidations, in Redis when redis_url is set
+    def __init__(self, redis_url=None, prefix='foodie:generation:'):
+        self._local = {}
+        self._lock = threading.Lock()
+        self.client = None
+        self.prefix = prefix
+        if redis_url:
+            import redis
+            self.client = redis.Redis.from_url(redis_url, socket_timeout=0.5)
+            self._errors = redis.RedisError
+
+    def get(self, recipe_id):
+        # None when Redis is down, the caller then leaves the cache alone
+        if self.client is None:
+            return self._local.get(recipe_id, 0)
+        try:
+            return int(self.client.get(f'{self.prefix}{recipe_id}') or 0)
+        except self._errors:
+            app.logger.warning('Redis cache unavailable for generation of recipe %s', recipe_id)
+            return None
+
+    def bump(self, recipe_id):
+        if self.client is None:
+            with self._lock:
+                self._local[recipe_id] = self._local.get(recipe_id, 0) + 1
+            return
+        try:
+            self.client.incr(f'{self.prefix}{recipe_id}')
+        except self._errors:
+            app.logger.warning('Redis cache unavailable for invalidating recipe %s', recipe_id)
+
+
+def create_cache(config, name):
+    # The payloads carry presigned image URLs (S3_URL_EXPIRES), an entry must be gone well
+    # before they stop working
+    ttl = min(config['RECIPE_CACHE_TTL'], config['S3_URL_EXPIRES'] // 2)
+    tiers = [LRUCache(config['RECIPE_CACHE_SIZE'], min(config['RECIPE_CACHE_LOCAL_TTL'] or ttl, ttl))]
+    if config['CACHE_REDIS_URL']:
+        tiers.append(RedisCache(config['CACHE_REDIS_URL'], ttl=ttl))
+    return TieredCache(tiers, name)
+
+
+recipe_cache = create_cache(app.config, 'recipe_details')
+recipe_generations = Generations(app.config['CACHE_REDIS_URL'])
+
+
+def recipe_key(recipe_id, generation):
+    return f'recipe_details:{recipe_id}:{generation}'
+
+
+def invalidate_recipe(recipe_id):
+    # Called after a commit that changes what /get_recipe_details returns for the recipe
+    generation = recipe_generations.get(recipe_id)
+    recipe_generations.bump(recipe_id)
+    if generation is not None:
+        recipe_cache.delete(recipe_key(recipe_id, generation))
@@ -0,0 +1,209 @@
+import os
+import json
+import time
+import click
+from app import app, db
+from .models import User, Recipe, Like, SavedRecipe, Comment
+from .search_index import search_index
+from .images import InvalidImage
+from .storage import attach_image, collect_unused_images, recount_image_references
+from .bench import login_headers, run_load, format_report, seed_bench_data, site_requests
+from .database import pragma_report
+from .bulk import bulk_insert, BATCH_SIZE
+from .seed import generate as generate_dataset
+
+###### CLI COMMANDS ######
+# Maintenance commands, run with `flask <command>` from the Foodie_Files folder
+
+
+def _count_of(model):
+    # correlated COUNT(*) of the rows pointing at each recipe
+    return db.select(db.func.count(model.id)).where(model.recipe_id == Recipe.id).scalar_subquery()
+
+
+@app.cli.command('reconcile-counts')
+def reconcile_counts():
+    """Repair the like/save/comment counters on recipes from the real rows."""
+    likes, saves, comments = _count_of(Like), _count_of(SavedRecipe), _count_of(Comment)
+
+    # only rewrite the recipes whose counters have drifted
+    result = db.session.execute(
+        db.update(Recipe)
+          .where((Recipe.like_count != likes) | (Recipe.save_count != saves) | (Recipe.comment_count != comments))
+          .values(like_count=likes, save_count=saves, comment_count=comments)
+          .execution_options(synchronize_session=False)
+    )
+    db.session.commit()
+    click.echo(f'Repaired counters on {result.rowcount} recipe(s).')
+
+
+@app.cli.command('rebuild-search-index')
+@click.option('--chunk-size', default=1000, show_default=True, help='Recipes read from the database at a time.')
+def rebuild_search_index(chunk_size):
+    """Rebuild the Whoosh search index from the database."""
+    total = search_index.rebuild(chunk_size, progress=lambda done: click.echo(f'Indexed {done} recipes...'))
+    click.echo(f'Search index rebuilt with {total} recipe(s).')
+
+
+@app.cli.command('process-images')
+def process_images():
+    """Move recipe images uploaded before the image pipeline into content addressed storage."""
+    processed = 0
+    for recipe in Recipe.query.filter(Recipe.image_url.isnot(None), Recipe.image_hash.is_(None)):
+        # old rows point at app/static/uploads/<file> or /static/uploads/<file>
+        filename = os.path.basename(recipe.image_url)
+        path = os.path.join(app.static_folder, 'uploads', filename)
+        try:
+            with open(path, 'rb') as original:
+                attach_image(recipe, original)
+        except (OSError, InvalidImage) as e:
+            click.echo(f'Skipped recipe {recipe.id}: {e}')
+            continue
+        processed += 1
+    db.session.commit()
+    click.echo(f'Processed images for {processed} recipe(s).')
+
+
+@app.cli.command('collect-images')
+def collect_images():
+    """Recount image references and delete the images no recipe uses."""
+    recounted = recount_image_references()
+    removed = collect_unused_images(everything=True)
+    click.echo(f'Recounted {recounted} image(s), removed {removed} unused image(s).')
+
+
+@app.cli.command('import-recipes')
+@click.argument('source', type=click.File('r', encoding='utf-8'))
+@click.option('--batch-size', default=BATCH_SIZE, show_default=True, help='Recipes written at a time.')
+def import_recipes(source, batch_size):
+    """Bulk load recipes from a JSON lines file (COPY on PostgreSQL).
+
+    Each line is an object with title, description, ingredients, steps and the author's username.
+    """
+    user_ids = dict(db.session.execute(db.select(User.username, User.id)).all())
+
+    def rows():
+        for number, line in enumerate(source, 1):
+            if not line.strip():
+                continue
+            recipe = json.loads(line)
+            if recipe.get('author') not in user_ids:
+                raise click.ClickException(f"Line {number}: unknown author {recipe.get('author')!r}.")
+            yield {
+                'user_id': user_ids[recipe['author']],
+                'title': recipe['title'],
+                'description': recipe['description'],
+                'ingredients': recipe['ingredients'],
+                'steps': recipe['steps'],
+            }
+
+    with db.engine.begin() as connection:
+        imported = bulk_insert(connection, Recipe.__table__, rows(), batch_size)
+    click.echo(f'Imported {imported} recipe(s).')
+    if app.config['SEARCH_BACKEND'] == 'whoosh':
+        click.echo('Run `flask rebuild-search-index` to make them searchable.')
+
+
+@app.cli.command('seed')
+@click.option('--users', default=1000, show_default=True, help='Users to add.')
+@click.option('--recipes', default=10000, show_default=True, help='Recipes to add.')
+@click.option('--likes', default=100000, show_default=True, help='Likes to add, about.')
+@click.option('--saves', default=20000, show_default=True, help='Saves to add, about.')
+@click.option('--comments', default=30000, show_default=True, help='Comments to add.')
+@click.option('--seed', default=0, show_default=True, help='Random seed, the same seed gives the same data.')
+@click.option('--batch-size', default=10000, show_default=True, help='Rows written per transaction.')
+def seed(users, recipes, likes, saves, comments, seed, batch_size):
+    """Add a synthetic dataset of users, recipes, likes, saves and comments.
+
+    For production scale e.g. --users 100000 --recipes 1000000 --likes 20000000.
+    """
+    if recipes and not users:
+        raise click.ClickException('Recipes need users to post them.')
+    started = time.perf_counter()
+
+    def progress(table, count):
+        click.echo(f'\r{table}: {count}', nl=False)
+
+    inserted = generate_dataset(users, recipes, likes, saves, comments, seed, batch_size, progress)
+    click.echo(f"\rAdded {', '.join(f'{count} {table}' for table, count in inserted.items())} "
+               f"in {time.perf_counter() - started:.0f}s.")
+    if app.config['SEARCH_BACKEND'] == 'whoosh':
+        click.echo('Run `flask rebuild-search-index` to make the recipes searchable.')
+
+
+@app.cli.command('sqlite-settings')
+def sqlite_settings():
+    """Show the SQLite settings a pooled connection actually runs with."""
+    if db.engine.dialect.name != 'sqlite':
+        raise click.ClickException('The database is not SQLite.')
+    with db.engine.connect() as connection:
+        report = pragma_report(connection.connection.dbapi_connection, app.config['SQLITE_PRAGMAS'])
+    for name, requested, effective, matches in report:
+        click.echo(f"{name:<14} {effective!s:<12} {'' if matches else f'(configured {requested})'}")
+
+
+@app.cli.command('serve')
+@click.option('--bind', default=lambda: app.config['SERVE_BIND'], help='host:port or unix:/path to listen on.')
+@click.option('--workers', type=int, default=lambda: app.config['SERVE_WORKERS'], help='Worker processes.')
+@click.option('--threads', type=int, default=lambda: app.config['SERVE_THREADS'], help='Threads per gthread worker.')
+@click.option('--worker-class', type=click.Choice(['gthread', 'gevent', 'uvicorn']),
+              default='gthread', show_default=True,
+              help='uvicorn serves SSE streams on an event loop, gevent needs a green database driver.')
+@click.option('--max-requests', type=int, default=lambda: app.config['SERVE_MAX_REQUESTS'],
+              help='Requests before a worker is replaced.')
+@click.option('--pid', 'pidfile', default=None, help='Write the master pid here, for kill -HUP.')
+def serve(bind, workers, threads, worker_class, max_requests, pidfile):
+    """Run the production server with preforked workers."""
+    # gunicorn only runs on Unix, so it is imported when the command is used
+    from .server import serve as run_server
+    run_server(bind, workers, threads, worker_class, max_requests, app.config['SERVE_MAX_REQUESTS_JITTER'],
+               app.config['SERVE_TIMEOUT'], app.config['SERVE_GRACEFUL_TIMEOUT'], pidfile)
+
+
+@app.cli.group('bench')
+def bench():
+    """Load tests against a running server."""
+
+
+@bench.command('likes')
+@click.option('--url', default='http://127.0.0.1:5000', show_default=True, help='Server to test.')
+@click.option('--requests', 'total', default=2000, show_default=True, help='Likes to send.')
+@click.option('--concurrency', default=50, show_default=True, help='Requests in flight at once.')
+@click.option('--users', default=20, show_default=True, help='Existing users to like as.')
+def bench_likes(url, total, concurrency, users):
+    """Toggle likes concurrently as several users and report throughput."""
+    logins = [login_headers(user) for user in User.query.order_by(User.id).limit(users)]
+    recipe_ids = [recipe_id for recipe_id, in db.session.query(Recipe.id).order_by(Recipe.id).limit(100)]
+    if not logins or not recipe_ids:
+        raise click.ClickException('The database needs users and recipes to benchmark against.')
+
+    def like(i):
+        recipe_id = recipe_ids[i % len(recipe_ids)]
+        return 'like_recipe', 'POST', '/like_recipe', {'recipe_id': recipe_id}, logins[i % len(logins)]
+
+    click.echo(format_report(run_load(url, like, total, concurrency)))
+
+
+@bench.command('load')
+@click.option('--url', default='http://127.0.0.1:5000', show_default=True, help='Server to test.')
+@click.option('--requests', 'total', default=5000, show_default=True, help='Requests to send.')
+@click.option('--concurrency', default=50, show_default=True, help='Requests in flight at once.')
+@click.option('--users', default=50, show_default=True, help='Bench users to log in and browse as.')
+@click.option('--recipes', default=1000, show_default=True, help='Recipes the database is topped up to.')
+@click.option('--seed', default=0, show_default=True, help='Random seed for the data and the requests.')
+@click.option('--output', type=click.File('w'), default='-', help='Write the JSON report here.')
+def bench_load(url, total, concurrency, users, recipes, seed, output):
+    """Drive a mix of every page and endpoint and report each route as JSON.
+
+    The server has to use the same database, it is seeded with bench users and recipes first.
+    """
+    bench_users = seed_bench_data(users, recipes, seed)
+    recipe_ids = [recipe_id for recipe_id, in db.session.query(Recipe.id).order_by(Recipe.id).limit(recipes)]
+    if not recipe_ids:
+        raise click.ClickException('There are no recipes to benchmark against.')
+
+    result = run_load(url, site_requests(bench_users, recipe_ids, seed), total, concurrency)
+    result.update(url=url, concurrency=concurrency, users=len(bench_users), recipes=len(recipe_ids))
+    json.dump(result, output, indent=2)
+    output.write('\n')
+    click.echo(format_report(result), err=True)
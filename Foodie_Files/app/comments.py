@@ -0,0 +1,47 @@
+from sqlalchemy.orm import joinedload
+from app import db
+from .models import Comment
+from .feed import encode_cursor, decode_cursor
+
+###### COMMENT PAGES ######
+# Comments are shown oldest first and fetched a page at a time with the same keyset
+# pagination as the feed, cut on (created_at, id) and walking ix_comments_recipe_id_created_at.
+# The cursor is the one the 'recent' feed uses, [created_at, id] of the last comment sent.
+
+COMMENT_PAGE_SIZE = 20
+
+
+def serialize_comment(comment):
+    return {
+        'id': comment.id,
+        'author': comment.user.username,
+        'content': comment.content,
+        'created_at': comment.created_at.strftime("%Y-%m-%d %H:%M:%S")
+    }
+
+
+def comments_statement(recipe_id, after=None, limit=COMMENT_PAGE_SIZE):
+    # The select for one page of comments plus one, raises ValueError for a bad cursor
+    statement = db.select(Comment).options(joinedload(Comment.user)).where(Comment.recipe_id == recipe_id)
+    if after:
+        created_at, last_id = decode_cursor(after, 'recent')
+        statement = statement.where(db.or_(Comment.created_at > created_at,
+                                           db.and_(Comment.created_at == created_at, Comment.id > last_id)))
+
+    # one extra row tells us whether there is another page
+    return statement.order_by(Comment.created_at.asc(), Comment.id.asc()).limit(limit + 1)
+
+
+def page_comments(recipe_id, after=None, limit=COMMENT_PAGE_SIZE):
+    # Returns (serialized comments, next cursor or None when this is the last page)
+    return cut_comments(db.session.scalars(comments_statement(recipe_id, after, limit)).all(), limit)
+
+
+def cut_comments(comments, limit):
+    page = comments[:limit]
+
+    next_cursor = None
+    if len(comments) > limit:
+        next_cursor = encode_cursor(page[-1].created_at, page[-1].id)
+
+    return [serialize_comment(c) for c in page], next_cursor
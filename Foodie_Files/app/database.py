@@ -0,0 +1,168 @@
+import os
+import time
+from functools import wraps
+from flask import g, session, has_request_context
+from sqlalchemy import event
+from sqlalchemy.dialects import sqlite, postgresql
+from app import app, db
+
+###### SQLITE CONNECTION SETTINGS ######
+# SQLite keeps most of its settings per connection, so the SQLITE_PRAGMAS from config.py are
+# applied to every connection the pools open (the Flask-SQLAlchemy engine and the async one
+# in app/asgi.py). The first connection logs what SQLite actually ended up using, a pragma it
+# ignores (WAL on a network filesystem, mmap above the compiled in limit) is a warning.
+# `flask sqlite-settings` prints the same report.
+
+# what SQLite reads back for the named values
+PRAGMA_VALUES = {
+    'synchronous': {'OFF': 0, 'NORMAL': 1, 'FULL': 2, 'EXTRA': 3},
+    'temp_store': {'DEFAULT': 0, 'FILE': 1, 'MEMORY': 2},
+}
+BOOLEAN_VALUES = {'ON': 1, 'TRUE': 1, 'YES': 1, 'OFF': 0, 'FALSE': 0, 'NO': 0}
+
+
+def apply_pragmas(dbapi_connection, pragmas):
+    cursor = dbapi_connection.cursor()
+    try:
+        for name, value in pragmas.items():
+            cursor.execute(f'PRAGMA {name} = {value}')
+    finally:
+        cursor.close()
+
+
+def read_pragmas(dbapi_connection, names):
+    cursor = dbapi_connection.cursor()
+    effective = {}
+    try:
+        for name in names:
+            cursor.execute(f'PRAGMA {name}')
+            effective[name] = cursor.fetchone()[0]
+    finally:
+        cursor.close()
+    return effective
+
+
+def _expected(name, value):
+    # The value as SQLite reports it, 'NORMAL' -> 1, 'WAL' -> 'wal', 'ON' -> 1
+    if isinstance(value, str):
+        upper = value.upper()
+        if upper in PRAGMA_VALUES.get(name, {}):
+            return PRAGMA_VALUES[name][upper]
+        if upper in BOOLEAN_VALUES:
+            return BOOLEAN_VALUES[upper]
+        return value.lower()
+    return value
+
+
+def pragma_report(dbapi_connection, pragmas):
+    # [(name, requested, effective, matches)] for every configured pragma
+    effective = read_pragmas(dbapi_connection, pragmas)
+    return [
+        (name, value, effective[name], _expected(name, value) == effective[name])
+        for name, value in pragmas.items()
+    ]
+
+
+def log_pragma_report(engine, report):
+    database = os.path.basename(engine.url.database or '') or ':memory:'
+    app.logger.info('SQLite %s: %s', database, ', '.join(f'{name}={effective}' for name, _, effective, _ in report))
+    for name, requested, effective, matches in report:
+        if not matches:
+            app.logger.warning('SQLite %s: %s is %s, %s was configured', database, name, effective, requested)
+
+
+def configure_sqlite(engine, read_only=False):
+    # Register the pragmas on an engine's new connections, other databases are left alone.
+    # A read only connection cant change the journal mode, the primary sets it in the file.
+    if engine.dialect.name != 'sqlite':
+        return
+    pragmas = dict(app.config['SQLITE_PRAGMAS'])
+    if read_only:
+        pragmas.pop('journal_mode', None)
+    reported = []
+
+    @event.listens_for(engine, 'connect')
+    def set_pragmas(dbapi_connection, connection_record):
+        apply_pragmas(dbapi_connection, pragmas)
+        if not reported:
+            reported.append(True)
+            log_pragma_report(engine, pragma_report(dbapi_connection, pragmas))
+
+
+with app.app_context():
+    configure_sqlite(db.engine)
+    if 'replica' in db.engines:
+        configure_sqlite(db.engines['replica'], read_only=True)
+
+
+###### READ/WRITE ROUTING ######
+# Views that only read are decorated with read_replica and query the 'replica' bind
+# (REPLICA_URI, see app/routing.py for how queries are routed). A user who has just written
+# is kept on the primary for READ_YOUR_WRITES_SECONDS, so their own like, save or comment
+# shows up even when the replica is behind. The time of their last committed write is kept
+# in their session cookie.
+
+LAST_WRITE_KEY = '_last_write'
+
+
+def read_replica(view):
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if 'replica' in db.engines and not recently_wrote():
+            g.use_replica = True
+        return view(*args, **kwargs)
+    return wrapper
+
+
+def recently_wrote():
+    last_write = session.get(LAST_WRITE_KEY)
+    return last_write is not None and time.time() - last_write < app.config['READ_YOUR_WRITES_SECONDS']
+
+
+def mark_write():
+    # Called after a commit that changed something, see track_writes
+    if has_request_context():
+        session[LAST_WRITE_KEY] = time.time()
+
+
+def _note_flush(db_session, flush_context):
+    db_session.info['wrote'] = True
+
+
+def _note_statement(orm_execute_state):
+    if orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete:
+        orm_execute_state.session.info['wrote'] = True
+
+
+def _mark_committed_write(db_session):
+    if db_session.info.pop('wrote', False):
+        mark_write()
+
+
+def _forget_write(db_session):
+    db_session.info.pop('wrote', None)
+
+
+def track_writes(target):
+    # mark_write() after every commit of a session of target (a session, or a Session class) that changed something
+    event.listen(target, 'after_flush', _note_flush)
+    event.listen(target, 'do_orm_execute', _note_statement)
+    event.listen(target, 'after_commit', _mark_committed_write)
+    event.listen(target, 'after_rollback', _forget_write)
+
+
+track_writes(db.session)
+
+
+###### DIALECT SPECIFIC STATEMENTS ######
+# SQLite and PostgreSQL both skip a row that would break a unique index with
+# INSERT ... ON CONFLICT DO NOTHING, the rowcount tells whether it went in. That saves the
+# failed INSERT, IntegrityError and rollback when a double click toggles a like/save twice.
+
+INSERTS = {'sqlite': sqlite.insert, 'postgresql': postgresql.insert}
+
+
+def insert_ignoring_conflicts(model, dialect_name):
+    # An INSERT into model's table that skips conflicting rows, None if the database cant
+    insert = INSERTS.get(dialect_name)
+    return insert(model).on_conflict_do_nothing() if insert is not None else None
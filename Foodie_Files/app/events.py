@@ -0,0 +1,232 @@
+import asyncio
+import json
+import os
+import queue
+import threading
+import time
+from app import app
+
+###### LIVE EVENTS ######
+# Like counts and new comments are pushed to open pages as Server-Sent Events instead of
+# the page polling get_recipe_details. Views publish to a channel per recipe after they
+# commit, and every open stream holds a subscription on the channels it shows.
+# The broker is picked with EVENTS_BROKER in config.py:
+#   'local' - in-process fan out, only the streams of the worker that handled the write
+#   'redis' - publishes through Redis pub/sub (or anything speaking its protocol) so the
+#             streams on every worker get it, one listener thread per worker process
+# A stream is a generator waiting on a queue and touches neither the database nor the
+# request once it starts. Under WSGI each open stream holds a worker thread (a greenlet with
+# `flask serve --worker-class gevent`). Under ASGI (app/asgi.py, `flask serve --worker-class
+# uvicorn`) the streams are async generators on the event loop and hold no thread at all.
+
+
+def recipe_channel(recipe_id):
+    return f'recipe:{recipe_id}'
+
+
+class Subscription:
+    # The events for a set of channels, in order. A subscriber that falls QUEUE_SIZE events
+    # behind is closed rather than slowing the publisher down, the client reconnects.
+    def __init__(self, broker, channels, queue_size):
+        self.broker = broker
+        self.channels = set(channels)
+        self.closed = False
+        self._queue = queue.Queue(maxsize=queue_size)
+
+    def put(self, event):
+        try:
+            self._queue.put_nowait(event)
+        except queue.Full:
+            self.close()
+
+    def get(self, timeout):
+        # Returns (event name, data) or None when nothing arrived within the timeout
+        try:
+            return self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.broker.unsubscribe(self)
+
+
+class AsyncSubscription(Subscription):
+    # For a coroutine on the running event loop. Events are put from any thread (a WSGI
+    # request, the Redis listener) and handed over to the loop.
+    def __init__(self, broker, channels, queue_size):
+        super().__init__(broker, channels, queue_size)
+        self._loop = asyncio.get_running_loop()
+        self._queue = asyncio.Queue(maxsize=queue_size)
+
+    def put(self, event):
+        try:
+            self._loop.call_soon_threadsafe(self._put, event)
+        except RuntimeError:
+            # the loop has been closed
+            self.close()
+
+    def _put(self, event):
+        try:
+            self._queue.put_nowait(event)
+        except asyncio.QueueFull:
+            self.close()
+
+    async def get(self, timeout):
+        try:
+            return await asyncio.wait_for(self._queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+
+class LocalBroker:
+    def __init__(self, queue_size=100):
+        self.queue_size = queue_size
+        self._subscribers = {}
+        self._lock = threading.Lock()
+
+    def subscribe(self, channels):
+        return self.add(Subscription(self, channels, self.queue_size))
+
+    def subscribe_async(self, channels):
+        return self.add(AsyncSubscription(self, channels, self.queue_size))
+
+    def add(self, subscription):
+        with self._lock:
+            for channel in subscription.channels:
+                self._subscribers.setdefault(channel, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            for channel in subscription.channels:
+                subscribers = self._subscribers.get(channel)
+                if subscribers is not None:
+                    subscribers.discard(subscription)
+                    if not subscribers:
+                        del self._subscribers[channel]
+
+    def publish(self, channel, event, data):
+        self.deliver(channel, event, data)
+
+    def deliver(self, channel, event, data):
+        with self._lock:
+            subscribers = list(self._subscribers.get(channel, ()))
+        for subscription in subscribers:
+            subscription.put((event, data))
+
+
+class RedisBroker(LocalBroker):
+    # Publishing goes through Redis, the listener thread delivers what comes back to the
+    # subscriptions of this process. Our own publishes come back the same way.
+    def __init__(self, url, prefix='foodie:events:', queue_size=100):
+        super().__init__(queue_size)
+        # redis is only needed when this broker is configured
+        import redis
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+        self._errors = redis.RedisError
+        self._listener = None
+        self._listener_pid = None
+
+    def add(self, subscription):
+        # The thread is started on first use (and again after a fork) rather than at import
+        if self._listener is None or not self._listener.is_alive() or self._listener_pid != os.getpid():
+            self._listener_pid = os.getpid()
+            self._listener = threading.Thread(target=self._listen, name='event-listener', daemon=True)
+            self._listener.start()
+        return super().add(subscription)
+
+    def publish(self, channel, event, data):
+        try:
+            self.client.publish(self.prefix + channel, json.dumps([event, data]))
+        except self._errors:
+            # a missed live update only means a stale count until the next one
+            app.logger.warning('Redis unavailable, event %s on %s not published', event, channel)
+
+    def _listen(self):
+        while True:
+            try:
+                pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+                pubsub.psubscribe(self.prefix + '*')
+                for message in pubsub.listen():
+                    channel = message['channel'].decode()[len(self.prefix):]
+                    event, data = json.loads(message['data'])
+                    self.deliver(channel, event, data)
+            except self._errors:
+                app.logger.warning('Redis event listener disconnected, reconnecting')
+                time.sleep(1)
+
+
+def create_broker(config):
+    backend = config['EVENTS_BROKER']
+    if backend == 'local':
+        return LocalBroker(config['EVENTS_QUEUE_SIZE'])
+    if backend == 'redis':
+        return RedisBroker(config['EVENTS_REDIS_URL'], queue_size=config['EVENTS_QUEUE_SIZE'])
+    raise ValueError(f'Unknown EVENTS_BROKER: {backend}')
+
+
+broker = create_broker(app.config)
+
+
+def publish_recipe_event(recipe_id, event, data):
+    # Called after the commit, streams only ever see committed state
+    broker.publish(recipe_channel(recipe_id), event, dict(data, recipe_id=recipe_id))
+
+
+###### SSE STREAMS ######
+
+def sse_message(event=None, data=None, comment=None, retry=None):
+    lines = []
+    if comment is not None:
+        lines.append(f': {comment}')
+    if retry is not None:
+        lines.append(f'retry: {retry}')
+    if event is not None:
+        lines.append(f'event: {event}')
+    if data is not None:
+        lines.append(f'data: {json.dumps(data)}')
+    return '\n'.join(lines) + '\n\n'
+
+
+def event_stream(recipe_ids):
+    # The stream ends after EVENTS_STREAM_MAX_AGE seconds and the browser reconnects,
+    # which spreads long lived connections over restarted workers.
+    channels = [recipe_channel(recipe_id) for recipe_id in recipe_ids]
+    heartbeat = app.config['EVENTS_HEARTBEAT']
+    max_age = app.config['EVENTS_STREAM_MAX_AGE']
+
+    def generate():
+        # subscribed inside the generator so the finally always runs for it
+        subscription = broker.subscribe(channels)
+        deadline = time.monotonic() + max_age
+        try:
+            yield sse_message(retry=app.config['EVENTS_RETRY_MS'], comment='connected')
+            while not subscription.closed and time.monotonic() < deadline:
+                yield next_message(subscription.get(timeout=heartbeat))
+        finally:
+            subscription.close()
+
+    return generate()
+
+
+async def async_event_stream(recipe_ids):
+    # event_stream for the ASGI app, the waiting is done on the event loop
+    subscription = broker.subscribe_async([recipe_channel(recipe_id) for recipe_id in recipe_ids])
+    deadline = time.monotonic() + app.config['EVENTS_STREAM_MAX_AGE']
+    try:
+        yield sse_message(retry=app.config['EVENTS_RETRY_MS'], comment='connected')
+        while not subscription.closed and time.monotonic() < deadline:
+            yield next_message(await subscription.get(timeout=app.config['EVENTS_HEARTBEAT']))
+    finally:
+        subscription.close()
+
+
+def next_message(message):
+    if message is None:
+        # keeps proxies from closing an idle connection
+        return sse_message(comment='ping')
+    event, data = message
+    return sse_message(event, data)
@@ -0,0 +1,176 @@
+import base64
+import json
+from datetime import datetime
+from flask import g
+from sqlalchemy.orm import selectinload
+from app import db
+from .models import Recipe, Like, SavedRecipe
+
+###### FEED QUERIES ######
+# Builds the recipe lists used by filter_recipes, saved_recipes and the templates
+# in a fixed number of queries instead of lazy loading likes/saves per recipe:
+#   1. the recipes themselves, like counts come from the Recipe.like_count counter
+#   2. their authors (selectinload, one IN query)
+#   3. + 4. the recipe ids the current user has liked / saved
+
+# SQLite limits how many parameters one statement can bind, so IN lists are chunked
+IN_CHUNK_SIZE = 500
+
+# Pages returned by filter_recipes, the client can ask for fewer/more up to the max
+PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+
+def _chunks(ids):
+    for i in range(0, len(ids), IN_CHUNK_SIZE):
+        yield ids[i:i + IN_CHUNK_SIZE]
+
+
+def _member_ids(model, user, recipe_ids=None):
+    if user is None or not user.is_authenticated:
+        return set()
+    query = db.session.query(model.recipe_id).filter(model.user_id == user.id)
+    if recipe_ids is None:
+        return {row[0] for row in query}
+    member_ids = set()
+    for chunk in _chunks(list(recipe_ids)):
+        member_ids.update(row[0] for row in query.filter(model.recipe_id.in_(chunk)))
+    return member_ids
+
+
+def liked_ids(user, recipe_ids=None):
+    return _member_ids(Like, user, recipe_ids)
+
+
+def saved_ids(user, recipe_ids=None):
+    return _member_ids(SavedRecipe, user, recipe_ids)
+
+
+def request_liked_ids(user):
+    # All the recipes a user has liked, loaded once per request for the template filters
+    cache = g.setdefault('feed_liked_ids', {})
+    if user.id not in cache:
+        cache[user.id] = liked_ids(user)
+    return cache[user.id]
+
+
+def request_saved_ids(user):
+    cache = g.setdefault('feed_saved_ids', {})
+    if user.id not in cache:
+        cache[user.id] = saved_ids(user)
+    return cache[user.id]
+
+
+def serialize_recipe(recipe, like_count, user_liked, user_saved):
+    return {
+        'id': recipe.id,
+        'title': recipe.title,
+        'author': recipe.author.username,
+        'like_count': like_count,
+        'user_liked': user_liked,
+        'user_saved': user_saved
+    }
+
+
+def load_feed(recipes, user):
+    # Serialize already loaded recipes with their counts and the users like/save state
+    recipe_ids = [r.id for r in recipes]
+
+    user_likes = liked_ids(user, recipe_ids)
+    user_saves = saved_ids(user, recipe_ids)
+
+    return [
+        serialize_recipe(r, r.like_count, r.id in user_likes, r.id in user_saves)
+        for r in recipes
+    ]
+
+
+def build_feed(query, user):
+    # Run a Recipe query and return the whole serialized list
+    return load_feed(query.options(selectinload(Recipe.author)).all(), user)
+
+
+###### KEYSET PAGINATION ######
+# Pages are cut with a WHERE on the last seen (sort key, id) instead of OFFSET so every
+# page costs the same no matter how deep the client has scrolled.
+# The cursor is the urlsafe base64 of the JSON [sort key, id] of the last recipe sent.
+
+def encode_cursor(sort_value, recipe_id):
+    if isinstance(sort_value, datetime):
+        sort_value = sort_value.isoformat()
+    raw = json.dumps([sort_value, recipe_id]).encode()
+    return base64.urlsafe_b64encode(raw).decode()
+
+
+def decode_cursor(cursor, sort_option):
+    # Raises ValueError for anything that isnt a cursor we handed out
+    try:
+        sort_value, recipe_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        if sort_option == 'recent':
+            sort_value = datetime.fromisoformat(sort_value)
+    except (TypeError, ValueError):
+        raise ValueError('Invalid cursor')
+    # relevance cursors carry the bm25/ts_rank score, every other key is an integer
+    value_types = (int, float) if sort_option == 'relevance' else int
+    if not isinstance(recipe_id, int) or (sort_option != 'recent' and not isinstance(sort_value, value_types)):
+        raise ValueError('Invalid cursor')
+    return sort_value, recipe_id
+
+
+def sort_key(sort_option, rank=None):
+    # Returns the key column to sort and cut pages on and whether it sorts descending.
+    # 'all' is oldest first by id, 'relevance' is best bm25 score (lowest) first and only
+    # applies to searches, every other sort is descending with the id as tie breaker.
+    # the counters are indexed together with the id so these walk ix_recipes_*_count_id
+    if sort_option == 'liked':
+        return Recipe.like_count, True
+    if sort_option == 'saved':
+        return Recipe.save_count, True
+    if sort_option == 'recent':
+        return Recipe.created_at, True
+    if sort_option == 'relevance' and rank is not None:
+        return rank, False
+    return Recipe.id, False
+
+
+def page_query(query, sort_option, cursor=None, limit=PAGE_SIZE, rank=None):
+    # The query for one page of (Recipe, sort value) rows, with one row more than the page.
+    # query is a Recipe query or a select(Recipe) statement (for the async views in asgi.py),
+    # rank is the relevance column from search_recipes when the list is a search.
+    key, descending = sort_key(sort_option, rank)
+
+    if cursor:
+        sort_value, last_id = decode_cursor(cursor, sort_option)
+        if key is Recipe.id:
+            query = query.filter(Recipe.id > last_id)
+        elif descending:
+            query = query.filter(db.or_(key < sort_value, db.and_(key == sort_value, Recipe.id < last_id)))
+        else:
+            query = query.filter(db.or_(key > sort_value, db.and_(key == sort_value, Recipe.id > last_id)))
+
+    if key is Recipe.id:
+        query = query.order_by(Recipe.id.asc())
+    elif descending:
+        query = query.order_by(key.desc(), Recipe.id.desc())
+    else:
+        query = query.order_by(key.asc(), Recipe.id.asc())
+
+    # one extra row tells us whether there is another page without a COUNT
+    return query.add_columns(key).options(selectinload(Recipe.author)).limit(limit + 1)
+
+
+def cut_page(rows, limit):
+    # Returns (recipes on the page, next cursor or None when this is the last page)
+    page = rows[:limit]
+    next_cursor = None
+    if len(rows) > limit:
+        last_recipe, last_value = page[-1]
+        next_cursor = encode_cursor(last_value, last_recipe.id)
+    return [r for r, _ in page], next_cursor
+
+
+def page_feed(query, sort_option, user, cursor=None, limit=PAGE_SIZE, rank=None):
+    # Returns (serialized recipes, next cursor or None when this is the last page)
+    rows = page_query(query, sort_option, cursor, limit, rank).all()
+    recipes, next_cursor = cut_page(rows, limit)
+    return load_feed(recipes, user), next_cursor
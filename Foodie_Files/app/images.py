@@ -0,0 +1,68 @@
+import io
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+###### IMAGE PIPELINE ######
+# Uploaded recipe images are decoded once and re-encoded as WebP and JPEG at a few fixed
+# widths, with the EXIF/ICC metadata dropped. The set of files is stored on the recipe as
+#   {'thumb': {'width': 160, 'height': 120, 'webp': key, 'jpeg': key}, 'card': {...}, 'full': {...}}
+# where the keys are storage keys. storage.py turns them into URLs and srcset attributes so
+# browsers pick the smallest file. This module only decodes and encodes.
+
+RENDITION_WIDTHS = {'thumb': 160, 'card': 480, 'full': 1200}
+JPEG_QUALITY = 82
+WEBP_QUALITY = 80
+
+
+class InvalidImage(ValueError):
+    pass
+
+
+def _flatten(img):
+    # JPEG has no alpha channel, put transparent images on a white background
+    if img.mode in ('RGBA', 'LA') or (img.mode == 'P' and 'transparency' in img.info):
+        img = img.convert('RGBA')
+        background = Image.new('RGB', img.size, (255, 255, 255))
+        background.paste(img, mask=img.getchannel('A'))
+        return background
+    return img.convert('RGB')
+
+
+def decode_image(stream):
+    # Decode the upload once, upright and without metadata
+    try:
+        img = Image.open(stream)
+        # let the JPEG decoder scale down while decoding when the original is huge
+        largest = max(RENDITION_WIDTHS.values())
+        img.draft('RGB', (largest, largest))
+        img = ImageOps.exif_transpose(img)
+        img.load()
+    except (UnidentifiedImageError, OSError, Image.DecompressionBombError) as e:
+        raise InvalidImage(str(e))
+    return _flatten(img)
+
+
+def render_image(img, save):
+    # Encode every rendition of a decoded image and return the rendition set,
+    # save(filename, data, content_type) stores one encoded file and returns its key
+    renditions = {}
+    previous = None
+    for name, target_width in sorted(RENDITION_WIDTHS.items(), key=lambda item: item[1]):
+        width = min(target_width, img.width)
+        if previous and previous['width'] == width:
+            # never upscale, a small original reuses the biggest rendition it already has
+            renditions[name] = dict(previous)
+            continue
+
+        height = max(1, round(img.height * width / img.width))
+        resized = img if width == img.width else img.resize((width, height), Image.LANCZOS)
+
+        rendition = {'width': width, 'height': height}
+        for fmt, ext, options in (('webp', 'webp', {'quality': WEBP_QUALITY, 'method': 4}),
+                                  ('jpeg', 'jpg', {'quality': JPEG_QUALITY, 'optimize': True, 'progressive': True})):
+            data = io.BytesIO()
+            resized.save(data, fmt.upper(), **options)
+            data.seek(0)
+            rendition[fmt] = save(f'{name}.{ext}', data, f'image/{fmt}')
+
+        renditions[name] = previous = rendition
+    return renditions
@@ -0,0 +1,172 @@
+import asyncio
+import functools
+import os
+import resource
+import threading
+import tracemalloc
+from flask import g, request
+from app import app
+from .metrics import observe
+from .profiler import short_path
+
+###### MEMORY PROFILING ######
+# With MEMORY_PROFILE on, tracemalloc follows every allocation and each request is measured
+# from before_request to after_request:
+#   - peak: the most the process had allocated during the request over what it started with
+#   - growth: what was still allocated at the end (the ORM identity map, the rendered page)
+#   - sites: the lines that allocated the most, from comparing a snapshot taken after with
+#     one taken before, each with the line of our code that led to it. Snapshots are slow,
+#     they are compared for the first request of a route and every
+#     MEMORY_PROFILE_SNAPSHOT_EVERY requests after that
+# The numbers are added up by route on the Diagnostics > Memory admin page, and the peaks go
+# to /metrics as a histogram.
+# tracemalloc sees the whole process, so only one request is measured at a time and a worker
+# handles its requests one after the other while this is on. The async views in asgi.py
+# share the event loop's thread, one that comes while another request is being measured
+# goes unmeasured instead of blocking the loop.
+# Tracing slows every allocation down and snapshots take longer the bigger the heap, this is
+# for a staging box or one worker taken out of rotation.
+
+_measuring = threading.Lock()
+_app_dir = os.path.dirname(os.path.abspath(__file__))
+
+# allocations of the measuring itself, and the hooks that sit between our code and the
+# allocations without being the reason for them
+_ignored = (tracemalloc.__file__, __file__)
+_plumbing = ('timing.py', 'metrics.py', 'sqlstats.py', 'slowlog.py', 'profiler.py', 'memprofile.py',
+             'routing.py', 'database.py')
+
+
+class RouteMemory:
+    def __init__(self):
+        self.requests = 0
+        self.snapshots = 0  # requests the sites come from
+        self.peak_total = 0
+        self.peak_max = 0
+        self.growth_total = 0
+        self.sites = {}  # (site, called from): [bytes, blocks], added up over the requests
+
+    def add(self, peak, growth, sites, keep):
+        self.requests += 1
+        self.peak_total += peak
+        self.peak_max = max(self.peak_max, peak)
+        self.growth_total += growth
+        if sites is None:
+            return
+        self.snapshots += 1
+        for key, size, count in sites:
+            entry = self.sites.setdefault(key, [0, 0])
+            entry[0] += size
+            entry[1] += count
+        if len(self.sites) > keep:
+            for key in sorted(self.sites, key=lambda k: self.sites[k][0])[:len(self.sites) - keep]:
+                del self.sites[key]
+
+    @property
+    def peak_mean(self):
+        return self.peak_total / self.requests
+
+    @property
+    def growth_mean(self):
+        return self.growth_total / self.requests
+
+    def snapshot_due(self, every):
+        return every > 0 and self.requests % every == 0
+
+    def top_sites(self, n=10):
+        # [(site, called from, bytes per request, blocks per request)], biggest first
+        ranked = sorted(self.sites.items(), key=lambda item: item[1][0], reverse=True)[:n]
+        return [(site, caller, size / self.snapshots, count / self.snapshots)
+                for (site, caller), (size, count) in ranked]
+
+
+routes = {}  # route rule: RouteMemory, only changed by the request being measured
+
+
+@functools.lru_cache(maxsize=4096)
+def frame_text(filename, lineno):
+    return f'{short_path(filename)}:{lineno}'
+
+
+def caller_in_app(traceback):
+    # the innermost frame in app/ besides the hooks, None when the allocation itself is ours
+    if traceback[-1].filename.startswith(_app_dir):
+        return None
+    for frame in reversed(traceback):
+        if frame.filename.startswith(_app_dir) and not frame.filename.endswith(_plumbing):
+            return frame_text(frame.filename, frame.lineno)
+    return None
+
+
+def top_sites(before, n):
+    # [((site, called from), bytes, blocks)] allocated since the before snapshot and still
+    # allocated, the n biggest. Snapshot.filter_traces is slow on a big heap, the measuring's
+    # own allocations are skipped here instead.
+    grown = {}
+    for stat in tracemalloc.take_snapshot().compare_to(before, 'traceback'):
+        if stat.size_diff <= 0 or stat.traceback[-1].filename in _ignored:
+            continue
+        key = (frame_text(stat.traceback[-1].filename, stat.traceback[-1].lineno), caller_in_app(stat.traceback))
+        entry = grown.setdefault(key, [0, 0])
+        entry[0] += stat.size_diff
+        entry[1] += stat.count_diff
+    ranked = sorted(grown.items(), key=lambda item: item[1][0], reverse=True)[:n]
+    return [(key, size, count) for key, (size, count) in ranked]
+
+
+def max_rss():
+    # the most resident memory this process has had, in bytes (ru_maxrss is KB on Linux)
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def route_rule():
+    return request.url_rule.rule if request.url_rule is not None else 'unmatched'
+
+
+def _on_event_loop():
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return False
+    return True
+
+
+@app.before_request
+def start_measuring():
+    if not app.config['MEMORY_PROFILE']:
+        return
+    if not _measuring.acquire(blocking=not _on_event_loop()):
+        return
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(app.config['MEMORY_PROFILE_FRAMES'])
+    stats = routes.get(route_rule())
+    before = None
+    if stats is None or stats.snapshot_due(app.config['MEMORY_PROFILE_SNAPSHOT_EVERY']):
+        before = tracemalloc.take_snapshot()
+    tracemalloc.reset_peak()
+    g.memory_start = (tracemalloc.get_traced_memory()[0], before)
+
+
+@app.after_request
+def stop_measuring(response):
+    start = g.pop('memory_start', None)
+    if start is None:
+        return response
+    try:
+        current, peak = tracemalloc.get_traced_memory()
+        started_with, before = start
+        sites = top_sites(before, app.config['MEMORY_PROFILE_TOP']) if before is not None else None
+        route = route_rule()
+        routes.setdefault(route, RouteMemory()).add(
+            peak - started_with, current - started_with, sites, app.config['MEMORY_PROFILE_KEEP'])
+        observe('foodie_http_request_peak_memory_bytes', peak - started_with, (('route', route),))
+    finally:
+        _measuring.release()
+    return response
+
+
+@app.teardown_request
+def abandon_measuring(exc):
+    # an unhandled error skips after_request
+    if g.pop('memory_start', None) is not None:
+        _measuring.release()
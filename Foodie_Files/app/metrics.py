@@ -0,0 +1,338 @@
+import bisect
+import glob
+import json
+import os
+import threading
+import time
+from flask import g, request, abort
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import Pool
+from app import app, db
+
+###### METRICS ######
+# Counters and histograms served on /metrics in the Prometheus text format.
+#   - Each thread records into its own dict, so recording takes no lock: a Python level
+#     read-modify-write on a dict only this thread writes. A scrape sums the threads' dicts.
+#   - Requests are labelled with the route rule (/edit_recipe/<int:recipe_id>), never the
+#     raw URL, so the number of series stays bounded.
+#   - With several worker processes (`flask serve`) set METRICS_DIR: every process writes a
+#     snapshot there every METRICS_FLUSH_INTERVAL seconds and on a scrape, and whichever
+#     worker gets the scrape adds them all up. Counters of exited workers are kept (folded
+#     into one file), gauges only count live ones. `flask serve` empties the folder on start.
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+STATEMENT_BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+UPLOAD_BUCKETS = (64 * 1024, 256 * 1024, 1024 * 1024, 4 * 1024 * 1024, 16 * 1024 * 1024)
+MEMORY_BUCKETS = (256 * 1024, 1024 * 1024, 4 * 1024 * 1024, 16 * 1024 * 1024, 64 * 1024 * 1024, 256 * 1024 * 1024)
+
+# name: (type, help, buckets for histograms)
+METRICS = {
+    'foodie_http_requests_total': ('counter', 'Requests handled, by route and status.', None),
+    'foodie_http_request_duration_seconds': ('histogram', 'Time to a response, by route.', DURATION_BUCKETS),
+    'foodie_http_requests_in_progress': ('gauge', 'Requests being handled right now.', None),
+    'foodie_http_request_peak_memory_bytes': ('histogram', 'Peak memory allocated by a request, by route, '
+                                              'while MEMORY_PROFILE is on.', MEMORY_BUCKETS),
+    'foodie_toggles_total': ('counter', 'Likes and saves added and removed.', None),
+    'foodie_upload_bytes': ('histogram', 'Size of uploaded recipe images.', UPLOAD_BUCKETS),
+    'foodie_cache_requests_total': ('counter', 'Cache lookups, by the tier that answered or miss.', None),
+    'foodie_cache_entries': ('gauge', 'Entries in the in-process cache.', None),
+    'foodie_db_statement_seconds': ('histogram', 'SQL statement time. On SQLite writes include waiting '
+                                    'for the write lock.', STATEMENT_BUCKETS),
+    'foodie_db_lock_timeouts_total': ('counter', 'Statements that gave up waiting for the SQLite lock.', None),
+    'foodie_db_connections_opened_total': ('counter', 'Database connections opened by the pools.', None),
+    'foodie_db_pool_connections': ('gauge', 'Pooled database connections, by engine and state.', None),
+}
+
+WRITE_PREFIXES = ('INSERT', 'UPDATE', 'DELETE', 'REPLACE')
+
+_local = threading.local()
+_threads = []  # every thread's values, list.append is atomic
+_flusher = None
+
+
+def _values():
+    values = getattr(_local, 'values', None)
+    if values is None:
+        values = _local.values = {}
+        _threads.append(values)
+    return values
+
+
+def inc(name, labels=(), amount=1):
+    # labels is a tuple of (name, value) pairs, in the same order every time
+    values = _values()
+    key = (name, labels)
+    values[key] = values.get(key, 0) + amount
+
+
+def observe(name, value, labels=()):
+    values = _values()
+    key = (name, labels)
+    counts = values.get(key)
+    buckets = METRICS[name][2]
+    if counts is None:
+        # a count per bucket (not cumulative), one for above the last, the sum and the count
+        counts = values[key] = [0] * (len(buckets) + 3)
+    counts[bisect.bisect_left(buckets, value)] += 1
+    counts[-2] += value
+    counts[-1] += 1
+
+
+def _forget_parent():
+    # a forked worker starts from zero, the master's threads and flusher stay behind
+    global _flusher
+    _threads.clear()
+    _local.__dict__.clear()
+    _flusher = None
+
+
+os.register_at_fork(after_in_child=_forget_parent)
+
+
+###### COLLECTING ######
+
+def _add(totals, key, value):
+    if isinstance(value, list):
+        current = totals.get(key)
+        totals[key] = value[:] if current is None else [a + b for a, b in zip(current, value)]
+    else:
+        totals[key] = totals.get(key, 0) + value
+
+
+def pool_gauges():
+    # QueuePool counts, other pools (SQLite in memory, NullPool) are skipped
+    gauges = {}
+    with app.app_context():
+        for bind, engine in db.engines.items():
+            pool = engine.pool
+            if not hasattr(pool, 'checkedout'):
+                continue
+            name = bind or 'primary'
+            gauges[('foodie_db_pool_connections', (('engine', name), ('state', 'checked_out')))] = pool.checkedout()
+            gauges[('foodie_db_pool_connections', (('engine', name), ('state', 'idle')))] = pool.checkedin()
+    return gauges
+
+
+def local_values():
+    # This process: the threads' values added up, plus the gauges read now
+    from .cache import recipe_cache
+    totals = {}
+    for values in list(_threads):
+        # dict.copy holds the GIL throughout, so a recording thread cant change it mid copy
+        for key, value in values.copy().items():
+            _add(totals, key, value)
+    totals.update(pool_gauges())
+    totals[('foodie_cache_entries', (('cache', recipe_cache.name),))] = len(recipe_cache.tiers[0])
+    return totals
+
+
+def _encode(values):
+    return [[name, [list(pair) for pair in labels], value] for (name, labels), value in values.items()]
+
+
+def _decode(rows):
+    return {(name, tuple(tuple(pair) for pair in labels)): value for name, labels, value in rows}
+
+
+def _write_json(path, data):
+    tmp = f'{path}.{os.getpid()}.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp, path)
+
+
+def _read_json(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def write_snapshot(directory):
+    _write_json(os.path.join(directory, f'{os.getpid()}.json'), {'pid': os.getpid(), 'values': _encode(local_values())})
+
+
+def all_values(directory):
+    # Every process's snapshot added up. The snapshots of exited workers are folded into
+    # exited.json (counters and histograms only) under a file lock so two scrapes dont both
+    # fold the same one.
+    import fcntl
+    write_snapshot(directory)
+    totals = {}
+    with open(os.path.join(directory, 'lock'), 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        exited_path = os.path.join(directory, 'exited.json')
+        exited = _decode(_read_json(exited_path) or [])
+        folded = []
+        for path in glob.glob(os.path.join(directory, '[0-9]*.json')):
+            snapshot = _read_json(path)
+            if snapshot is None:
+                continue
+            values = _decode(snapshot['values'])
+            if _alive(snapshot['pid']):
+                for key, value in values.items():
+                    _add(totals, key, value)
+                continue
+            for key, value in values.items():
+                if METRICS[key[0]][0] != 'gauge':
+                    _add(exited, key, value)
+            folded.append(path)
+        if folded:
+            _write_json(exited_path, _encode(exited))
+            for path in folded:
+                os.remove(path)
+    for key, value in exited.items():
+        _add(totals, key, value)
+    return totals
+
+
+def clear_directory(directory):
+    for path in glob.glob(os.path.join(directory, '*.json')):
+        os.remove(path)
+
+
+def _flush_forever(directory, interval):
+    while True:
+        time.sleep(interval)
+        try:
+            write_snapshot(directory)
+        except OSError:
+            app.logger.exception('Writing metrics to %s failed', directory)
+
+
+def start_flusher():
+    # one per process, started by its first request
+    global _flusher
+    directory = app.config['METRICS_DIR']
+    if _flusher is not None or not directory:
+        return
+    os.makedirs(directory, exist_ok=True)
+    _flusher = threading.Thread(target=_flush_forever, args=(directory, app.config['METRICS_FLUSH_INTERVAL']),
+                                daemon=True, name='metrics-flusher')
+    _flusher.start()
+
+
+###### EXPOSITION ######
+
+def _labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def exposition(values):
+    lines = []
+    for name, (kind, help_text, buckets) in METRICS.items():
+        samples = sorted((labels, value) for (metric, labels), value in values.items() if metric == name)
+        if not samples:
+            continue
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {kind}')
+        for labels, value in samples:
+            if kind != 'histogram':
+                lines.append(f'{name}{_labels(labels)} {_number(value)}')
+                continue
+            cumulative = 0
+            for bound, count in zip(list(buckets) + ['+Inf'], value):
+                cumulative += count
+                le = bound if bound == '+Inf' else _number(bound)
+                lines.append(f'{name}_bucket{_labels(labels, [("le", le)])} {cumulative}')
+            lines.append(f'{name}_sum{_labels(labels)} {_number(value[-2])}')
+            lines.append(f'{name}_count{_labels(labels)} {value[-1]}')
+    return '\n'.join(lines) + '\n'
+
+
+@app.route('/metrics')
+def metrics():
+    if not app.config['METRICS_ENABLED']:
+        abort(404)
+    directory = app.config['METRICS_DIR']
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    values = all_values(directory) if directory else local_values()
+    return app.response_class(exposition(values), mimetype='text/plain; version=0.0.4')
+
+
+###### RECORDING ######
+
+@app.before_request
+def start_request_metrics():
+    if not app.config['METRICS_ENABLED']:
+        return
+    start_flusher()
+    g.metrics_started = time.perf_counter()
+    inc('foodie_http_requests_in_progress')
+
+
+def record_request(status):
+    started = g.pop('metrics_started', None)
+    if started is None:
+        return
+    route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    inc('foodie_http_requests_in_progress', amount=-1)
+    inc('foodie_http_requests_total', (('method', request.method), ('route', route), ('status', str(status))))
+    observe('foodie_http_request_duration_seconds', time.perf_counter() - started,
+            (('method', request.method), ('route', route)))
+
+
+@app.after_request
+def end_request_metrics(response):
+    record_request(response.status_code)
+    return response
+
+
+@app.teardown_request
+def failed_request_metrics(exc):
+    # an unhandled error skips after_request
+    record_request(500)
+
+
+def count_toggle(model, added):
+    inc('foodie_toggles_total', (('table', model.__tablename__), ('action', 'add' if added else 'remove')))
+
+
+def count_cache(cache, result):
+    inc('foodie_cache_requests_total', (('cache', cache), ('result', result)))
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _start_statement(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('metrics_started', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _end_statement(conn, cursor, statement, parameters, context, executemany):
+    seconds = time.perf_counter() - conn.info['metrics_started'].pop()
+    kind = 'write' if statement.lstrip()[:7].upper().startswith(WRITE_PREFIXES) else 'read'
+    observe('foodie_db_statement_seconds', seconds, (('kind', kind),))
+
+
+@event.listens_for(Engine, 'handle_error')
+def _failed_statement(context):
+    if context.connection is not None and context.connection.info.get('metrics_started'):
+        context.connection.info['metrics_started'].pop()
+    if 'database is locked' in str(context.original_exception):
+        inc('foodie_db_lock_timeouts_total')
+
+
+@event.listens_for(Pool, 'connect')
+def _opened_connection(dbapi_connection, connection_record):
+    inc('foodie_db_connections_opened_total')
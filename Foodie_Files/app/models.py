@@ -17,6 +17,7 @@ class User(db.Model,UserMixin):
     recipes = db.relationship('Recipe', back_populates='author', cascade="all, delete-orphan")
     likes = db.relationship('Like', back_populates='user', cascade="all, delete-orphan")
     saved_recipes = db.relationship('SavedRecipe', back_populates='user', cascade="all, delete-orphan")
+    comments = db.relationship('Comment', back_populates='user', cascade="all, delete-orphan")
 
     # our users are unique but the primary key in our database. Eveything is based off them.
     # Classes cannot exist without them
@@ -27,7 +28,7 @@ class Recipe(db.Model):
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
 
     # Foreign Key and Relationship to User
-    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False, index=True)
     author = db.relationship('User', back_populates='recipes')
     
     title = db.Column(db.String(100), nullable=False)
@@ -35,15 +36,48 @@ class Recipe(db.Model):
     ingredients = db.Column(db.Text, nullable=False)
     steps = db.Column(db.Text, nullable=False)
     image_url = db.Column(db.String(255))  # Optional, we can set a default picture if anythign 
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    image_renditions = db.Column(db.JSON)  # resized WebP/JPEG copies made by app/images.py
+    image_hash = db.Column(db.String(64), index=True)  # the StoredImage this recipe holds a reference on
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
     
+    # Denormalized counters, kept in step with the likes/saved_recipes/comments rows in the
+    # same transaction that adds or removes them (flask reconcile-counts repairs any drift)
+    like_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    save_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    comment_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+
+    # (count, id) indexes so the Most Liked / Most Saved pages are index range scans
+    __table_args__ = (
+        db.Index('ix_recipes_like_count_id', 'like_count', 'id'),
+        db.Index('ix_recipes_save_count_id', 'save_count', 'id'),
+    )
     
     # Our relationships with other classes
     likes = db.relationship('Like', back_populates='recipe', cascade="all, delete-orphan")
     saved_by = db.relationship('SavedRecipe', back_populates='recipe', cascade="all, delete-orphan")
+    # foreign keys are enforced (see SQLITE_PRAGMAS), so comments go with their recipe
+    comments = db.relationship('Comment', back_populates='recipe', cascade="all, delete-orphan")
     # users can create multiple recipes showing off a one to many relationship
+
+    def bump(self, counter, delta):
+        # The database does the arithmetic so two concurrent toggles dont lose an update
+        setattr(self, counter, getattr(Recipe, counter) + delta)
     
 
+class StoredImage(db.Model):
+    __tablename__ = 'stored_images'
+    # SHA-256 of the uploaded bytes, the files live under a path made from it (see app/storage.py)
+    hash = db.Column(db.String(64), primary_key=True)
+    renditions = db.Column(db.JSON, nullable=False)
+    # how many recipes use this image, the files are deleted when it drops to 0
+    ref_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    byte_size = db.Column(db.Integer)  # size of the original upload
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def __str__(self):
+        return f"{self.hash[:12]} ({self.ref_count} refs)"
+
+
 class Like(db.Model):
     __tablename__ = 'likes'
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
@@ -56,6 +90,11 @@ class Like(db.Model):
     # Our relationships with other clas
     user = db.relationship('User', back_populates='likes')
     recipe = db.relationship('Recipe', back_populates='likes')
+
+    # a user can like a recipe once, the toggle in like_recipe relies on this
+    __table_args__ = (
+        db.Index('ix_likes_user_id_recipe_id', 'user_id', 'recipe_id', unique=True),
+    )
     # a post can have many likes 
 
 class SavedRecipe(db.Model):
@@ -71,6 +110,11 @@ class SavedRecipe(db.Model):
     user = db.relationship('User', back_populates='saved_recipes')
     recipe = db.relationship('Recipe', back_populates='saved_by')
 
+    # same for saves, see save_recipe
+    __table_args__ = (
+        db.Index('ix_saved_recipes_user_id_recipe_id', 'user_id', 'recipe_id', unique=True),
+    )
+
     # a single user can have many saved recipes
 
 class Comment(db.Model):
@@ -84,6 +128,11 @@ class Comment(db.Model):
     recipe_id = db.Column(db.Integer, db.ForeignKey('recipes.id'), nullable=False)
     
     # Relationships
-    user = db.relationship('User')
-    recipe = db.relationship('Recipe')
+    user = db.relationship('User', back_populates='comments')
+    recipe = db.relationship('Recipe', back_populates='comments')
+
+    # comments are always read per recipe in posting order
+    __table_args__ = (
+        db.Index('ix_comments_recipe_id_created_at', 'recipe_id', 'created_at'),
+    )
     # a single user can comment on many posts same way a post can have many comments
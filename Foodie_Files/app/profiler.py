@@ -0,0 +1,138 @@
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from flask import request
+from app import app
+
+###### SAMPLING PROFILER ######
+# Profiles the live process without restarting it under a profiler (Diagnostics > Profiler
+# in /admin). For N seconds the admin request's thread looks at every other thread's Python
+# stack PROFILE_INTERVAL seconds apart, which costs the threads being profiled nothing but
+# the GIL for a moment. Only the worker process that got the admin request is profiled.
+# By default only threads handling a request are sampled, with the endpoint as the root of
+# each stack, so idle worker threads and the background ones (indexer, metrics flusher)
+# dont drown out the views.
+# A thread is seen where it last let go of the GIL, so time waiting on the database or the
+# network counts in full, Python code at the interpreter's switch points.
+# The result is a top functions table and the stacks in the collapsed format ("a;b;c 12"
+# per line) that flamegraph.pl, speedscope and inferno read.
+# It needs threads: gevent workers run every request as a greenlet of one thread and uvicorn
+# workers run the async views on the event loop's thread, so sys._current_frames() shows
+# one stack for all of them. It refuses to start there, profile a `flask serve` with the
+# default gthread workers (or `flask run`) instead.
+
+_requests = {}  # thread id: endpoint, for the threads inside a request right now
+_labels = {}  # code object: frame label
+_running = threading.Lock()
+
+
+@app.before_request
+def _enter_request():
+    _requests[threading.get_ident()] = request.endpoint or 'unmatched'
+
+
+@app.teardown_request
+def _leave_request(exc):
+    _requests.pop(threading.get_ident(), None)
+
+
+def unsupported_worker():
+    # why the requests of this worker cant be told apart by thread, None when they can
+    monkey = sys.modules.get('gevent.monkey')
+    if monkey is not None and monkey.is_module_patched('threading'):
+        return 'gevent workers run every request as a greenlet of one thread'
+    if 'app.asgi' in sys.modules:
+        return "ASGI workers run the async views on the event loop's thread"
+    return None
+
+
+def short_path(filename):
+    # relative to the longest sys.path entry it is under
+    best = ''
+    for entry in sys.path:
+        if entry and filename.startswith(entry) and len(entry) > len(best):
+            best = entry
+    return os.path.relpath(filename, best) if best else filename
+
+
+def frame_label(code):
+    label = _labels.get(code)
+    if label is None:
+        label = _labels[code] = f'{code.co_name} ({short_path(code.co_filename)}:{code.co_firstlineno})'
+    return label
+
+
+class Profile:
+    def __init__(self, seconds, interval, all_threads):
+        self.seconds = seconds
+        self.interval = interval
+        self.all_threads = all_threads
+        self.started = None
+        self.samples = 0  # times the threads were looked at
+        self.stacks = Counter()  # collapsed stack: samples
+
+    def take_sample(self, skip):
+        # one look at every thread, stacks are root first
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id in skip:
+                continue
+            endpoint = _requests.get(thread_id)
+            if endpoint is None and not self.all_threads:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(frame_label(frame.f_code))
+                frame = frame.f_back
+            stack.reverse()
+            if endpoint is not None:
+                stack.insert(0, endpoint)
+            self.stacks[';'.join(stack)] += 1
+        self.samples += 1
+
+    def run(self):
+        skip = {threading.get_ident()}
+        self.started = time.time()
+        deadline = time.monotonic() + self.seconds
+        while time.monotonic() < deadline:
+            self.take_sample(skip)
+            time.sleep(self.interval)
+
+    def collapsed(self):
+        return ''.join(f'{stack} {count}\n' for stack, count in self.stacks.most_common())
+
+    def top_functions(self, limit=50):
+        # [(function, self samples, total samples)], by self time then total. A function
+        # shows up in total once per stack however deep it recurses. The endpoint roots
+        # arent functions and are left out.
+        own, total = Counter(), Counter()
+        for stack, count in self.stacks.items():
+            frames = stack.split(';')
+            if frames[0] in app.view_functions or frames[0] == 'unmatched':
+                frames = frames[1:]
+            if not frames:
+                continue
+            own[frames[-1]] += count
+            for label in set(frames):
+                total[label] += count
+        rows = [(label, own[label], total[label]) for label in total]
+        rows.sort(key=lambda row: (row[1], row[2]), reverse=True)
+        return rows[:limit]
+
+    @property
+    def stack_samples(self):
+        return sum(self.stacks.values())
+
+
+def profile(seconds, all_threads=False):
+    # Samples for seconds from the calling thread, which is left out, and returns the
+    # Profile, or None when another profile is already running
+    if not _running.acquire(blocking=False):
+        return None
+    try:
+        result = Profile(seconds, app.config['PROFILE_INTERVAL'], all_threads)
+        result.run()
+        return result
+    finally:
+        _running.release()
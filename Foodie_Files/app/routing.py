@@ -0,0 +1,19 @@
+from flask import g, has_app_context
+from flask_sqlalchemy.session import Session
+from sqlalchemy.sql.dml import UpdateBase
+
+###### READ/WRITE ROUTING SESSION ######
+# The session class of db.session (set in app/__init__.py). Inside a view marked with
+# read_replica (app/database.py) queries go to the 'replica' bind, everything else, and any
+# flush or INSERT/UPDATE/DELETE even inside such a view, goes to the primary database.
+# This module only picks engines, app/database.py decides when the replica may be used.
+
+
+class RoutingSession(Session):
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and not self._flushing and not isinstance(clause, UpdateBase) \
+                and has_app_context() and g.get('use_replica'):
+            replica = self._db.engines.get('replica')
+            if replica is not None:
+                return replica
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
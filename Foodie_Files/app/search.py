@@ -0,0 +1,138 @@
+import re
+from sqlalchemy import event, DDL
+from sqlalchemy.dialects.postgresql import REGCONFIG, DOUBLE_PRECISION
+from app import app, db
+from .models import Recipe
+from .search_index import search_index
+
+###### FULL TEXT SEARCH ######
+# On SQLite recipes are searched through an FTS5 index (recipes_fts) over the title,
+# description, ingredients and steps. It is an external content table so the text is
+# not stored twice, triggers on recipes keep it in sync and results are ranked with bm25.
+# On PostgreSQL a generated tsvector column (search_vector, weighted like the bm25 columns)
+# with a GIN index does the same and results are ranked with ts_rank.
+# Other databases fall back to the old ILIKE filter.
+# With SEARCH_BACKEND = 'whoosh' the Whoosh index in search_index.py is used instead.
+
+# bm25 weights for title, description, ingredients, steps
+FTS_WEIGHTS = (10.0, 5.0, 2.0, 1.0)
+
+FTS_DDL = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS recipes_fts USING fts5("
+    "title, description, ingredients, steps, "
+    "content='recipes', content_rowid='id', tokenize='porter unicode61', prefix='2 3')",
+
+    "CREATE TRIGGER IF NOT EXISTS recipes_fts_ai AFTER INSERT ON recipes BEGIN "
+    "INSERT INTO recipes_fts(rowid, title, description, ingredients, steps) "
+    "VALUES (new.id, new.title, new.description, new.ingredients, new.steps); END",
+
+    "CREATE TRIGGER IF NOT EXISTS recipes_fts_ad AFTER DELETE ON recipes BEGIN "
+    "INSERT INTO recipes_fts(recipes_fts, rowid, title, description, ingredients, steps) "
+    "VALUES ('delete', old.id, old.title, old.description, old.ingredients, old.steps); END",
+
+    # only the searchable columns, so bumping the like/save counters doesnt reindex the text
+    "CREATE TRIGGER IF NOT EXISTS recipes_fts_au AFTER UPDATE OF title, description, ingredients, steps "
+    "ON recipes BEGIN "
+    "INSERT INTO recipes_fts(recipes_fts, rowid, title, description, ingredients, steps) "
+    "VALUES ('delete', old.id, old.title, old.description, old.ingredients, old.steps); "
+    "INSERT INTO recipes_fts(rowid, title, description, ingredients, steps) "
+    "VALUES (new.id, new.title, new.description, new.ingredients, new.steps); END",
+]
+
+# the column isnt on the Recipe model, the database fills it in and only searches read it
+TS_CONFIG = 'english'
+TS_DDL = [
+    "ALTER TABLE recipes ADD COLUMN IF NOT EXISTS search_vector tsvector GENERATED ALWAYS AS ("
+    f"setweight(to_tsvector('{TS_CONFIG}', coalesce(title, '')), 'A') || "
+    f"setweight(to_tsvector('{TS_CONFIG}', coalesce(description, '')), 'B') || "
+    f"setweight(to_tsvector('{TS_CONFIG}', coalesce(ingredients, '')), 'C') || "
+    f"setweight(to_tsvector('{TS_CONFIG}', coalesce(steps, '')), 'D')) STORED",
+
+    "CREATE INDEX IF NOT EXISTS ix_recipes_search_vector ON recipes USING gin (search_vector)",
+]
+
+# db.create_all() (db_create.py) builds the index too, migrations create it themselves
+for statement in FTS_DDL:
+    event.listen(Recipe.__table__, 'after_create', DDL(statement).execute_if(dialect='sqlite'))
+for statement in TS_DDL:
+    event.listen(Recipe.__table__, 'after_create', DDL(statement).execute_if(dialect='postgresql'))
+
+WORD_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def fts_match(search_query):
+    # Every word has to match, the last word as a prefix so results show up while typing.
+    # Words are quoted so FTS5 operators in the input are searched as plain text.
+    words = WORD_RE.findall(search_query)
+    if not words:
+        return None
+    terms = [f'"{word}"' for word in words]
+    terms[-1] += '*'
+    return ' '.join(terms)
+
+
+def ts_query(search_query):
+    # The same query in to_tsquery syntax, 'pasta' & 'tom':*
+    words = WORD_RE.findall(search_query)
+    if not words:
+        return None
+    terms = [f"'{word}'" for word in words]
+    terms[-1] += ':*'
+    return ' & '.join(terms)
+
+
+def search_recipes(query, search_query):
+    # Returns the filtered Recipe query, the rank column to order by relevance and a dict of
+    # recipe id -> highlighted snippet. The rank is None when the ILIKE fallback is used.
+    if app.config['SEARCH_BACKEND'] == 'whoosh':
+        return whoosh_search(query, search_query)
+
+    dialect = db.engine.dialect.name
+    match = None
+    if dialect == 'sqlite':
+        match = fts_match(search_query)
+    elif dialect == 'postgresql':
+        match = ts_query(search_query)
+    if match is None:
+        return query.filter(
+            (Recipe.title.ilike(f"%{search_query}%")) |
+            (Recipe.description.ilike(f"%{search_query}%"))
+        ), None, {}
+
+    if dialect == 'postgresql':
+        return tsvector_search(query, match)
+    return fts_search(query, match)
+
+
+def fts_search(query, match):
+    fts = db.table('recipes_fts', db.column('rowid'))
+    fts_name = db.literal_column('recipes_fts')
+    matches = db.select(
+        fts.c.rowid.label('recipe_id'),
+        db.func.bm25(fts_name, *FTS_WEIGHTS).label('rank')
+    ).select_from(fts).where(fts_name.op('MATCH')(match)).subquery()
+
+    query = query.join(matches, matches.c.recipe_id == Recipe.id)
+    return query, matches.c.rank, {}
+
+
+def tsvector_search(query, match):
+    # ts_rank is higher for better matches, negated so the best sort first like bm25.
+    # It is a real, as a double it survives the trip through the page cursor exactly.
+    search_vector = db.literal_column('recipes.search_vector')
+    tsquery = db.func.to_tsquery(db.literal(TS_CONFIG).cast(REGCONFIG), match)
+    query = query.filter(search_vector.op('@@')(tsquery))
+    rank = db.cast(-db.func.ts_rank(search_vector, tsquery), DOUBLE_PRECISION)
+    return query, rank.label('rank'), {}
+
+
+def whoosh_search(query, search_query):
+    # Whoosh ranks the hits, the position in its result list becomes the rank column
+    hits = search_index.search(search_query)
+    if not hits:
+        return query.filter(db.false()), None, {}
+
+    positions = {recipe_id: position for position, (recipe_id, _) in enumerate(hits)}
+    highlights = {recipe_id: snippet for recipe_id, snippet in hits if snippet}
+    query = query.filter(Recipe.id.in_(list(positions)))
+    return query, db.case(positions, value=Recipe.id), highlights
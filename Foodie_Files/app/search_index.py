@@ -0,0 +1,217 @@
+import os
+import queue
+import threading
+import time
+from sqlalchemy import event
+from whoosh import index as whoosh_index
+from whoosh.analysis import StemmingAnalyzer
+from whoosh.fields import Schema, ID, TEXT
+from whoosh.highlight import HtmlFormatter
+from whoosh.qparser import MultifieldParser, AndGroup
+from whoosh.index import LockError
+from app import app, db
+from .models import Recipe, Comment
+
+###### WHOOSH SEARCH INDEX ######
+# An on disk Whoosh index with one document per recipe (its text plus all its comments),
+# used by /filter_recipes?q= when SEARCH_BACKEND = 'whoosh'.
+# Writes never happen on the request thread: committed changes queue the recipe id and a
+# background thread reindexes the queued recipes from the database in batches.
+# flask_whooshalchemy is in the virtualenv but imports flask.ext, which Flask 3 removed,
+# so Whoosh is used directly.
+
+SEARCH_FIELDS = ['title', 'description', 'ingredients', 'steps', 'comments']
+RECIPE_TEXT_FIELDS = ('title', 'description', 'ingredients', 'steps')
+
+schema = Schema(
+    id=ID(stored=True, unique=True),
+    title=TEXT(stored=True, analyzer=StemmingAnalyzer(), field_boost=3.0),
+    description=TEXT(stored=True, analyzer=StemmingAnalyzer(), field_boost=1.5),
+    ingredients=TEXT(analyzer=StemmingAnalyzer()),
+    steps=TEXT(analyzer=StemmingAnalyzer()),
+    comments=TEXT(analyzer=StemmingAnalyzer(), field_boost=0.5),
+)
+
+
+def open_index(index_dir, clear=False):
+    if not os.path.exists(index_dir):
+        os.makedirs(index_dir)
+    if clear or not whoosh_index.exists_in(index_dir):
+        return whoosh_index.create_in(index_dir, schema)
+    return whoosh_index.open_dir(index_dir)
+
+
+def recipe_documents(recipes):
+    # Whoosh documents for the given recipes, comments are loaded in one query
+    comments = {}
+    recipe_ids = [r.id for r in recipes]
+    if recipe_ids:
+        rows = db.session.query(Comment.recipe_id, Comment.content) \
+                         .filter(Comment.recipe_id.in_(recipe_ids)) \
+                         .order_by(Comment.recipe_id, Comment.created_at)
+        for recipe_id, content in rows:
+            comments.setdefault(recipe_id, []).append(content)
+
+    for r in recipes:
+        yield {
+            'id': str(r.id),
+            'title': r.title,
+            'description': r.description,
+            'ingredients': r.ingredients,
+            'steps': r.steps,
+            'comments': '\n'.join(comments.get(r.id, [])),
+        }
+
+
+class SearchIndex:
+    # Settings come from the WHOOSH_* values in config.py
+    def __init__(self, app):
+        self.app = app
+        self._index = None
+        self._index_lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._worker = None
+        self._worker_pid = None
+
+    @property
+    def index(self):
+        with self._index_lock:
+            if self._index is None:
+                self._index = open_index(self.app.config['WHOOSH_INDEX_DIR'])
+            return self._index
+
+    ### Searching ###
+
+    def search(self, search_query, limit=None):
+        # Returns [(recipe id, highlighted snippet or None)] best match first
+        limit = limit or self.app.config['WHOOSH_SEARCH_LIMIT']
+        parser = MultifieldParser(SEARCH_FIELDS, schema=schema, group=AndGroup)
+        parsed = parser.parse(search_query)
+
+        with self.index.searcher() as searcher:
+            hits = searcher.search(parsed, limit=limit)
+            hits.formatter = HtmlFormatter(tagname='mark', between='&hellip;')
+            return [
+                (int(hit['id']), hit.highlights('description') or hit.highlights('title') or None)
+                for hit in hits
+            ]
+
+    ### Incremental updates ###
+
+    def enqueue(self, recipe_ids):
+        # The thread is started on first use (and again after a fork) rather than at import
+        if self._worker is None or not self._worker.is_alive() or self._worker_pid != os.getpid():
+            self._start_worker()
+        for recipe_id in recipe_ids:
+            self._queue.put(recipe_id)
+
+    def _start_worker(self):
+        self._queue = queue.Queue()
+        self._worker_pid = os.getpid()
+        self._worker = threading.Thread(target=self._run, name='whoosh-indexer', daemon=True)
+        self._worker.start()
+
+    def _run(self):
+        batch_size = self.app.config['WHOOSH_BATCH_SIZE']
+        interval = self.app.config['WHOOSH_COMMIT_INTERVAL']
+        while True:
+            # block for the first id then keep collecting until the batch is full or the interval is up
+            pending = {self._queue.get()}
+            deadline = time.monotonic() + interval
+            while len(pending) < batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    pending.add(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            try:
+                with self.app.app_context():
+                    self.reindex(pending)
+            except LockError:
+                # another process is writing, try these again with the next batch
+                for recipe_id in pending:
+                    self._queue.put(recipe_id)
+            except Exception:
+                self.app.logger.exception('Whoosh indexing failed for recipes %s', sorted(pending))
+
+    def reindex(self, recipe_ids):
+        # Update or delete the documents for these recipes from the current database rows
+        recipes = Recipe.query.filter(Recipe.id.in_(list(recipe_ids))).all()
+        found = {r.id for r in recipes}
+
+        writer = self.index.writer(timeout=5.0)
+        try:
+            for document in recipe_documents(recipes):
+                writer.update_document(**document)
+            for recipe_id in set(recipe_ids) - found:
+                writer.delete_by_term('id', str(recipe_id))
+        except Exception:
+            writer.cancel()
+            raise
+        writer.commit()
+
+    ### Bulk rebuild ###
+
+    def rebuild(self, chunk_size=1000, progress=None):
+        # Build a fresh index from the database, reading the recipes chunk by chunk with keyset paging
+        with self._index_lock:
+            self._index = open_index(self.app.config['WHOOSH_INDEX_DIR'], clear=True)
+        writer = self.index.writer(limitmb=256)
+        total, last_id = 0, 0
+        try:
+            while True:
+                recipes = Recipe.query.filter(Recipe.id > last_id).order_by(Recipe.id).limit(chunk_size).all()
+                if not recipes:
+                    break
+                for document in recipe_documents(recipes):
+                    writer.add_document(**document)
+                total += len(recipes)
+                last_id = recipes[-1].id
+                # drop the chunk from the identity map before loading the next one
+                db.session.expunge_all()
+                if progress:
+                    progress(total)
+        except Exception:
+            writer.cancel()
+            raise
+        writer.commit(optimize=True)
+        return total
+
+
+search_index = SearchIndex(app)
+
+
+# Collect the recipes touched by a flush and queue them once the transaction commits.
+# Recipe updates only count when searchable text changed, so counter bumps are ignored.
+def _collect_changes(session, flush_context):
+    changed = session.info.setdefault('search_index_changes', set())
+    for obj in list(session.new) + list(session.deleted):
+        if isinstance(obj, Recipe):
+            changed.add(obj.id)
+        elif isinstance(obj, Comment):
+            changed.add(obj.recipe_id)
+    for obj in session.dirty:
+        if isinstance(obj, Recipe):
+            state = db.inspect(obj)
+            if any(state.attrs[name].history.has_changes() for name in RECIPE_TEXT_FIELDS):
+                changed.add(obj.id)
+        elif isinstance(obj, Comment):
+            changed.add(obj.recipe_id)
+
+
+def _queue_changes(session):
+    changed = session.info.pop('search_index_changes', None)
+    if changed and search_index.app.config['SEARCH_BACKEND'] == 'whoosh':
+        search_index.enqueue(changed)
+
+
+def _drop_changes(session):
+    session.info.pop('search_index_changes', None)
+
+
+event.listen(db.session, 'after_flush', _collect_changes)
+event.listen(db.session, 'after_commit', _queue_changes)
+event.listen(db.session, 'after_rollback', _drop_changes)
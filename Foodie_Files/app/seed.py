@@ -0,0 +1,200 @@
+import random
+from datetime import datetime, timedelta
+from itertools import accumulate
+from werkzeug.security import generate_password_hash
+from app import db
+from .models import User, Recipe, Like, SavedRecipe, Comment
+from .bulk import bulk_insert, batches
+
+###### SYNTHETIC DATASETS ######
+# `flask seed` fills the database with made up data shaped like production, for benchmarks:
+#   - recipe text is about as long as real recipes (titles of a few words, a paragraph of
+#     description, a dozen ingredient lines, several steps)
+#   - popularity and activity follow a power law: a few recipes get most of the likes, saves
+#     and comments, a few users do most of the liking and posting
+#   - comments come in threads, each one later than the last, after the recipe was posted
+#   - the same seed and sizes always give the same data
+# Users and recipes get explicit ids after the existing ones so likes, saves and comments can
+# point at them without reading anything back. Every table goes in through app/bulk.py,
+# batch_size rows per transaction, and the recipe counters are set once at the end.
+
+SEED_PASSWORD = 'seed-password'
+
+# Zipf exponents, 0 spreads evenly and higher concentrates on the top ranks
+POPULARITY_EXPONENT = 0.9
+ACTIVITY_EXPONENT = 0.9
+
+# recipes are posted over this long before now, later ids being newer
+TIME_SPAN = timedelta(days=2 * 365)
+
+WORDS = (
+    'tomato basil garlic onion shallot leek pasta noodle rice quinoa couscous chicken beef pork '
+    'lamb salmon tuna shrimp tofu tempeh egg lemon lime orange apple pear berry mango ginger '
+    'chili cumin coriander paprika turmeric cinnamon nutmeg oregano thyme rosemary parsley mint '
+    'dill butter cream cheese yogurt milk flour sugar honey maple vinegar mustard soy miso '
+    'coconut curry potato carrot celery mushroom spinach kale cabbage broccoli zucchini eggplant '
+    'pepper corn pea bean lentil chickpea almond walnut peanut sesame olive avocado cucumber '
+    'roast grill bake fry saute simmer braise stew steam poach toast whisk knead chop slice '
+    'dice mince stir fold season serve rest glaze marinate crispy tender creamy spicy smoky '
+    'sweet tangy fresh hearty quick easy weeknight family classic rustic soup salad bread pie '
+    'cake tart sauce dressing bowl wrap taco burger casserole risotto stirfry skillet sheet pan'
+).split()
+
+
+def sentence(rng, words):
+    return ' '.join(rng.choices(WORDS, k=words)).capitalize()
+
+
+def lines(rng, count, words):
+    # count and words are (low, high, mode) for random.triangular
+    return '\n'.join(sentence(rng, round(rng.triangular(*words))) for _ in range(round(rng.triangular(*count))))
+
+
+def recipe_text(rng):
+    return {
+        'title': sentence(rng, round(rng.triangular(2, 8, 3))).title(),
+        'description': sentence(rng, round(rng.triangular(15, 150, 40))),
+        'ingredients': lines(rng, (4, 20, 9), (1, 6, 3)),
+        'steps': lines(rng, (3, 14, 6), (8, 40, 18)),
+    }
+
+
+def zipf_cum_weights(n, exponent):
+    # for random.choices, the item at rank r is picked in proportion to 1 / (r + 1) ** exponent
+    return list(accumulate(1 / (rank + 1) ** exponent for rank in range(n)))
+
+
+def zipf_split(rng, total, n, exponent, cap):
+    # total split over n ranks in Zipf proportions, each share rounded up or down at random so
+    # they add up to about total, and at most cap
+    cum_weights = zipf_cum_weights(n, exponent)
+    scale = total / cum_weights[-1] if cum_weights else 0
+    previous = 0
+    for cumulative in cum_weights:
+        share = (cumulative - previous) * scale
+        previous = cumulative
+        yield min(cap, int(share) + (rng.random() < share % 1))
+
+
+def next_id(model):
+    return (db.session.scalar(db.select(db.func.max(model.id))) or 0) + 1
+
+
+def insert_batches(table, rows, batch_size, progress=None):
+    count = 0
+    for batch in batches(rows, batch_size):
+        with db.engine.begin() as connection:
+            count += bulk_insert(connection, table, batch, batch_size)
+        if progress:
+            progress(table.name, count)
+    return count
+
+
+def reset_sequences(connection, tables):
+    # PostgreSQL hands out ids from a sequence that doesnt know about the explicit ones
+    if connection.dialect.name != 'postgresql':
+        return
+    for table in tables:
+        connection.execute(db.text(
+            f"SELECT setval(pg_get_serial_sequence('{table.name}', 'id'), (SELECT max(id) FROM {table.name}))"
+        ))
+
+
+def generate(users, recipes, likes, saves, comments, seed=0, batch_size=10000, progress=None):
+    # Adds the rows and returns how many of each went in. A user likes/saves a recipe once,
+    # so with strong power laws a few less likes and saves than asked for go in.
+    rng = random.Random(seed)
+    now = datetime.utcnow().replace(microsecond=0)
+    first_user, first_recipe = next_id(User), next_id(Recipe)
+    password_hash = generate_password_hash(SEED_PASSWORD, method='pbkdf2:sha256')
+
+    # who is most active and what is most popular, as ids in rank order
+    user_order = list(range(first_user, first_user + users))
+    recipe_order = list(range(first_recipe, first_recipe + recipes))
+    rng.shuffle(user_order)
+    rng.shuffle(recipe_order)
+    user_weights = zipf_cum_weights(users, ACTIVITY_EXPONENT)
+    recipe_weights = zipf_cum_weights(recipes, POPULARITY_EXPONENT)
+
+    def posted_at(recipe_id):
+        return now - TIME_SPAN + TIME_SPAN * ((recipe_id - first_recipe) / max(recipes, 1))
+
+    def later(start):
+        return start + (now - start) * rng.random()
+
+    def user_rows():
+        for user_id in range(first_user, first_user + users):
+            yield {
+                'id': user_id,
+                'username': f'seed{user_id}',
+                'email': f'seed{user_id}@example.com',
+                'password_hash': password_hash,
+                'created_at': now - TIME_SPAN * rng.random(),
+            }
+
+    def recipe_rows():
+        for recipe_id in range(first_recipe, first_recipe + recipes):
+            yield {
+                'id': recipe_id,
+                'user_id': rng.choices(user_order, cum_weights=user_weights)[0],
+                'created_at': posted_at(recipe_id),
+                **recipe_text(rng),
+            }
+
+    counts = {'like_count': [0] * recipes, 'save_count': [0] * recipes, 'comment_count': [0] * recipes}
+
+    def membership_rows(total, counter, time_column):
+        # each user's share of total, spread over the recipes by popularity
+        for user_id, share in zip(user_order, zipf_split(rng, total, users, ACTIVITY_EXPONENT, recipes)):
+            picked = set()
+            # the popular recipes come up more than once, draw again for the repeats
+            for _ in range(3):
+                if len(picked) >= share:
+                    break
+                picked.update(rng.choices(recipe_order, cum_weights=recipe_weights, k=share - len(picked)))
+            for recipe_id in sorted(picked):
+                counts[counter][recipe_id - first_recipe] += 1
+                yield {'user_id': user_id, 'recipe_id': recipe_id, time_column: later(posted_at(recipe_id))}
+
+    def comment_rows():
+        for recipe_id, share in zip(recipe_order, zipf_split(rng, comments, recipes, POPULARITY_EXPONENT, comments)):
+            counts['comment_count'][recipe_id - first_recipe] = share
+            created_at = posted_at(recipe_id)
+            for user_id in rng.choices(user_order, cum_weights=user_weights, k=share):
+                # each reply comes somewhere in the first part of the time left
+                created_at += (now - created_at) * rng.random() * 0.2
+                yield {
+                    'user_id': user_id,
+                    'recipe_id': recipe_id,
+                    'content': sentence(rng, round(rng.triangular(3, 60, 12))),
+                    'created_at': created_at,
+                }
+
+    inserted = {
+        'users': insert_batches(User.__table__, user_rows(), batch_size, progress),
+        'recipes': insert_batches(Recipe.__table__, recipe_rows(), batch_size, progress),
+    }
+    if users and recipes:
+        inserted['likes'] = insert_batches(
+            Like.__table__, membership_rows(likes, 'like_count', 'liked_at'), batch_size, progress)
+        inserted['saves'] = insert_batches(
+            SavedRecipe.__table__, membership_rows(saves, 'save_count', 'saved_at'), batch_size, progress)
+        inserted['comments'] = insert_batches(Comment.__table__, comment_rows(), batch_size, progress)
+
+    # the counters of the recipes that got any likes, saves or comments
+    recipes_table = Recipe.__table__
+    set_counts = db.update(recipes_table).where(recipes_table.c.id == db.bindparam('recipe_id')).values(
+        {counter: db.bindparam(f'new_{counter}') for counter in counts}
+    )
+    counter_rows = (
+        {'recipe_id': first_recipe + i, **{f'new_{counter}': values[i] for counter, values in counts.items()}}
+        for i in range(recipes)
+        if any(values[i] for values in counts.values())
+    )
+    for batch in batches(counter_rows, batch_size):
+        with db.engine.begin() as connection:
+            connection.execute(set_counts, batch)
+
+    with db.engine.begin() as connection:
+        reset_sequences(connection, [User.__table__, Recipe.__table__])
+    return inserted
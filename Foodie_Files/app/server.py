@@ -0,0 +1,126 @@
+import gc
+import os
+import sys
+from gunicorn.app.base import BaseApplication
+from sqlalchemy import orm
+from app import app, db
+
+###### PRODUCTION SERVER ######
+# `flask serve` runs the app under gunicorn instead of the single process dev server:
+#   - the master imports the app and warms it once (mappers, templates, a database round
+#     trip), then forks the workers, so every worker starts ready and shares those pages
+#   - gc.freeze() before forking moves everything loaded so far out of the collector's
+#     reach, a collection in a worker would otherwise touch (and so copy) every shared page
+#   - workers are replaced after SERVE_MAX_REQUESTS requests (plus jitter so they dont all
+#     restart together) to cap slow leaks
+#   - kill -HUP <master pid> replaces the workers gracefully, in flight requests finish.
+#     The app is preloaded, so new code needs kill -USR2 (start a new master) and then
+#     kill -QUIT on the old one.
+# Worker classes:
+#   'gthread' - the default, SERVE_THREADS threads per worker. Every open SSE stream holds
+#               one of them for up to EVENTS_STREAM_MAX_AGE
+#   'uvicorn' - the ASGI app in app/asgi.py, SSE streams run on the event loop and the other
+#               routes on a thread pool, the choice for many open pages
+#   'gevent'  - opt in. A stream is a greenlet and a worker takes SERVE_WORKER_CONNECTIONS
+#               clients, but the standard library has to be patched before the app is
+#               imported, so the command re-runs itself through green.py. Only PostgreSQL
+#               with psycogreen installed waits cooperatively, a SQLite query (or psycopg2
+#               without psycogreen) stalls every greenlet of its worker.
+
+WORKER_CLASSES = {
+    'gthread': 'gthread',
+    'gevent': 'gevent',
+    'uvicorn': 'uvicorn.workers.UvicornWorker',
+}
+
+
+def warm_up():
+    # Everything a first request would otherwise load lazily in each worker
+    orm.configure_mappers()
+    for name in app.jinja_loader.list_templates():
+        app.jinja_env.get_template(name)
+    with app.app_context():
+        db.session.execute(db.text('SELECT 1'))
+        db.session.remove()
+        # no pooled connection may cross the fork, each worker opens its own
+        db.engine.dispose()
+    gc.collect()
+    gc.freeze()
+
+
+def pre_fork(server, worker):
+    # objects the master created since the last fork are shared too
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    # drop anything pooled in the master without closing it under the master's feet
+    with app.app_context():
+        db.engine.dispose(close=False)
+
+
+class FoodieServer(BaseApplication):
+    def __init__(self, application, options):
+        self.application = application
+        self.options = options
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            if value is not None:
+                self.cfg.set(key, value)
+
+    def load(self):
+        return self.application
+
+
+def green_driver():
+    # None if the database driver would block the gevent hub
+    if db.engine.dialect.name != 'postgresql':
+        return None
+    from psycopg2 import extensions
+    return extensions.get_wait_callback()
+
+
+def serve(bind, workers, threads, worker_class, max_requests, max_requests_jitter, timeout,
+          graceful_timeout, pidfile=None):
+    if worker_class == 'gevent':
+        from gevent import monkey
+        if not monkey.is_module_patched('socket'):
+            green = os.path.join(os.path.dirname(app.root_path), 'green.py')
+            os.execv(sys.executable, [sys.executable, green] + sys.argv[1:])
+        if green_driver() is None:
+            app.logger.warning('The %s driver blocks the gevent hub, a query stalls every request of '
+                               'its worker. Use uvicorn workers for SSE, or PostgreSQL with psycogreen',
+                               db.engine.dialect.name)
+    if worker_class == 'uvicorn':
+        from .asgi import asgi_app
+        application = asgi_app
+    else:
+        application = app
+    if worker_class == 'gthread' and app.config['EVENTS_ENABLED']:
+        app.logger.warning('Every open SSE stream holds one of the %d threads of a gthread worker, '
+                           'use --worker-class uvicorn for many open pages or set FOODIE_EVENTS_ENABLED=0',
+                           threads)
+    if app.config['METRICS_DIR']:
+        # the counters of the workers of an earlier run dont belong to this one
+        from .metrics import clear_directory
+        clear_directory(app.config['METRICS_DIR'])
+    warm_up()
+
+    FoodieServer(application, {
+        'bind': bind,
+        'workers': workers,
+        'threads': threads,
+        'worker_connections': app.config['SERVE_WORKER_CONNECTIONS'],
+        'worker_class': WORKER_CLASSES[worker_class],
+        'preload_app': True,
+        'max_requests': max_requests,
+        'max_requests_jitter': max_requests_jitter,
+        'timeout': timeout,
+        'graceful_timeout': graceful_timeout,
+        'pidfile': pidfile,
+        'pre_fork': pre_fork,
+        'post_fork': post_fork,
+        'proc_name': 'foodie',
+    }).run()
@@ -0,0 +1,173 @@
+import os
+import re
+import sys
+import threading
+import time
+from collections import OrderedDict, deque
+from flask import request, has_request_context
+from app import app
+
+###### SLOW QUERY LOG ######
+# A statement that takes SLOW_QUERY_SECONDS or longer (timed by app/sqlstats.py) is logged as
+# a warning with its parameters, the endpoint and the line of our code that ran it, and the
+# database's plan for it: EXPLAIN QUERY PLAN on SQLite, EXPLAIN elsewhere. The plan is taken
+# on the same connection right after the statement, once per fingerprint every
+# SLOW_QUERY_EXPLAIN_INTERVAL seconds.
+# Statements are also added up by fingerprint (the SQL with its literals and parameters
+# replaced by ?) for the Slow queries admin page. That is per worker process, the log has
+# every one of them.
+
+SAMPLES_KEPT = 5
+PARAMETER_LENGTH = 200  # longer parameter values are cut in the log and on the page
+
+EXPLAINABLE = ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH')
+EXPLAIN_SAVEPOINT = 'slow_query_explain'
+
+_LITERALS = [
+    (re.compile(r"'(?:[^']|'')*'"), '?'),                         # strings
+    (re.compile(r'%\(\w+\)s|\$\d+|(?<![:\w]):\w+|%s'), '?'),       # bind parameters
+    (re.compile(r'\b\d+(?:\.\d+)?\b'), '?'),                      # numbers
+    (re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)'), '(...)'),         # IN lists of any length
+]
+
+# frames in these files are the plumbing, not the code that ran the statement
+_PLUMBING = ('sqlstats.py', 'slowlog.py', 'timing.py', 'metrics.py', 'routing.py', 'database.py')
+_APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def fingerprint(statement):
+    statement = ' '.join(statement.split())
+    for pattern, replacement in _LITERALS:
+        statement = pattern.sub(replacement, statement)
+    return statement
+
+
+class SlowQuery:
+    def __init__(self, fingerprint):
+        self.fingerprint = fingerprint
+        self.count = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+        self.endpoints = {}
+        self.samples = deque(maxlen=SAMPLES_KEPT)  # dicts, newest last
+        self.plan = None
+        self.explained_at = None
+
+    @property
+    def mean_seconds(self):
+        return self.seconds / self.count if self.count else 0.0
+
+
+class SlowQueryLog:
+    def __init__(self, keep):
+        self.keep = keep
+        self._queries = OrderedDict()  # by fingerprint, least recently slow first
+        self._lock = threading.Lock()
+
+    def add(self, statement, seconds, sample):
+        # Returns the SlowQuery, with the sample counted in
+        key = fingerprint(statement)
+        with self._lock:
+            query = self._queries.get(key)
+            if query is None:
+                query = self._queries[key] = SlowQuery(key)
+                while len(self._queries) > self.keep:
+                    self._queries.popitem(last=False)
+            self._queries.move_to_end(key)
+            query.count += 1
+            query.seconds += seconds
+            query.max_seconds = max(query.max_seconds, seconds)
+            endpoint = sample['endpoint'] or '-'
+            query.endpoints[endpoint] = query.endpoints.get(endpoint, 0) + 1
+            query.samples.append(sample)
+        return query
+
+    def queries(self):
+        # worst first, by the time they took altogether
+        with self._lock:
+            return sorted(self._queries.values(), key=lambda q: q.seconds, reverse=True)
+
+    def clear(self):
+        with self._lock:
+            self._queries.clear()
+
+
+slow_queries = SlowQueryLog(app.config['SLOW_QUERY_KEEP'])
+
+
+def short_parameters(parameters, executemany):
+    if executemany:
+        return f'{short_parameters(parameters[0], False)} (and {len(parameters) - 1} more)' if parameters else '[]'
+    text = repr(parameters)
+    return text if len(text) <= PARAMETER_LENGTH else text[:PARAMETER_LENGTH] + '...'
+
+
+def calling_line():
+    # file:line function of the innermost frame in app/ that isnt one of the hooks
+    frame = sys._getframe(1)
+    while frame is not None:
+        filename = frame.f_code.co_filename
+        if filename.startswith(_APP_DIR) and not filename.endswith(_PLUMBING):
+            return f'{os.path.relpath(filename, os.path.dirname(_APP_DIR))}:{frame.f_lineno} {frame.f_code.co_name}'
+        frame = frame.f_back
+    return None
+
+
+def explain(conn, statement, parameters):
+    # The plan as text, or why there isnt one. A new cursor on the same DBAPI connection,
+    # so it sees the same transaction and doesnt fire the engine events again. Outside
+    # SQLite a failed statement aborts the whole transaction, there the EXPLAIN runs in a
+    # savepoint that is rolled back if it fails, so the request carries on.
+    sqlite = conn.dialect.name == 'sqlite'
+    explain_statement = ('EXPLAIN QUERY PLAN ' if sqlite else 'EXPLAIN ') + statement
+    cursor = conn.connection.dbapi_connection.cursor()
+    try:
+        if not sqlite:
+            cursor.execute(f'SAVEPOINT {EXPLAIN_SAVEPOINT}')
+        try:
+            cursor.execute(explain_statement, parameters)
+            rows = cursor.fetchall()
+        except Exception as e:
+            if not sqlite:
+                cursor.execute(f'ROLLBACK TO SAVEPOINT {EXPLAIN_SAVEPOINT}')
+            return f'EXPLAIN failed: {e}'
+        if not sqlite:
+            cursor.execute(f'RELEASE SAVEPOINT {EXPLAIN_SAVEPOINT}')
+    except Exception as e:
+        # no transaction to make a savepoint in (AUTOCOMMIT), nothing to spoil either
+        return f'EXPLAIN skipped: {e}'
+    finally:
+        cursor.close()
+    if not sqlite:
+        return '\n'.join(str(row[0]) for row in rows)
+    # (id, parent, notused, detail) rows, indented under their parent
+    depth = {0: -1}
+    lines = []
+    for node_id, parent, _, detail in rows:
+        depth[node_id] = depth.get(parent, -1) + 1
+        lines.append('  ' * depth[node_id] + detail)
+    return '\n'.join(lines)
+
+
+def record_slow_query(conn, statement, parameters, executemany, seconds):
+    # Called by app/sqlstats.py for every statement over SLOW_QUERY_SECONDS
+    sample = {
+        'at': time.time(),
+        'seconds': seconds,
+        'parameters': short_parameters(parameters, executemany),
+        'endpoint': request.endpoint if has_request_context() else None,
+        'caller': calling_line(),
+    }
+    query = slow_queries.add(statement, seconds, sample)
+
+    plan = query.plan
+    words = statement.lstrip().split(None, 1)
+    now = time.monotonic()
+    if app.config['SLOW_QUERY_EXPLAIN'] and words and words[0].upper() in EXPLAINABLE and (
+            query.explained_at is None or now - query.explained_at > app.config['SLOW_QUERY_EXPLAIN_INTERVAL']):
+        query.explained_at = now
+        plan = query.plan = explain(conn, statement, parameters[0] if executemany else parameters)
+
+    app.logger.warning('Slow query %.1fms in %s at %s: %s parameters=%s\n%s', seconds * 1000,
+                       sample['endpoint'] or '-', sample['caller'] or '-', ' '.join(statement.split()),
+                       sample['parameters'], plan or '(no plan)')
@@ -0,0 +1,110 @@
+import heapq
+import time
+from flask import g, request, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from app import app
+from .slowlog import record_slow_query
+
+###### PER REQUEST SQL STATS ######
+# Every statement any engine runs during a request (the primary, the replica bind, the async
+# engine in app/asgi.py) is counted and timed. After the request:
+#   - the X-DB-Queries and X-DB-Time (ms) headers carry the count and the total time
+#   - the numbers and the slowest statements are logged at debug level
+#   - a view with a query budget (sql_budget below, or SQL_BUDGETS in config.py by endpoint)
+#     that ran more statements is logged as a warning, and fails the request when testing,
+#     so an N+1 query loop shows up in the test that exercises it
+# Statements over SLOW_QUERY_SECONDS, in a request or not, go to the slow query log
+# (app/slowlog.py).
+
+class SQLBudgetExceeded(AssertionError):
+    pass
+
+
+class QueryStats:
+    def __init__(self, keep):
+        self.count = 0
+        self.seconds = 0.0
+        self.keep = keep
+        self._slowest = []  # min heap of (seconds, n, statement), the keep slowest
+
+    def record(self, statement, seconds):
+        statement = ' '.join(statement.split())
+        self.count += 1
+        self.seconds += seconds
+        entry = (seconds, self.count, statement)
+        if len(self._slowest) < self.keep:
+            heapq.heappush(self._slowest, entry)
+        elif seconds > self._slowest[0][0]:
+            heapq.heapreplace(self._slowest, entry)
+
+    @property
+    def slowest(self):
+        # [(seconds, statement)], slowest first
+        return [(seconds, statement) for seconds, _, statement in sorted(self._slowest, reverse=True)]
+
+
+def sql_budget(max_queries):
+    # @sql_budget(5) under @app.route, the most statements the view may run per request
+    def decorate(view):
+        view.sql_budget = max_queries
+        return view
+    return decorate
+
+
+def request_stats():
+    # The QueryStats of the current request, None outside requests or when turned off
+    if not has_request_context() or not app.config['SQL_STATS']:
+        return None
+    if 'sql_stats' not in g:
+        g.sql_stats = QueryStats(app.config['SQL_STATS_SLOWEST'])
+    return g.sql_stats
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _start_timer(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('sql_stats_started', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _record_statement(conn, cursor, statement, parameters, context, executemany):
+    seconds = time.perf_counter() - conn.info['sql_stats_started'].pop()
+    stats = request_stats()
+    if stats is not None:
+        stats.record(statement, seconds)
+    threshold = app.config['SLOW_QUERY_SECONDS']
+    if threshold is not None and seconds >= threshold:
+        record_slow_query(conn, statement, parameters, executemany, seconds)
+
+
+@event.listens_for(Engine, 'handle_error')
+def _drop_timer(context):
+    # a failed statement never gets to after_cursor_execute
+    if context.connection is not None and context.connection.info.get('sql_stats_started'):
+        context.connection.info['sql_stats_started'].pop()
+
+
+def budget_for(endpoint):
+    if endpoint in app.config['SQL_BUDGETS']:
+        return app.config['SQL_BUDGETS'][endpoint]
+    return getattr(app.view_functions.get(endpoint), 'sql_budget', None)
+
+
+@app.after_request
+def report_sql_stats(response):
+    stats = request_stats()
+    if stats is None:
+        return response
+
+    response.headers['X-DB-Queries'] = str(stats.count)
+    response.headers['X-DB-Time'] = f'{stats.seconds * 1000:.1f}'
+    app.logger.debug('%s %s: %d queries in %.1fms, slowest: %s', request.method, request.path, stats.count,
+                     stats.seconds * 1000, '; '.join(f'{s * 1000:.1f}ms {sql}' for s, sql in stats.slowest))
+
+    budget = budget_for(request.endpoint)
+    if budget is not None and stats.count > budget:
+        message = f'{request.endpoint} ran {stats.count} queries, its budget is {budget}'
+        app.logger.warning('%s, slowest: %s', message, '; '.join(sql for _, sql in stats.slowest))
+        if app.testing:
+            raise SQLBudgetExceeded(message)
+    return response
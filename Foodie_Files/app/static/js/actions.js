@@ -27,6 +27,13 @@ $(document).ready(function() {
             }
         });
 
+        // Infinite scroll, fetch the next page when we get close to the bottom of the list
+        $(window).on("scroll", function() {
+            if ($(window).scrollTop() + $(window).height() >= $(document).height() - 300) {
+                loadMoreRecipes();
+            }
+        });
+
         // load the recipes on initial page load if this is a page that uses loadRecipes()
         loadRecipes();
     }
@@ -94,13 +101,26 @@ $(document).ready(function() {
                 $("#recipeIngredients").text(response.ingredients);
                 $("#recipeSteps").text(response.steps);
 
-                if(response.image_url) {
-                    $("#recipeImageContainer").html('<img src="'+response.image_url+'" alt="'+response.title+'" style="max-width:100%;">');
+                if(response.image_sources) {
+                    // let the browser pick the smallest rendition that fits, WebP first
+                    var sources = response.image_sources;
+                    var picture = $("<picture></picture>");
+                    picture.append($("<source type='image/webp'>").attr({ srcset: sources.webp, sizes: sources.sizes }));
+                    picture.append($("<img style='max-width:100%;'>").attr({
+                        src: response.image_url, srcset: sources.jpeg, sizes: sources.sizes, alt: response.title
+                    }));
+                    $("#recipeImageContainer").empty().append(picture);
+                } else if(response.image_url) {
+                    $("#recipeImageContainer").empty().append($("<img style='max-width:100%;'>").attr({
+                        src: response.image_url, alt: response.title
+                    }));
                 } else {
                     $("#recipeImageContainer").html('');
                 }
 
-                updateCommentList(response.comments);
+                commentsRecipeId = recipeId;
+                updateCommentList(response.comments, response.comments_cursor);
+                followRecipe(recipeId);
 
                 $("#submitCommentBtn").data('recipe-id', recipeId);
 
@@ -130,7 +150,10 @@ $(document).ready(function() {
             success: function(response) {
                 if(response.status === 'success') {
                     $("#newCommentContent").val('');
-                    updateCommentList(response.comments);
+                    // only append it once every older page is shown, otherwise it comes with the last page
+                    if(commentsCursor === null && recipeId === commentsRecipeId) {
+                        appendComments([response.comment]);
+                    }
                 } else {
                     console.log("Error adding comment");
                 }
@@ -141,45 +164,197 @@ $(document).ready(function() {
         });
     });
 
-    function updateCommentList(comments) {
+    // Comments are paged oldest first, commentsCursor is where the next page starts (null when all are shown)
+    var commentsRecipeId = null;
+    var commentsCursor = null;
+    var shownComments = {};
+
+    function updateCommentList(comments, cursor) {
+        $("#commentList").empty();
+        shownComments = {};
+        appendComments(comments);
+        setCommentsCursor(cursor);
+    }
+
+    function appendComments(comments) {
         var commentList = $("#commentList");
-        commentList.empty();
-        if(comments.length === 0) {
-            commentList.append("<p>No comments yet.</p>");
-        } else {
-            for(var i=0; i<comments.length; i++) {
-                var c = comments[i];
-                var commentHTML = "<div class='mb-2'><strong>"+c.author+"</strong> <small>("+c.created_at+")</small><br>"+c.content+"</div>";
-                commentList.append(commentHTML);
+        commentList.find(".no-comments").remove();
+        for(var i=0; i<comments.length; i++) {
+            var c = comments[i];
+            // our own comments come back both from add_comment and from the live stream
+            if(shownComments[c.id]) {
+                continue;
+            }
+            shownComments[c.id] = true;
+            // author and content are what users typed, they only ever go in as text
+            var comment = $("<div class='mb-2'></div>");
+            comment.append($("<strong></strong>").text(c.author), " ", $("<small></small>").text("(" + c.created_at + ")"));
+            comment.append("<br>", document.createTextNode(c.content));
+            commentList.append(comment);
+        }
+        if(commentList.children().length === 0) {
+            commentList.append("<p class='no-comments'>No comments yet.</p>");
+        }
+    }
+
+    function setCommentsCursor(cursor) {
+        commentsCursor = cursor || null;
+        $("#loadMoreComments").remove();
+        if(commentsCursor) {
+            $("#commentList").after("<button id='loadMoreComments' class='btn btn-link p-0'>Show more comments</button>");
+        }
+    }
+
+    // Live updates (Server-Sent Events) for the recipe open in the modal and for the recipe list
+    var liveUpdates = $('meta[name="live-updates"]').attr('content') === 'true';
+    var recipeStream = null;
+    var listStream = null;
+    var listStreamIds = null;
+    var listStreamTimer = null;
+
+    function updateLikeCount(data) {
+        $("#like-count-" + data.recipe_id).text(data.like_count);
+    }
+
+    function followRecipe(recipeId) {
+        if(!liveUpdates) {
+            return;
+        }
+        if(recipeStream) {
+            recipeStream.close();
+        }
+        recipeStream = new EventSource('/recipe_events?recipe_id=' + encodeURIComponent(recipeId));
+        recipeStream.addEventListener('comment', function(e) {
+            var data = JSON.parse(e.data);
+            if(data.recipe_id === commentsRecipeId && commentsCursor === null) {
+                appendComments([data.comment]);
             }
+        });
+        recipeStream.addEventListener('likes', function(e) {
+            updateLikeCount(JSON.parse(e.data));
+        });
+    }
+
+    $("#recipeModal").on("hidden.bs.modal", function() {
+        if(recipeStream) {
+            recipeStream.close();
+            recipeStream = null;
         }
+    });
+
+    function followRecipeList() {
+        // Renders come in bursts (typing a search, loading more), the stream is replaced
+        // once they settle and only when the recipes on the page changed
+        if(!liveUpdates) {
+            return;
+        }
+        clearTimeout(listStreamTimer);
+        listStreamTimer = setTimeout(openListStream, 1000);
     }
 
+    function openListStream() {
+        // one multiplexed stream for the recipes on the page, the server caps how many it follows
+        var ids = $("#recipeList .view-details-button").map(function() {
+            return $(this).data('recipe-id');
+        }).get().slice(-200).join(',');
+        if(listStream && ids === listStreamIds) {
+            return;
+        }
+        if(listStream) {
+            listStream.close();
+            listStream = null;
+        }
+        listStreamIds = ids;
+        if(ids.length > 0) {
+            listStream = new EventSource('/events?recipe_ids=' + ids);
+            listStream.addEventListener('likes', function(e) {
+                updateLikeCount(JSON.parse(e.data));
+            });
+        }
+    }
+
+    $("body").on("click", "#loadMoreComments", function() {
+        var recipeId = commentsRecipeId;
+        $.ajax({
+            url: '/comments',
+            type: 'GET',
+            data: { recipe_id: recipeId, after: commentsCursor },
+            dataType: 'json',
+            success: function(response) {
+                // the modal may have moved on to another recipe meanwhile
+                if(recipeId !== commentsRecipeId) {
+                    return;
+                }
+                appendComments(response.comments);
+                setCommentsCursor(response.next_cursor);
+            },
+            error: function(error) {
+                console.log(error);
+            }
+        });
+    });
+
     // These functions only run if the necessary elements are present
+    // The list is paged, nextCursor is what the server sent back for the page after the last one shown
+    var nextCursor = null;
+    var loadingRecipes = false;
+    var recipeRequest = 0;
+
     function loadRecipes() {
+        nextCursor = null;
+        fetchRecipes(false);
+    }
+
+    function loadMoreRecipes() {
+        if (nextCursor && !loadingRecipes) {
+            fetchRecipes(true);
+        }
+    }
+
+    function fetchRecipes(append) {
         var sort = $("#sortOption").val();
         var query = $("#searchQuery").val().trim();
+        var data = { sort: sort, q: query };
+        if (append) {
+            data.cursor = nextCursor;
+        }
+
+        // ignore answers to requests made before the sort or search changed
+        var requestId = ++recipeRequest;
+        loadingRecipes = true;
 
         $.ajax({
             url: '/filter_recipes',
             type: 'GET',
-            data: { sort: sort, q: query },
+            data: data,
             dataType: 'json',
             success: function(response) {
-                renderRecipeList(response);
+                if (requestId !== recipeRequest) {
+                    return;
+                }
+                nextCursor = response.next_cursor;
+                renderRecipeList(response.recipes, append);
             },
             error: function(error) {
                 console.log(error);
+            },
+            complete: function() {
+                if (requestId === recipeRequest) {
+                    loadingRecipes = false;
+                }
             }
         });
     }
 
-    function renderRecipeList(recipes) {
+    function renderRecipeList(recipes, append) {
         var recipeList = $("#recipeList");
-        recipeList.empty();
+        if (!append) {
+            recipeList.empty();
+        }
     
-        if (recipes.length === 0) {
+        if (recipes.length === 0 && !append) {
             recipeList.append("<li>No recipes found.</li>");
+            followRecipeList();
             return;
         }
     
@@ -189,7 +364,12 @@ $(document).ready(function() {
             var li = $("<li class='recipe-item'></li>");
 
             var infoDiv = $("<div class='recipe-info'></div>");
-            infoDiv.append("<strong>" + r.title + "</strong> by <em>" + r.author + "</em> (Likes: <span id='like-count-" + r.id + "'>" + r.like_count + "</span>)");
+            infoDiv.append($("<strong></strong>").text(r.title), " by ", $("<em></em>").text(r.author), " (Likes: ",
+                           $("<span></span>").attr('id', 'like-count-' + r.id).text(r.like_count), ")");
+            if (r.highlight) {
+                // snippet from the search index, the matched words are wrapped in <mark>
+                infoDiv.append("<div class='recipe-highlight'><small>" + r.highlight + "</small></div>");
+            }
 
             var actionsDiv = $("<div class='recipe-actions'></div>");
             actionsDiv.append('<button class="btn action-button view-details-button" data-recipe-id="' + r.id + '">View Details</button>');
@@ -206,5 +386,6 @@ $(document).ready(function() {
 
             recipeList.append(li);
         });
+        followRecipeList();
     }
 });
@@ -0,0 +1,199 @@
+import hashlib
+import os
+from datetime import datetime
+from sqlalchemy.exc import IntegrityError
+from app import app, db
+from .database import insert_ignoring_conflicts
+from .models import Recipe, StoredImage
+from .images import decode_image, render_image
+from .storage_backends import create_storage
+from .metrics import observe
+
+###### CONTENT ADDRESSED IMAGE STORAGE ######
+# Uploads are stored by the SHA-256 of their bytes instead of the client's filename:
+#   ab/cd/abcd.../{thumb,card,full}.{webp,jpg}   (keys in the storage backend)
+# so two users uploading "pizza.jpg" never overwrite each other and the same picture is only
+# processed and stored once. Every recipe using an image holds a reference on its
+# StoredImage row, and the files are deleted when the last reference goes away.
+# The renditions never change for a hash, so they are served as immutable.
+
+HASH_CHUNK_SIZE = 64 * 1024
+
+# sizes attribute that goes with the srcset in the recipe modal and on the cards
+MODAL_SIZES = '(max-width: 800px) 100vw, 800px'
+CARD_SIZES = '(max-width: 576px) 100vw, 480px'
+
+storage = create_storage(app.config)
+
+
+def hash_stream(stream):
+    # SHA-256 of the whole stream read in chunks, the stream is rewound for decoding
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: stream.read(HASH_CHUNK_SIZE), b''):
+        digest.update(chunk)
+    stream.seek(0)
+    return digest.hexdigest()
+
+
+def image_key(digest):
+    # shard on the first two bytes so no directory ends up with every image in it
+    return f'{digest[:2]}/{digest[2:4]}/{digest}'
+
+
+def store_image(stream):
+    # Returns the StoredImage for this upload with a reference taken on it,
+    # decoding and rendering only when these bytes havent been stored before
+    digest = hash_stream(stream)
+    stream.seek(0, os.SEEK_END)
+    byte_size = stream.tell()
+    stored = db.session.get(StoredImage, digest)
+
+    renditions = None
+    if stored is None:
+        add_stored_image(digest, render_renditions(stream, digest), byte_size)
+    elif not storage.exists(stored.renditions['full']['jpeg']):
+        renditions = render_renditions(stream, digest)
+
+    if not take_reference(digest, renditions):
+        # collect_unused_images deleted the row, and the files with it, after we looked
+        add_stored_image(digest, render_renditions(stream, digest), byte_size)
+        take_reference(digest)
+    return db.session.get(StoredImage, digest, populate_existing=True)
+
+
+def render_renditions(stream, digest):
+    stream.seek(0)
+    prefix = image_key(digest)
+    return render_image(decode_image(stream), lambda filename, data, content_type:
+                        storage.save(f'{prefix}/{filename}', data, content_type))
+
+
+def take_reference(digest, renditions=None):
+    # In SQL, a concurrent upload of the same bytes may have added its reference already.
+    # False when there is no row to take it on.
+    values = {'ref_count': StoredImage.ref_count + 1}
+    if renditions is not None:
+        values['renditions'] = renditions
+    return db.session.execute(
+        db.update(StoredImage).where(StoredImage.hash == digest).values(values)
+    ).rowcount > 0
+
+
+def add_stored_image(digest, renditions, byte_size):
+    # The row for a first upload with no references yet. Two first uploads of the same bytes
+    # render the same files, whichever inserts second leaves the row as it is.
+    values = {'hash': digest, 'renditions': renditions, 'ref_count': 0, 'byte_size': byte_size,
+              'created_at': datetime.utcnow()}
+    insert = insert_ignoring_conflicts(StoredImage, db.session.get_bind(StoredImage).dialect.name)
+    if insert is not None:
+        db.session.execute(insert.values(values))
+        return
+    try:
+        with db.session.begin_nested():
+            db.session.add(StoredImage(**values))
+    except IntegrityError:
+        pass
+
+
+def release_image(digest):
+    # Drop one reference, collect_unused_images removes the files once nobody uses them
+    if digest:
+        db.session.info.setdefault('released_images', set()).add(digest)
+        db.session.execute(
+            db.update(StoredImage).where(StoredImage.hash == digest)
+              .values(ref_count=StoredImage.ref_count - 1)
+        )
+
+
+def attach_image(recipe, stream):
+    # Store an upload and point the recipe at it. Any image the recipe had before is released.
+    # image_url is only for recipes from before the pipeline: the URLs of the renditions are
+    # made when rendering (recipe_image_url) since presigned S3 URLs expire and dont fit it.
+    stream.seek(0, os.SEEK_END)
+    observe('foodie_upload_bytes', stream.tell())
+    stream.seek(0)
+    stored = store_image(stream)
+    # for a re-upload of the same picture this gives back the extra reference just taken
+    release_image(recipe.image_hash)
+    recipe.image_hash = stored.hash
+    recipe.image_renditions = stored.renditions
+    recipe.image_url = None
+
+
+def detach_image(recipe):
+    release_image(recipe.image_hash)
+    recipe.image_hash = None
+
+
+def collect_unused_images(everything=False):
+    # Delete the images nothing references any more. Run after the commit that released them.
+    # The files go before the row's deletion is committed and only while the row is still
+    # gone in that transaction: until the commit the deleted row keeps an upload of the same
+    # bytes from taking a reference (or adding the row again), after it the upload finds the
+    # row gone and renders the files anew. If deleting the files fails the row stays.
+    # Only the images released in this session are checked unless everything is asked for.
+    if everything:
+        candidates = [digest for digest, in db.session.query(StoredImage.hash).filter(StoredImage.ref_count <= 0)]
+    else:
+        candidates = db.session.info.pop('released_images', set())
+
+    removed = 0
+    for digest in candidates:
+        deleted = db.session.execute(
+            db.delete(StoredImage).where(StoredImage.hash == digest, StoredImage.ref_count <= 0)
+        ).rowcount
+        still_gone = deleted and db.session.scalar(
+            db.select(db.func.count()).where(StoredImage.hash == digest)
+        ) == 0
+        if still_gone:
+            storage.delete_prefix(image_key(digest))
+            removed += 1
+        db.session.commit()
+    return removed
+
+
+def recount_image_references():
+    # Set every ref_count from the recipes that actually use the image, for when rows were
+    # changed without going through this module (e.g. in the admin)
+    references = db.select(db.func.count(Recipe.id)).where(Recipe.image_hash == StoredImage.hash).scalar_subquery()
+    result = db.session.execute(
+        db.update(StoredImage).where(StoredImage.ref_count != references)
+          .values(ref_count=references)
+          .execution_options(synchronize_session=False)
+    )
+    db.session.commit()
+    return result.rowcount
+
+
+###### IMAGE URLS ######
+
+@app.template_filter('media_url')
+def media_url(key):
+    return storage.url(key)
+
+
+@app.template_filter('srcset')
+def srcset(renditions, fmt):
+    # "url 160w, url 480w, ..." for one format, duplicates from small originals are skipped
+    entries = {}
+    for rendition in (renditions or {}).values():
+        entries[rendition['width']] = rendition[fmt]
+    return ', '.join(f'{storage.url(key)} {width}w' for width, key in sorted(entries.items()))
+
+
+def recipe_image_url(recipe):
+    # recipes from before the pipeline only have image_url
+    if recipe.image_renditions:
+        return storage.url(recipe.image_renditions['full']['jpeg'])
+    return recipe.image_url
+
+
+def image_sources(recipe):
+    # What get_recipe_details sends for the image srcsets
+    if not recipe.image_renditions:
+        return None
+    return {
+        'webp': srcset(recipe.image_renditions, 'webp'),
+        'jpeg': srcset(recipe.image_renditions, 'jpeg'),
+        'sizes': MODAL_SIZES,
+    }
@@ -0,0 +1,141 @@
+import os
+import shutil
+import tempfile
+from abc import ABC, abstractmethod
+
+###### STORAGE BACKENDS ######
+# Where uploaded files are kept, picked with STORAGE_BACKEND in config.py:
+#   'local' - a folder on disk (UPLOAD_FOLDER) published under UPLOAD_URL
+#   's3'    - any S3 API compatible bucket (AWS, MinIO, a local stand-in like moto_server)
+# Both take writes as streams and hand out URLs the browser reads from directly, so with a
+# CDN/nginx UPLOAD_URL or a bucket the Flask workers never proxy image bytes.
+# Keys are '/' separated paths like 'ab/cd/<hash>/full.jpg'.
+
+COPY_CHUNK_SIZE = 1024 * 1024
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+
+class StorageBackend(ABC):
+    @abstractmethod
+    def save(self, key, stream, content_type=None):
+        # store the stream under key and return the key
+        ...
+
+    @abstractmethod
+    def exists(self, key):
+        ...
+
+    @abstractmethod
+    def delete_prefix(self, prefix):
+        # delete every key under prefix/
+        ...
+
+    @abstractmethod
+    def url(self, key):
+        ...
+
+
+class LocalStorage(StorageBackend):
+    def __init__(self, root, base_url):
+        self.root = root
+        self.base_url = base_url.rstrip('/')
+
+    def path(self, key):
+        path = os.path.normpath(os.path.join(self.root, *key.split('/')))
+        if not path.startswith(os.path.normpath(self.root) + os.sep):
+            raise ValueError(f'Key outside the storage folder: {key}')
+        return path
+
+    def save(self, key, stream, content_type=None):
+        # copy in chunks to a temporary file next to the target and rename it into place,
+        # readers never see a half written file
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.upload-')
+        try:
+            with os.fdopen(fd, 'wb') as tmp:
+                shutil.copyfileobj(stream, tmp, COPY_CHUNK_SIZE)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        return key
+
+    def exists(self, key):
+        return os.path.isfile(self.path(key))
+
+    def delete_prefix(self, prefix):
+        shutil.rmtree(self.path(prefix), ignore_errors=True)
+
+    def url(self, key):
+        return f'{self.base_url}/{key}'
+
+
+class S3Storage(StorageBackend):
+    def __init__(self, bucket, endpoint_url=None, region=None, access_key=None, secret_key=None,
+                 public_url=None, url_expires=3600, multipart_threshold=8 * 1024 * 1024,
+                 multipart_chunksize=8 * 1024 * 1024):
+        # boto3 is only needed when this backend is used
+        import boto3
+        from boto3.s3.transfer import TransferConfig
+        from botocore.exceptions import ClientError
+
+        self.bucket = bucket
+        self.public_url = public_url.rstrip('/') if public_url else None
+        self.url_expires = url_expires
+        self.client = boto3.client(
+            's3', endpoint_url=endpoint_url, region_name=region,
+            aws_access_key_id=access_key, aws_secret_access_key=secret_key
+        )
+        # anything above the threshold is uploaded as a multipart upload, part by part from the stream
+        self.transfer_config = TransferConfig(multipart_threshold=multipart_threshold,
+                                              multipart_chunksize=multipart_chunksize)
+        self._client_error = ClientError
+
+    def save(self, key, stream, content_type=None):
+        extra = {'CacheControl': IMMUTABLE_CACHE_CONTROL}
+        if content_type:
+            extra['ContentType'] = content_type
+        self.client.upload_fileobj(stream, self.bucket, key, ExtraArgs=extra, Config=self.transfer_config)
+        return key
+
+    def exists(self, key):
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=key)
+        except self._client_error as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+                return False
+            raise
+        return True
+
+    def delete_prefix(self, prefix):
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix.rstrip('/') + '/'):
+            keys = [{'Key': obj['Key']} for obj in page.get('Contents', [])]
+            if keys:
+                self.client.delete_objects(Bucket=self.bucket, Delete={'Objects': keys, 'Quiet': True})
+
+    def url(self, key):
+        # a public bucket/CDN URL when there is one, otherwise a presigned GET
+        if self.public_url:
+            return f'{self.public_url}/{key}'
+        return self.client.generate_presigned_url(
+            'get_object', Params={'Bucket': self.bucket, 'Key': key}, ExpiresIn=self.url_expires
+        )
+
+
+def create_storage(config):
+    backend = config['STORAGE_BACKEND']
+    if backend == 'local':
+        return LocalStorage(config['UPLOAD_FOLDER'], config['UPLOAD_URL'])
+    if backend == 's3':
+        return S3Storage(
+            config['S3_BUCKET'],
+            endpoint_url=config['S3_ENDPOINT_URL'],
+            region=config['S3_REGION'],
+            access_key=config['S3_ACCESS_KEY'],
+            secret_key=config['S3_SECRET_KEY'],
+            public_url=config['S3_PUBLIC_URL'],
+            url_expires=config['S3_URL_EXPIRES'],
+        )
+    raise ValueError(f'Unknown STORAGE_BACKEND: {backend}')
@@ -0,0 +1,176 @@
+import json
+import time
+from contextlib import contextmanager
+from flask import g, request, has_request_context, before_render_template, template_rendered
+from flask.json.provider import DefaultJSONProvider
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Mapper
+from app import app
+
+###### SERVER TIMING ######
+# Where a request's time goes, sent back in a Server-Timing header (browsers show it in the
+# request's Timing tab) and logged at info level as one JSON line:
+#   db         running SQL statements, on any engine
+#   orm        fetching the rows and building objects from them, outside the SQL itself
+#   render     Jinja templates, less the SQL and ORM work of the lazy loads they trigger
+#   serialize  jsonify and the encoding of the cached recipe payloads
+#   app        the rest, from the first before_request to the last after_request
+# Every phase counts only its own time, nested phases are taken off, so they add up to total.
+# With SERVER_TIMING off no request gets a Timings and each hook returns after one lookup.
+
+PHASES = ('db', 'orm', 'render', 'serialize')
+
+
+class Timings:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.seconds = dict.fromkeys(PHASES, 0.0)
+        self.queries = 0
+        self.last_row = None  # when the last statement finished or the last object was loaded
+        self._running = []  # [phase, started, seconds of the phases nested in it]
+
+    def start(self, phase):
+        self.last_row = None
+        self._running.append([phase, time.perf_counter(), 0.0])
+
+    def stop(self, phase):
+        self.last_row = None
+        # a phase that never stopped (a template that raised) is dropped with it
+        if not any(running[0] == phase for running in self._running):
+            return
+        while self._running:
+            name, started, nested = self._running.pop()
+            if name == phase:
+                elapsed = time.perf_counter() - started
+                self.seconds[phase] += elapsed - nested
+                if self._running:
+                    self._running[-1][2] += elapsed
+                return
+
+    def add(self, phase, seconds):
+        # time measured outside start/stop, taken off the running phase like a nested one
+        self.seconds[phase] += seconds
+        if self._running:
+            self._running[-1][2] += seconds
+
+    def breakdown(self):
+        # {phase: seconds} including app, and the total
+        total = time.perf_counter() - self.started
+        seconds = dict(self.seconds, app=max(total - sum(self.seconds.values()), 0.0))
+        return seconds, total
+
+
+def current_timings():
+    if not has_request_context():
+        return None
+    return g.get('timings')
+
+
+@contextmanager
+def phase(name):
+    # with phase('serialize'): ... counts the block's time to name
+    timings = current_timings()
+    if timings is None:
+        yield
+        return
+    timings.start(name)
+    try:
+        yield
+    finally:
+        timings.stop(name)
+
+
+@app.before_request
+def start_timings():
+    if app.config['SERVER_TIMING']:
+        g.timings = Timings()
+
+
+@app.after_request
+def send_timings(response):
+    timings = current_timings()
+    if timings is None:
+        return response
+    seconds, total = timings.breakdown()
+    entries = [f'{name};dur={s * 1000:.1f}' for name, s in seconds.items()]
+    entries[0] += f';desc="{timings.queries} queries"'
+    entries.append(f'total;dur={total * 1000:.1f}')
+    response.headers.add('Server-Timing', ', '.join(entries))
+
+    app.logger.info('timing %s', json.dumps({
+        'method': request.method,
+        'route': request.url_rule.rule if request.url_rule is not None else None,
+        'status': response.status_code,
+        'queries': timings.queries,
+        **{f'{name}_ms': round(s * 1000, 2) for name, s in seconds.items()},
+        'total_ms': round(total * 1000, 2),
+    }))
+    return response
+
+
+###### PHASE HOOKS ######
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _start_db(conn, cursor, statement, parameters, context, executemany):
+    timings = current_timings()
+    if timings is not None:
+        timings.queries += 1
+        timings.start('db')
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _stop_db(conn, cursor, statement, parameters, context, executemany):
+    timings = current_timings()
+    if timings is not None:
+        timings.stop('db')
+        timings.last_row = time.perf_counter()
+
+
+@event.listens_for(Engine, 'handle_error')
+def _failed_db(context):
+    timings = current_timings()
+    # errors outside a statement (connecting) never started one
+    if timings is not None and context.statement is not None:
+        timings.stop('db')
+
+
+@event.listens_for(Mapper, 'load')
+@event.listens_for(Mapper, 'refresh')
+def _time_orm(target, *args):
+    # The ORM builds the objects while the caller fetches the rows, so there is no end of the
+    # phase to hook. Each loaded object counts the time since the statement finished or the
+    # object before it was loaded, unless another phase started or ended in between. Rows of
+    # objects already in the session load nothing and are counted with the next object that
+    # does, those after the last one are not counted.
+    timings = current_timings()
+    if timings is None:
+        return
+    now = time.perf_counter()
+    if timings.last_row is not None:
+        timings.add('orm', now - timings.last_row)
+    timings.last_row = now
+
+
+@before_render_template.connect_via(app)
+def _start_render(sender, template, context, **extra):
+    timings = current_timings()
+    if timings is not None:
+        timings.start('render')
+
+
+@template_rendered.connect_via(app)
+def _stop_render(sender, template, context, **extra):
+    timings = current_timings()
+    if timings is not None:
+        timings.stop('render')
+
+
+class TimedJSONProvider(DefaultJSONProvider):
+    # jsonify goes through app.json.dumps
+    def dumps(self, obj, **kwargs):
+        with phase('serialize'):
+            return super().dumps(obj, **kwargs)
+
+
+app.json = TimedJSONProvider(app)
@@ -1,13 +1,28 @@
 import os
+import hashlib
+import json
 from app import app, models, db, admin
-from flask import render_template, flash, request, redirect, url_for, jsonify
+from flask import render_template, flash, request, redirect, url_for, jsonify, send_from_directory, abort
 from flask_login import LoginManager, login_user, logout_user, login_required, current_user
 from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.utils import secure_filename
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload
 from flask_admin.contrib.sqla import ModelView
 from flask_admin.form import Select2Widget
-from .models import User, Recipe, SavedRecipe, Like, Comment
+from .models import User, Recipe, SavedRecipe, Like, Comment, StoredImage
 from .forms import NewRecipeForm, LoginForm, RegisterForm
+from .search import search_recipes
+from .images import InvalidImage
+from .storage import attach_image, detach_image, collect_unused_images, image_sources, recipe_image_url, CARD_SIZES
+from .database import read_replica, recently_wrote, insert_ignoring_conflicts
+from .sqlstats import sql_budget
+from .metrics import count_toggle
+from .timing import phase
+from .cache import recipe_cache, recipe_generations, recipe_key, invalidate_recipe
+from .comments import page_comments, comments_statement, cut_comments, serialize_comment, COMMENT_PAGE_SIZE
+from .events import event_stream, publish_recipe_event
+from .feed import build_feed, page_feed, request_liked_ids, request_saved_ids, PAGE_SIZE, MAX_PAGE_SIZE
 
 
 # Flask-Login setup
@@ -28,6 +43,7 @@ admin.add_view(ModelView(Recipe, db.session))
 admin.add_view(ModelView(SavedRecipe, db.session))
 admin.add_view(ModelView(Like, db.session))
 admin.add_view(ModelView(Comment, db.session))
+admin.add_view(ModelView(StoredImage, db.session))
 
 ###### HELPER FUNCTIONS ######
 # Check to see whether the file uploaded in add_recipes follows the right formatting
@@ -37,11 +53,63 @@ ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
+# The membership sets are loaded once per request so the filters dont touch recipe.likes/saved_by
 def user_has_liked(user, recipe):
-    return any(like.user_id == user.id for like in recipe.likes)
+    return user.is_authenticated and recipe.id in request_liked_ids(user)
 
 def user_has_saved(user, recipe):
-    return any(save.user_id == user.id for save in recipe.saved_by)
+    return user.is_authenticated and recipe.id in request_saved_ids(user)
+
+# Like/save toggles lean on the unique (user_id, recipe_id) indexes instead of read-then-write:
+# try to delete the row, and if there was nothing to delete insert it. A concurrent insert
+# of the same row is skipped by ON CONFLICT DO NOTHING (SQLite, PostgreSQL) or fails on the
+# index, either way it is treated as already toggled on.
+# Returns True when the row exists afterwards.
+# This and the other helpers taking a db_session are shared with the async views in asgi.py,
+# which run them on their AsyncSession with run_sync.
+def toggle_membership(db_session, model, counter, recipe, user):
+    deleted = db_session.execute(
+        db.delete(model).where(model.user_id == user.id, model.recipe_id == recipe.id)
+    ).rowcount
+    if deleted:
+        recipe.bump(counter, -deleted)
+        count_toggle(model, False)
+        db_session.commit()
+        return False
+
+    insert = insert_ignoring_conflicts(model, db_session.get_bind(model).dialect.name)
+    if insert is not None:
+        if db_session.execute(insert.values(user_id=user.id, recipe_id=recipe.id)).rowcount:
+            recipe.bump(counter, 1)
+            count_toggle(model, True)
+        db_session.commit()
+        return True
+
+    try:
+        db_session.add(model(user_id=user.id, recipe_id=recipe.id))
+        recipe.bump(counter, 1)
+        db_session.commit()
+        count_toggle(model, True)
+    except IntegrityError:
+        db_session.rollback()
+    return True
+
+# Toggle and tell the open pages the new count, returns (whether the row exists, the count)
+def toggle_recipe(db_session, model, counter, event, recipe, user):
+    recipe_id = recipe.id
+    member = toggle_membership(db_session, model, counter, recipe, user)
+    db_session.refresh(recipe, [counter])
+    count = getattr(recipe, counter)
+    publish_recipe_event(recipe_id, event, {counter: count})
+    return member, count
+
+def like(db_session, recipe, user):
+    liked, like_count = toggle_recipe(db_session, Like, 'like_count', 'likes', recipe, user)
+    return {'status': 'liked' if liked else 'unliked', 'like_count': like_count}
+
+def save(db_session, recipe, user):
+    saved, _ = toggle_recipe(db_session, SavedRecipe, 'save_count', 'saves', recipe, user)
+    return {'status': 'saved' if saved else 'unsaved'}
 
 @app.template_filter('has_liked')
 def user_has_liked_filter(recipe, user):
@@ -52,6 +120,16 @@ def user_has_saved_filter(recipe, user):
     return user_has_saved(user, recipe)
 
 
+# Uploaded images for the local storage backend when nothing in front of Flask serves UPLOAD_URL,
+# the path has the content hash in it so the files never change
+@app.route('/media/<path:filename>')
+def media(filename):
+    response = send_from_directory(app.config['UPLOAD_FOLDER'], filename, max_age=app.config['MEDIA_MAX_AGE'])
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+
 # This is our Home page
 @app.route('/')
 def index():
@@ -131,15 +209,16 @@ def add_recipe():
             user_id=current_user.id
         )
         if form.image.data:
-            # validate and save the image
+            # validate the image and save the resized copies of it
             filename = secure_filename(form.image.data.filename)
-            if allowed_file(filename):
-                filepath = os.path.join('app/static/uploads', filename)
-                form.image.data.save(filepath)
-                new_recipe.image_url = f'app/static/uploads/{filename}'
-            else:
+            if not allowed_file(filename):
                 flash('Invalid file type. Please upload an image file (png, jpg, jpeg, gif).', 'danger')
                 return redirect(request.url)
+            try:
+                attach_image(new_recipe, form.image.data.stream)
+            except InvalidImage:
+                flash('The uploaded file could not be read as an image.', 'danger')
+                return redirect(request.url)
 
         try:
             # save the recipe to the database
@@ -154,17 +233,20 @@ def add_recipe():
     return render_template('add_recipe.html', form=form)
 
 @app.route('/view_recipes')
+@sql_budget(2)
+@read_replica
 def view_recipes():
-    recipes = Recipe.query.order_by(Recipe.created_at.desc()).all()
-    return render_template('view_recipes.html', recipes=recipes)
+    # The list itself is paged in by actions.js from /filter_recipes
+    return render_template('view_recipes.html')
 
 
 @app.route('/my_recipes', methods=['GET'])
+@sql_budget(4)
 @login_required
 def my_recipes():
     # Look for the recipes created by the logged-in user
     recipes = Recipe.query.filter_by(user_id=current_user.id).order_by(Recipe.created_at.desc()).all()
-    return render_template('my_recipes.html', recipes=recipes)
+    return render_template('my_recipes.html', recipes=recipes, card_sizes=CARD_SIZES)
 
 @app.route('/edit_recipe/<int:recipe_id>', methods=['GET', 'POST'])
 @login_required
@@ -183,12 +265,20 @@ def edit_recipe(recipe_id):
         recipe.steps = form.steps.data
         if form.image.data:
             filename = secure_filename(form.image.data.filename)
-            filepath = os.path.join('app/static/uploads', filename)
-            form.image.data.save(filepath)
-            recipe.image_url = f'/static/uploads/{filename}'
+            if not allowed_file(filename):
+                flash('Invalid file type. Please upload an image file (png, jpg, jpeg, gif).', 'danger')
+                return redirect(request.url)
+            try:
+                attach_image(recipe, form.image.data.stream)
+            except InvalidImage:
+                flash('The uploaded file could not be read as an image.', 'danger')
+                return redirect(request.url)
         
         try:
             db.session.commit()
+            invalidate_recipe(recipe.id)
+            # a replaced image may not be used by anyone any more
+            collect_unused_images()
             flash('Recipe updated successfully ', 'success')
             return redirect(url_for('my_recipes'))
         except Exception as e:
@@ -206,8 +296,11 @@ def delete_recipe(recipe_id):
         return redirect(url_for('my_recipes'))
 
     try:
+        detach_image(recipe)
         db.session.delete(recipe)
         db.session.commit()
+        invalidate_recipe(recipe_id)
+        collect_unused_images()
         flash(f'Recipe "{recipe.title}" has been deleted.', 'success')
     except Exception as e:
         db.session.rollback()
@@ -217,86 +310,99 @@ def delete_recipe(recipe_id):
 
 
 @app.route('/like_recipe', methods=['POST'])
+@sql_budget(6)
 @login_required
 def like_recipe():
     data = request.get_json()
     recipe_id = data.get('recipe_id')
     recipe = Recipe.query.get_or_404(recipe_id)
 
-    # Checking if the user has liked the recipe
-    existing_like = Like.query.filter_by(user_id=current_user.id, recipe_id=recipe.id).first()
-    if existing_like:
-        # Unlike the recipe
-        db.session.delete(existing_like)
-        db.session.commit()
-        like_count = len(recipe.likes)  # Updated likes count
-        return jsonify({'status': 'unliked', 'like_count': like_count})
-    
-    # If they have liked the recipe
-    new_like = Like(user_id=current_user.id, recipe_id=recipe.id)
-    db.session.add(new_like)
-    db.session.commit()
-    like_count = len(recipe.likes)  # Updated likes count
-    return jsonify({'status': 'liked', 'like_count': like_count})
+    # Like or unlike the recipe, the counter is updated in the same transaction
+    return jsonify(like(db.session, recipe, current_user))
 
 
 @app.route('/save_recipe', methods=['POST'])
+@sql_budget(6)
 @login_required
 def save_recipe():
     data = request.get_json()
     recipe_id = data.get('recipe_id')
     recipe = Recipe.query.get_or_404(recipe_id)
 
-    #check if the user has already saved the recipe
-    existing_save = SavedRecipe.query.filter_by(user_id=current_user.id, recipe_id=recipe.id).first()
-    if existing_save:
-        # Remove from saved recipes
-        db.session.delete(existing_save)
-        db.session.commit()
-        return jsonify({'status': 'unsaved'})
-
-    # save the recipe
-    new_save = SavedRecipe(user_id=current_user.id, recipe_id=recipe.id)
-    db.session.add(new_save)
-    db.session.commit()
-    return jsonify({'status': 'saved'})
+    # Save the recipe or remove it from the saved recipes
+    return jsonify(save(db.session, recipe, current_user))
 
 @app.route('/saved_recipes', methods=['GET'])
+@sql_budget(6)
 @login_required
+@read_replica
 def saved_recipes():
     # get the recipes saved by the current user
-    saved_recipes = Recipe.query.join(SavedRecipe, Recipe.id == SavedRecipe.recipe_id) \
-                                .filter(SavedRecipe.user_id == current_user.id).all()
+    query = Recipe.query.join(SavedRecipe, Recipe.id == SavedRecipe.recipe_id) \
+                        .filter(SavedRecipe.user_id == current_user.id)
+    saved_recipes = build_feed(query, current_user)
     return render_template('saved_recipes.html', saved_recipes=saved_recipes)
 
 @app.route('/get_recipe_details', methods=['GET'])
+@sql_budget(3)
 def get_recipe_details():
     recipe_id = request.args.get('recipe_id', type=int)
-    recipe = Recipe.query.get_or_404(recipe_id)
-
-    # fetch comments and serialize them
-    comments_data = []
-    comments = Comment.query.filter_by(recipe_id=recipe_id).order_by(Comment.created_at.asc()).all()
-    for c in comments:
-        comments_data.append({
-            'author': c.user.username,
-            'content': c.content,
-            'created_at': c.created_at.strftime("%Y-%m-%d %H:%M:%S")
-        })
 
+    # The payload is the same for every user, so the serialized body is cached and shared.
+    # edit_recipe, delete_recipe and add_comment invalidate it after they commit. It is
+    # loaded from the primary: a replica that is behind would put the old recipe back in the
+    # cache under the new generation. The cache stands in for the replica here.
+    # A user who just wrote skips the cache, other workers' local entries can still be old.
+    generation, cached = cached_recipe_details(recipe_id)
+    if cached is None:
+        cached = cache_recipe_details(recipe_id, generation, recipe_details_body(db.session, recipe_id))
+    return recipe_details_response(*cached)
+
+def cached_recipe_details(recipe_id):
+    # Returns the cache generation to fill (None to skip the cache) and the cached (body, etag)
+    generation = None if recently_wrote() else recipe_generations.get(recipe_id)
+    cached = recipe_cache.get(recipe_key(recipe_id, generation)) if generation is not None else None
+    return generation, cached
+
+def cache_recipe_details(recipe_id, generation, details):
+    if generation is not None:
+        recipe_cache.set(recipe_key(recipe_id, generation), details)
+    return details
+
+def recipe_details_response(body, etag):
+    # the client revalidates every time and gets a 304 without a body while nothing changed
+    response = app.response_class(body, mimetype='application/json')
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response.make_conditional(request)
+
+def recipe_details_body(db_session, recipe_id):
+    # Returns the (body, etag) pair for get_recipe_details
+    recipe = db_session.get(Recipe, recipe_id, options=[joinedload(Recipe.author)])
+    if recipe is None:
+        abort(404)
+
+    # only the first page of comments, the rest come from /comments
+    comments = db_session.scalars(comments_statement(recipe_id)).all()
+    comments_data, comments_cursor = cut_comments(comments, COMMENT_PAGE_SIZE)
     recipe_data = {
         'title': recipe.title,
         'author': recipe.author.username,
         'description': recipe.description,
         'ingredients': recipe.ingredients,
         'steps': recipe.steps,
-        'image_url': recipe.image_url,
-        'comments': comments_data
+        'image_url': recipe_image_url(recipe),
+        'image_sources': image_sources(recipe),
+        'comments': comments_data,
+        'comments_cursor': comments_cursor
     }
 
-    return jsonify(recipe_data)
+    with phase('serialize'):
+        body = json.dumps(recipe_data).encode()
+    return body, hashlib.sha1(body).hexdigest()
 
 @app.route('/add_comment', methods=['POST'])
+@sql_budget(7)
 @login_required
 def add_comment():
     data = request.get_json()
@@ -307,67 +413,110 @@ def add_comment():
     
     recipe = Recipe.query.get_or_404(recipe_id)
 
-    # Create the new comment
-    new_comment = Comment(user_id=current_user.id, recipe_id=recipe_id, content=content)
-    db.session.add(new_comment)
-    db.session.commit()
+    # only the new comment, the page already has the others
+    return jsonify({'status': 'success', 'comment': post_comment(db.session, recipe, current_user, content)})
+
+def post_comment(db_session, recipe, user, content):
+    # Adds the comment and tells the open pages, returns it serialized
+    recipe_id = recipe.id
+    new_comment = Comment(user_id=user.id, recipe_id=recipe_id, content=content)
+    db_session.add(new_comment)
+    recipe.bump('comment_count', 1)
+    db_session.commit()
+    invalidate_recipe(recipe_id)
+
+    comment_data = serialize_comment(new_comment)
+    publish_recipe_event(recipe_id, 'comment', {'comment': comment_data})
+    return comment_data
+
+@app.route('/comments', methods=['GET'])
+@sql_budget(2)
+@read_replica
+def get_comments():
+    recipe_id = request.args.get('recipe_id', type=int)
+    if recipe_id is None:
+        return jsonify({'status': 'error', 'message': 'recipe_id is required.'}), 400
+
+    # the page after the cursor sent back with the previous page, the first page without one
+    after = request.args.get('after')
+    limit = min(max(request.args.get('limit', COMMENT_PAGE_SIZE, type=int), 1), MAX_PAGE_SIZE)
+    try:
+        comments_data, next_cursor = page_comments(recipe_id, after, limit)
+    except ValueError:
+        return jsonify({'status': 'error', 'message': 'Invalid cursor.'}), 400
+
+    return jsonify({'comments': comments_data, 'next_cursor': next_cursor})
+
+###### LIVE UPDATES ######
+# Server-Sent Events for one recipe (the open modal) or for a list of them (the recipe list),
+# see app/events.py. Events are 'likes', 'saves' and 'comment'.
+
+# The async views of the same name in asgi.py pass async_event_stream instead.
+
+def event_response(stream):
+    response = app.response_class(stream, mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    # stop nginx from buffering the stream
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
 
-    # Return updated comments
-    comments_data = []
-    comments = Comment.query.filter_by(recipe_id=recipe_id).order_by(Comment.created_at.asc()).all()
-    for c in comments:
-        comments_data.append({
-            'author': c.user.username,
-            'content': c.content,
-            'created_at': c.created_at.strftime("%Y-%m-%d")
-        })
+def recipe_events_response(stream):
+    if not app.config['EVENTS_ENABLED']:
+        abort(404)
+    recipe_id = request.args.get('recipe_id', type=int)
+    if recipe_id is None:
+        return jsonify({'status': 'error', 'message': 'recipe_id is required.'}), 400
+    return event_response(stream([recipe_id]))
+
+def events_response(stream):
+    # recipe_ids is a comma separated list, e.g. /events?recipe_ids=1,2,3
+    if not app.config['EVENTS_ENABLED']:
+        abort(404)
+    try:
+        recipe_ids = {int(i) for i in request.args.get('recipe_ids', '').split(',') if i}
+    except ValueError:
+        return jsonify({'status': 'error', 'message': 'recipe_ids must be a list of numbers.'}), 400
+    if not recipe_ids or len(recipe_ids) > app.config['EVENTS_MAX_RECIPES']:
+        return jsonify({'status': 'error', 'message': 'Invalid number of recipes.'}), 400
+    return event_response(stream(recipe_ids))
 
-    return jsonify({'status': 'success', 'comments': comments_data})
+@app.route('/recipe_events', methods=['GET'])
+def recipe_events():
+    return recipe_events_response(event_stream)
+
+@app.route('/events', methods=['GET'])
+def events():
+    return events_response(event_stream)
 
 @app.route('/filter_recipes', methods=['GET'])
+@sql_budget(5)
+@read_replica
 def filter_recipes():
     sort_option = request.args.get('sort', 'all')
     search_query = request.args.get('q', '').strip()
     
     query = Recipe.query
     
-    # Filter by search query
+    # Filter by search query, full text on SQLite and PostgreSQL, ILIKE elsewhere
+    rank, highlights = None, {}
     if search_query:
-        query = query.filter(
-            (Recipe.title.ilike(f"%{search_query}%")) |
-            (Recipe.description.ilike(f"%{search_query}%"))
-        )
+        query, rank, highlights = search_recipes(query, search_query)
+
+    # Sorting and paging, a page starts after the cursor sent back with the previous page
+    cursor = request.args.get('cursor')
+    limit = min(max(request.args.get('limit', PAGE_SIZE, type=int), 1), MAX_PAGE_SIZE)
+    try:
+        # counts and the users like/save state are batched by the feed instead of loaded per recipe
+        recipe_data, next_cursor = page_feed(query, sort_option, current_user, cursor, limit, rank)
+    except ValueError:
+        return jsonify({'status': 'error', 'message': 'Invalid cursor.'}), 400
+
+    # matched text from the search index, if it gives us any
+    for r in recipe_data:
+        if r['id'] in highlights:
+            r['highlight'] = highlights[r['id']]
 
-    # Sorting
-    if sort_option == 'liked':
-        query = query.outerjoin(Like).group_by(Recipe.id).order_by(db.func.count(Like.id).desc())
-    elif sort_option == 'saved':
-        query = query.outerjoin(SavedRecipe).group_by(Recipe.id).order_by(db.func.count(SavedRecipe.id).desc())
-    elif sort_option == 'recent':
-        query = query.order_by(Recipe.created_at.desc())
-    else:
-        query = query.order_by(Recipe.id.asc())
-
-    recipes = query.all()
-
-    recipe_data = []
-    for r in recipes:
-        user_liked = False
-        user_saved = False
-        if current_user.is_authenticated:
-            user_liked = any(l.user_id == current_user.id for l in r.likes)
-            user_saved = any(s.user_id == current_user.id for s in r.saved_by)
-
-        recipe_data.append({
-            'id': r.id,
-            'title': r.title,
-            'author': r.author.username,
-            'like_count': len(r.likes),  # Include like_count
-            'user_liked': user_liked,
-            'user_saved': user_saved
-        })
-
-    return jsonify(recipe_data)
+    return jsonify({'recipes': recipe_data, 'next_cursor': next_cursor})
 
 
 
@@ -0,0 +1,3 @@
+from app.asgi import asgi_app as app
+
+# Run with an ASGI server, e.g.  uvicorn asgi:app --workers 4
@@ -0,0 +1,19 @@
+# `flask serve --worker-class gevent` re-runs the flask command through this file (app/server.py).
+# gevent has to patch socket, threading, queue and time before anything imports them, and
+# the flask command has imported the whole app by the time a command runs.
+from gevent import monkey
+monkey.patch_all()
+
+# psycopg2 waits on its sockets in C, psycogreen hands those waits to the gevent hub so one
+# query doesnt stall every other greenlet of the worker. There is nothing like it for sqlite3.
+try:
+    from psycogreen.gevent import patch_psycopg
+except ImportError:
+    pass
+else:
+    patch_psycopg()
+
+from flask.cli import main
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,42 @@
+"""recipe counters
+
+Revision ID: 3b9d2f6c1e47
+Revises: 08314651dc8d
+Create Date: 2026-10-18 10:12:31.402118
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3b9d2f6c1e47'
+down_revision = '08314651dc8d'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('recipes', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('like_count', sa.Integer(), server_default='0', nullable=False))
+        batch_op.add_column(sa.Column('save_count', sa.Integer(), server_default='0', nullable=False))
+        batch_op.add_column(sa.Column('comment_count', sa.Integer(), server_default='0', nullable=False))
+        batch_op.create_index('ix_recipes_like_count_id', ['like_count', 'id'], unique=False)
+        batch_op.create_index('ix_recipes_save_count_id', ['save_count', 'id'], unique=False)
+
+    # Backfill the counters from the rows that already exist
+    op.execute(
+        "UPDATE recipes SET "
+        "like_count = (SELECT count(*) FROM likes WHERE likes.recipe_id = recipes.id), "
+        "save_count = (SELECT count(*) FROM saved_recipes WHERE saved_recipes.recipe_id = recipes.id), "
+        "comment_count = (SELECT count(*) FROM comments WHERE comments.recipe_id = recipes.id)"
+    )
+
+
+def downgrade():
+    with op.batch_alter_table('recipes', schema=None) as batch_op:
+        batch_op.drop_index('ix_recipes_save_count_id')
+        batch_op.drop_index('ix_recipes_like_count_id')
+        batch_op.drop_column('comment_count')
+        batch_op.drop_column('save_count')
+        batch_op.drop_column('like_count')
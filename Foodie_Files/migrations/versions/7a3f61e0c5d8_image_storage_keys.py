@@ -0,0 +1,56 @@
+"""image storage keys
+
+Revision ID: 7a3f61e0c5d8
+Revises: e2d94c7b1a60
+Create Date: 2026-10-18 16:08:35.904417
+
+"""
+import json
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7a3f61e0c5d8'
+down_revision = 'e2d94c7b1a60'
+branch_labels = None
+depends_on = None
+
+
+# Renditions used to hold /media/... URLs, they now hold storage keys and the URL is
+# worked out by the storage backend when the page is rendered
+MEDIA_PREFIX = '/media/'
+
+
+def _to_key(url):
+    return url[len(MEDIA_PREFIX):] if url.startswith(MEDIA_PREFIX) else url
+
+
+def _to_url(key):
+    return key if key.startswith(MEDIA_PREFIX) else MEDIA_PREFIX + key
+
+
+def _rewrite(table, id_column, renditions_column, convert):
+    conn = op.get_bind()
+    rows = conn.execute(sa.text(
+        f"SELECT {id_column}, {renditions_column} FROM {table} WHERE {renditions_column} IS NOT NULL"
+    )).fetchall()
+    for row_id, renditions in rows:
+        renditions = json.loads(renditions) if isinstance(renditions, str) else renditions
+        for rendition in renditions.values():
+            for fmt in ('webp', 'jpeg'):
+                rendition[fmt] = convert(rendition[fmt])
+        conn.execute(
+            sa.text(f"UPDATE {table} SET {renditions_column} = :renditions WHERE {id_column} = :row_id"),
+            {'renditions': json.dumps(renditions), 'row_id': row_id}
+        )
+
+
+def upgrade():
+    _rewrite('stored_images', 'hash', 'renditions', _to_key)
+    _rewrite('recipes', 'id', 'image_renditions', _to_key)
+
+
+def downgrade():
+    _rewrite('recipes', 'id', 'image_renditions', _to_url)
+    _rewrite('stored_images', 'hash', 'renditions', _to_url)
@@ -0,0 +1,62 @@
+"""toggle and lookup indexes
+
+Revision ID: a71c5e0d9b28
+Revises: 3b9d2f6c1e47
+Create Date: 2026-10-18 11:04:52.118930
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a71c5e0d9b28'
+down_revision = '3b9d2f6c1e47'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Double clicks could have left duplicate likes/saves, keep the first of each before
+    # the unique indexes go on and recount the recipes that were affected
+    op.execute(
+        "DELETE FROM likes WHERE id NOT IN "
+        "(SELECT min(id) FROM likes GROUP BY user_id, recipe_id)"
+    )
+    op.execute(
+        "DELETE FROM saved_recipes WHERE id NOT IN "
+        "(SELECT min(id) FROM saved_recipes GROUP BY user_id, recipe_id)"
+    )
+    op.execute(
+        "UPDATE recipes SET "
+        "like_count = (SELECT count(*) FROM likes WHERE likes.recipe_id = recipes.id), "
+        "save_count = (SELECT count(*) FROM saved_recipes WHERE saved_recipes.recipe_id = recipes.id)"
+    )
+
+    with op.batch_alter_table('likes', schema=None) as batch_op:
+        batch_op.create_index('ix_likes_user_id_recipe_id', ['user_id', 'recipe_id'], unique=True)
+
+    with op.batch_alter_table('saved_recipes', schema=None) as batch_op:
+        batch_op.create_index('ix_saved_recipes_user_id_recipe_id', ['user_id', 'recipe_id'], unique=True)
+
+    with op.batch_alter_table('recipes', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_recipes_user_id'), ['user_id'], unique=False)
+        batch_op.create_index(batch_op.f('ix_recipes_created_at'), ['created_at'], unique=False)
+
+    with op.batch_alter_table('comments', schema=None) as batch_op:
+        batch_op.create_index('ix_comments_recipe_id_created_at', ['recipe_id', 'created_at'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('comments', schema=None) as batch_op:
+        batch_op.drop_index('ix_comments_recipe_id_created_at')
+
+    with op.batch_alter_table('recipes', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_recipes_created_at'))
+        batch_op.drop_index(batch_op.f('ix_recipes_user_id'))
+
+    with op.batch_alter_table('saved_recipes', schema=None) as batch_op:
+        batch_op.drop_index('ix_saved_recipes_user_id_recipe_id')
+
+    with op.batch_alter_table('likes', schema=None) as batch_op:
+        batch_op.drop_index('ix_likes_user_id_recipe_id')
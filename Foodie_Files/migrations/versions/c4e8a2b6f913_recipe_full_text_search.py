@@ -0,0 +1,59 @@
+"""recipe full text search
+
+Revision ID: c4e8a2b6f913
+Revises: a71c5e0d9b28
+Create Date: 2026-10-18 12:21:07.550214
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c4e8a2b6f913'
+down_revision = 'a71c5e0d9b28'
+branch_labels = None
+depends_on = None
+
+
+# FTS5 is SQLite only, PostgreSQL gets a tsvector column in d3b7f0a4c915 (see app/search.py)
+def upgrade():
+    if op.get_bind().dialect.name != 'sqlite':
+        return
+
+    op.execute(
+        "CREATE VIRTUAL TABLE recipes_fts USING fts5("
+        "title, description, ingredients, steps, "
+        "content='recipes', content_rowid='id', tokenize='porter unicode61', prefix='2 3')"
+    )
+    op.execute(
+        "CREATE TRIGGER recipes_fts_ai AFTER INSERT ON recipes BEGIN "
+        "INSERT INTO recipes_fts(rowid, title, description, ingredients, steps) "
+        "VALUES (new.id, new.title, new.description, new.ingredients, new.steps); END"
+    )
+    op.execute(
+        "CREATE TRIGGER recipes_fts_ad AFTER DELETE ON recipes BEGIN "
+        "INSERT INTO recipes_fts(recipes_fts, rowid, title, description, ingredients, steps) "
+        "VALUES ('delete', old.id, old.title, old.description, old.ingredients, old.steps); END"
+    )
+    op.execute(
+        "CREATE TRIGGER recipes_fts_au AFTER UPDATE OF title, description, ingredients, steps "
+        "ON recipes BEGIN "
+        "INSERT INTO recipes_fts(recipes_fts, rowid, title, description, ingredients, steps) "
+        "VALUES ('delete', old.id, old.title, old.description, old.ingredients, old.steps); "
+        "INSERT INTO recipes_fts(rowid, title, description, ingredients, steps) "
+        "VALUES (new.id, new.title, new.description, new.ingredients, new.steps); END"
+    )
+
+    # index the recipes that are already there
+    op.execute("INSERT INTO recipes_fts(recipes_fts) VALUES ('rebuild')")
+
+
+def downgrade():
+    if op.get_bind().dialect.name != 'sqlite':
+        return
+
+    op.execute("DROP TRIGGER IF EXISTS recipes_fts_au")
+    op.execute("DROP TRIGGER IF EXISTS recipes_fts_ad")
+    op.execute("DROP TRIGGER IF EXISTS recipes_fts_ai")
+    op.execute("DROP TABLE IF EXISTS recipes_fts")
@@ -0,0 +1,40 @@
+"""postgresql search vector
+
+Revision ID: d3b7f0a4c915
+Revises: 7a3f61e0c5d8
+Create Date: 2026-10-18 19:42:13.118604
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd3b7f0a4c915'
+down_revision = '7a3f61e0c5d8'
+branch_labels = None
+depends_on = None
+
+
+# The PostgreSQL counterpart of recipes_fts (c4e8a2b6f913), SQLite has nothing to do.
+# The generated column is filled in for the existing recipes as it is added.
+def upgrade():
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+
+    op.execute(
+        "ALTER TABLE recipes ADD COLUMN search_vector tsvector GENERATED ALWAYS AS ("
+        "setweight(to_tsvector('english', coalesce(title, '')), 'A') || "
+        "setweight(to_tsvector('english', coalesce(description, '')), 'B') || "
+        "setweight(to_tsvector('english', coalesce(ingredients, '')), 'C') || "
+        "setweight(to_tsvector('english', coalesce(steps, '')), 'D')) STORED"
+    )
+    op.execute("CREATE INDEX ix_recipes_search_vector ON recipes USING gin (search_vector)")
+
+
+def downgrade():
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+
+    op.execute("DROP INDEX IF EXISTS ix_recipes_search_vector")
+    op.execute("ALTER TABLE recipes DROP COLUMN IF EXISTS search_vector")
@@ -0,0 +1,81 @@
+import os
+import tempfile
+import pytest
+
+# app.config is loaded from config.py on import, so the scratch database (and the read only
+# replica bind on the same file) is put there before anything imports the app
+import config
+_scratch = tempfile.mkdtemp(prefix='foodie-tests-')
+config.SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(_scratch, 'app.db')
+config.SQLALCHEMY_BINDS = {'replica': 'sqlite:///file:' + os.path.join(_scratch, 'app.db') + '?mode=ro&uri=true'}
+
+from flask_migrate import upgrade
+from werkzeug.security import generate_password_hash
+from app import app as flask_app, db
+from app.cache import recipe_cache
+from app.models import User, Recipe
+
+PASSWORD = 'password123'
+
+
+@pytest.fixture(scope='session')
+def app():
+    flask_app.config.update(TESTING=True, WTF_CSRF_ENABLED=False, SESSION_COOKIE_SECURE=False)
+    with flask_app.app_context():
+        upgrade(directory=os.path.join(os.path.dirname(flask_app.root_path), 'migrations'))
+    return flask_app
+
+
+@pytest.fixture(autouse=True)
+def clean_database(app):
+    yield
+    with app.app_context():
+        db.session.remove()
+        for table in reversed(db.metadata.sorted_tables):
+            db.session.execute(table.delete())
+        db.session.commit()
+    recipe_cache.tiers[0].clear()
+    app.config['SQL_BUDGETS'] = {}
+
+
+def add_user(name):
+    user = User(username=name, email=f'{name}@example.com',
+                password_hash=generate_password_hash(PASSWORD, method='pbkdf2:sha256'))
+    db.session.add(user)
+    db.session.commit()
+    # loaded now so the object stays usable once the app context is gone
+    db.session.refresh(user)
+    return user
+
+
+def add_recipe(user, title='Pasta'):
+    recipe = Recipe(title=title, description='tasty', ingredients='flour eggs', steps='mix cook', user_id=user.id)
+    db.session.add(recipe)
+    db.session.commit()
+    db.session.refresh(recipe)
+    return recipe
+
+
+def log_in(client, user):
+    response = client.post('/login', data={'email': user.email, 'password': PASSWORD})
+    assert response.status_code == 302
+
+
+@pytest.fixture
+def user(app):
+    with app.app_context():
+        return add_user('cook')
+
+
+@pytest.fixture
+def recipe(app, user):
+    with app.app_context():
+        return add_recipe(user)
+
+
+@pytest.fixture
+def client(app, user):
+    # logged in as user
+    client = app.test_client()
+    log_in(client, user)
+    return client
@@ -0,0 +1,89 @@
+import asyncio
+import httpx
+from app.asgi import asgi_app, close_database
+from app.cache import recipe_cache
+from app.events import broker, publish_recipe_event
+from conftest import PASSWORD
+
+
+def run(test):
+    # each test gets its own event loop, the async engine is made again in it
+    async def main():
+        try:
+            await test()
+        finally:
+            await close_database()
+    asyncio.run(main())
+
+
+def asgi_client():
+    return httpx.AsyncClient(transport=httpx.ASGITransport(app=asgi_app), base_url='http://localhost')
+
+
+def test_async_views_share_the_sync_behaviour(app, user, recipe):
+    async def test():
+        async with asgi_client() as client:
+            # the login page is the Flask app run through the WSGI adapter
+            login = await client.post('/login', data={'email': user.email, 'password': PASSWORD})
+            assert login.status_code == 302
+
+            like = await client.post('/like_recipe', json={'recipe_id': recipe.id})
+            assert like.json() == {'status': 'liked', 'like_count': 1}
+            unlike = await client.post('/like_recipe', json={'recipe_id': recipe.id})
+            assert unlike.json() == {'status': 'unliked', 'like_count': 0}
+            saved = await client.post('/save_recipe', json={'recipe_id': recipe.id})
+            assert saved.json() == {'status': 'saved'}
+
+            comment = await client.post('/add_comment', json={'recipe_id': recipe.id, 'content': 'lovely'})
+            assert comment.json()['comment']['author'] == user.username
+
+            details = await client.get('/get_recipe_details', params={'recipe_id': recipe.id})
+            assert details.status_code == 200
+            assert [c['content'] for c in details.json()['comments']] == ['lovely']
+            again = await client.get('/get_recipe_details', params={'recipe_id': recipe.id},
+                                     headers={'If-None-Match': details.headers['ETag']})
+            assert again.status_code == 304
+            # the commits above marked the session as a recent writer, so nothing was cached
+            assert not recipe_cache.tiers[0]
+
+            feed = await client.get('/filter_recipes')
+            assert [(r['id'], r['user_saved']) for r in feed.json()['recipes']] == [(recipe.id, True)]
+
+            missing = await client.get('/get_recipe_details', params={'recipe_id': recipe.id + 1})
+            assert missing.status_code == 404
+    run(test)
+
+
+def test_event_stream_is_served_natively(app, recipe):
+    # httpx reads a whole ASGI response before returning it, so the stream is driven by hand
+    async def test():
+        sent = []
+        requests = [{'type': 'http.request', 'body': b''}]
+        gone = asyncio.Event()
+
+        async def receive():
+            if requests:
+                return requests.pop()
+            await gone.wait()
+            return {'type': 'http.disconnect'}
+
+        async def send(message):
+            sent.append(message)
+
+        scope = {'type': 'http', 'method': 'GET', 'path': '/recipe_events', 'http_version': '1.1',
+                 'query_string': f'recipe_id={recipe.id}'.encode(), 'headers': [], 'scheme': 'http',
+                 'server': ('localhost', 80)}
+        served = asyncio.ensure_future(asgi_app(scope, receive, send))
+        await asyncio.sleep(0.1)
+        assert sent[0]['status'] == 200
+        assert dict(sent[0]['headers'])[b'content-type'].startswith(b'text/event-stream')
+
+        publish_recipe_event(recipe.id, 'likes', {'like_count': 3})
+        await asyncio.sleep(0.1)
+        body = b''.join(message.get('body', b'') for message in sent[1:])
+        assert b'event: likes' in body and b'"like_count": 3' in body
+
+        gone.set()
+        await asyncio.wait_for(served, 2)
+        assert not broker._subscribers
+    run(test)
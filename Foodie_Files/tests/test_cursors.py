@@ -0,0 +1,76 @@
+import base64
+import json
+from datetime import datetime
+import pytest
+from app import db
+from app.models import Comment
+from app.feed import encode_cursor, decode_cursor
+from conftest import add_recipe
+
+
+@pytest.mark.parametrize('sort_option, sort_value', [
+    ('recent', datetime(2024, 5, 1, 12, 30, 15, 123456)),
+    ('liked', 7),
+])
+def test_cursor_round_trip(sort_option, sort_value):
+    assert decode_cursor(encode_cursor(sort_value, 42), sort_option) == (sort_value, 42)
+
+
+def raw_cursor(value):
+    return base64.urlsafe_b64encode(json.dumps(value).encode()).decode()
+
+
+@pytest.mark.parametrize('cursor, sort_option', [
+    ('not a cursor', 'recent'),
+    (raw_cursor({'a': 1}), 'liked'),
+    (raw_cursor([1, 2, 3]), 'liked'),
+    (raw_cursor(['seven', 1]), 'liked'),
+    (raw_cursor([1.5, 1]), 'liked'),
+    (raw_cursor([7, '1']), 'liked'),
+    (raw_cursor(['yesterday', 1]), 'recent'),
+])
+def test_bad_cursors_are_rejected(cursor, sort_option):
+    with pytest.raises(ValueError):
+        decode_cursor(cursor, sort_option)
+
+
+@pytest.mark.parametrize('sort_option', ['all', 'recent', 'liked'])
+def test_feed_pages_through_every_recipe_once(app, client, user, sort_option):
+    with app.app_context():
+        ids = {add_recipe(user, f'Pasta {i}').id for i in range(7)}
+
+    seen, cursor = [], None
+    while True:
+        params = {'sort': sort_option, 'limit': 3, **({'cursor': cursor} if cursor else {})}
+        page = client.get('/filter_recipes', query_string=params).json
+        seen.extend(r['id'] for r in page['recipes'])
+        cursor = page['next_cursor']
+        if cursor is None:
+            break
+    assert sorted(seen) == sorted(ids)
+
+
+def test_feed_rejects_a_bad_cursor(client):
+    response = client.get('/filter_recipes', query_string={'cursor': 'garbage'})
+    assert response.status_code == 400
+
+
+def test_comments_page_through_every_comment_once(app, client, user, recipe):
+    with app.app_context():
+        db.session.add_all(Comment(user_id=user.id, recipe_id=recipe.id, content=f'c{i}') for i in range(5))
+        db.session.commit()
+
+    seen, cursor = [], None
+    while True:
+        params = {'recipe_id': recipe.id, 'limit': 2, **({'after': cursor} if cursor else {})}
+        page = client.get('/comments', query_string=params).json
+        seen.extend(c['content'] for c in page['comments'])
+        cursor = page['next_cursor']
+        if cursor is None:
+            break
+    assert seen == [f'c{i}' for i in range(5)]
+
+
+def test_comments_reject_a_bad_cursor(client, recipe):
+    response = client.get('/comments', query_string={'recipe_id': recipe.id, 'after': raw_cursor([1, 1])})
+    assert response.status_code == 400
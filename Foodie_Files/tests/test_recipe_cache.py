@@ -0,0 +1,63 @@
+from app import app as flask_app
+from app.cache import recipe_cache, recipe_generations, recipe_key, invalidate_recipe
+from conftest import add_user, log_in
+
+
+def details(client, recipe_id, etag=None):
+    headers = {'If-None-Match': etag} if etag else {}
+    return client.get('/get_recipe_details', query_string={'recipe_id': recipe_id}, headers=headers)
+
+
+def test_unchanged_recipe_answers_304(app, recipe):
+    reader = app.test_client()
+    first = details(reader, recipe.id)
+    assert first.status_code == 200
+    assert first.headers['Cache-Control'] == 'no-cache'
+    again = details(reader, recipe.id, first.headers['ETag'])
+    assert again.status_code == 304
+    assert again.data == b''
+
+
+def test_new_comment_changes_the_etag(app, recipe):
+    reader = app.test_client()
+    first = details(reader, recipe.id)
+
+    writer = app.test_client()
+    with app.app_context():
+        log_in(writer, add_user('critic'))
+    assert writer.post('/add_comment', json={'recipe_id': recipe.id, 'content': 'lovely'}).status_code == 200
+
+    after = details(reader, recipe.id, first.headers['ETag'])
+    assert after.status_code == 200
+    assert after.headers['ETag'] != first.headers['ETag']
+    assert [c['content'] for c in after.json['comments']] == ['lovely']
+
+
+def test_invalidation_bumps_the_generation(app, recipe):
+    reader = app.test_client()
+    details(reader, recipe.id)
+    generation = recipe_generations.get(recipe.id)
+    assert recipe_cache.get(recipe_key(recipe.id, generation)) is not None
+
+    invalidate_recipe(recipe.id)
+    assert recipe_generations.get(recipe.id) == generation + 1
+    assert recipe_cache.get(recipe_key(recipe.id, generation)) is None
+
+
+def test_fill_that_raced_an_invalidation_is_never_served(app, recipe):
+    # a request read the generation and loaded the recipe, then an edit committed
+    generation = recipe_generations.get(recipe.id)
+    invalidate_recipe(recipe.id)
+    recipe_cache.set(recipe_key(recipe.id, generation), (b'{"title": "stale"}', 'stale'))
+
+    response = details(app.test_client(), recipe.id)
+    assert response.json['title'] == recipe.title
+
+
+def test_recent_writer_skips_the_cache(app, client, recipe):
+    client.post('/like_recipe', json={'recipe_id': recipe.id})
+    stale = (b'{"title": "stale"}', 'stale')
+    recipe_cache.set(recipe_key(recipe.id, recipe_generations.get(recipe.id)), stale)
+
+    assert details(client, recipe.id).json['title'] == recipe.title
+    assert details(app.test_client(), recipe.id).json['title'] == 'stale'
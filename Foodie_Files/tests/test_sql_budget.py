@@ -0,0 +1,24 @@
+import pytest
+from app.sqlstats import SQLBudgetExceeded
+
+
+def test_within_budget(app, client, recipe):
+    response = client.get('/get_recipe_details', query_string={'recipe_id': recipe.id})
+    assert response.status_code == 200
+    assert int(response.headers['X-DB-Queries']) <= 3
+
+
+def test_overrun_raises_when_testing(app, client, recipe):
+    app.config['SQL_BUDGETS'] = {'get_recipe_details': 1}
+    with pytest.raises(SQLBudgetExceeded, match='get_recipe_details ran \\d+ queries, its budget is 1'):
+        client.get('/get_recipe_details', query_string={'recipe_id': recipe.id})
+
+
+def test_overrun_only_warns_outside_tests(app, client, recipe, caplog):
+    app.config.update(SQL_BUDGETS={'get_recipe_details': 1}, TESTING=False)
+    try:
+        response = client.get('/get_recipe_details', query_string={'recipe_id': recipe.id})
+    finally:
+        app.config['TESTING'] = True
+    assert response.status_code == 200
+    assert 'its budget is 1' in caplog.text
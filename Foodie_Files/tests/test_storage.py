@@ -0,0 +1,96 @@
+import io
+import pytest
+from PIL import Image
+from app import db, storage as images
+from app.models import StoredImage
+from app.storage_backends import StorageBackend, LocalStorage
+
+
+@pytest.fixture
+def storage(tmp_path):
+    return LocalStorage(str(tmp_path / 'media'), '/media/')
+
+
+def test_keys_map_under_the_root(storage, tmp_path):
+    assert storage.path('images/ab/cd.jpg') == str(tmp_path / 'media' / 'images' / 'ab' / 'cd.jpg')
+    assert storage.url('images/ab/cd.jpg') == '/media/images/ab/cd.jpg'
+
+
+@pytest.mark.parametrize('key', ['..', '../secret', 'images/../../secret', 'images/../..', ''])
+def test_keys_outside_the_root_are_refused(storage, key):
+    with pytest.raises(ValueError):
+        storage.path(key)
+
+
+def test_save_outside_the_root_writes_nothing(storage, tmp_path):
+    with pytest.raises(ValueError):
+        storage.save('../escaped.jpg', io.BytesIO(b'data'))
+    assert not (tmp_path / 'escaped.jpg').exists()
+
+
+def test_save_round_trip(storage):
+    storage.save('images/ab/cd.jpg', io.BytesIO(b'data'))
+    assert storage.exists('images/ab/cd.jpg')
+    storage.delete_prefix('images/ab')
+    assert not storage.exists('images/ab/cd.jpg')
+
+
+def test_backends_implement_every_operation():
+    class UrlsOnly(StorageBackend):
+        def url(self, key):
+            return key
+
+    with pytest.raises(TypeError, match='save'):
+        UrlsOnly()
+
+
+###### IMAGE STORE ######
+
+@pytest.fixture
+def image_store(app, storage, monkeypatch):
+    monkeypatch.setattr(images, 'storage', storage)
+    with app.app_context():
+        yield images
+
+
+def upload():
+    data = io.BytesIO()
+    Image.new('RGB', (64, 48), 'red').save(data, 'JPEG')
+    data.seek(0)
+    return data
+
+
+def test_upload_racing_the_collector_stores_the_image_again(image_store, storage, monkeypatch):
+    first = image_store.store_image(upload())
+    image_store.release_image(first.hash)
+    db.session.commit()
+
+    take_reference = image_store.take_reference
+
+    def collected_first(digest, renditions=None):
+        # what collect_unused_images does between store_image's lookup and its reference
+        db.session.execute(db.delete(StoredImage).where(StoredImage.hash == digest))
+        storage.delete_prefix(image_store.image_key(digest))
+        monkeypatch.setattr(image_store, 'take_reference', take_reference)
+        return take_reference(digest, renditions)
+
+    monkeypatch.setattr(image_store, 'take_reference', collected_first)
+    stored = image_store.store_image(upload())
+    db.session.commit()
+    assert stored.hash == first.hash and stored.ref_count == 1
+    assert storage.exists(stored.renditions['full']['jpeg'])
+
+
+def test_collect_keeps_referenced_images(image_store, storage):
+    unused = image_store.store_image(upload())
+    digest, full = unused.hash, unused.renditions['full']['jpeg']
+    image_store.release_image(digest)
+    db.session.commit()
+    assert image_store.collect_unused_images() == 1
+    assert db.session.get(StoredImage, digest) is None
+    assert not storage.exists(full)
+
+    used = image_store.store_image(upload())
+    db.session.commit()
+    assert image_store.collect_unused_images(everything=True) == 0
+    assert storage.exists(used.renditions['full']['jpeg'])
@@ -0,0 +1,33 @@
+import re
+import pytest
+from conftest import add_recipe
+
+
+@pytest.fixture
+def timed(app):
+    app.config['SERVER_TIMING'] = True
+    yield
+    app.config['SERVER_TIMING'] = False
+
+
+def durations(response):
+    return {name: float(ms) for name, ms in re.findall(r'(\w+);dur=([\d.]+)', response.headers['Server-Timing'])}
+
+
+def test_off_by_default(app, client, recipe):
+    response = client.get('/filter_recipes')
+    assert response.status_code == 200
+    assert 'Server-Timing' not in response.headers
+
+
+def test_phases_add_up(app, client, user, timed):
+    with app.app_context():
+        for i in range(20):
+            add_recipe(user, title=f'Recipe {i}')
+    response = client.get('/filter_recipes')
+    assert response.status_code == 200
+    assert len(response.get_json()['recipes']) == 20
+    timings = durations(response)
+    assert timings['db'] > 0 and timings['orm'] > 0
+    assert sum(timings[name] for name in ('db', 'orm', 'render', 'serialize', 'app')) == pytest.approx(timings['total'], abs=0.5)
+
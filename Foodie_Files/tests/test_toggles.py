@@ -0,0 +1,51 @@
+import pytest
+from app import db
+from app.models import Recipe, Like, SavedRecipe
+from app.views import toggle_membership
+from conftest import add_user
+
+
+def counts(recipe_id, model):
+    recipe = db.session.get(Recipe, recipe_id, populate_existing=True)
+    rows = db.session.query(model).filter_by(recipe_id=recipe_id).count()
+    return recipe.like_count if model is Like else recipe.save_count, rows
+
+
+@pytest.mark.parametrize('model, counter', [(Like, 'like_count'), (SavedRecipe, 'save_count')])
+def test_toggle_adds_then_removes(app, user, recipe, model, counter):
+    with app.app_context():
+        recipe = db.session.get(Recipe, recipe.id)
+        assert toggle_membership(db.session, model, counter, recipe, user) is True
+        assert counts(recipe.id, model) == (1, 1)
+        assert toggle_membership(db.session, model, counter, recipe, user) is False
+        assert counts(recipe.id, model) == (0, 0)
+        assert toggle_membership(db.session, model, counter, recipe, user) is True
+        assert counts(recipe.id, model) == (1, 1)
+
+
+def test_toggle_counts_every_user(app, user, recipe):
+    with app.app_context():
+        others = [add_user(f'fan{i}') for i in range(3)]
+        recipe = db.session.get(Recipe, recipe.id)
+        for other in others:
+            toggle_membership(db.session, Like, 'like_count', recipe, other)
+        toggle_membership(db.session, Like, 'like_count', recipe, others[0])
+        assert counts(recipe.id, Like) == (2, 2)
+
+
+def test_like_recipe_view(client, app, recipe):
+    first = client.post('/like_recipe', json={'recipe_id': recipe.id}).json
+    second = client.post('/like_recipe', json={'recipe_id': recipe.id}).json
+    assert first == {'status': 'liked', 'like_count': 1}
+    assert second == {'status': 'unliked', 'like_count': 0}
+    with app.app_context():
+        assert counts(recipe.id, Like) == (0, 0)
+
+
+def test_save_recipe_view(client, app, recipe):
+    assert client.post('/save_recipe', json={'recipe_id': recipe.id}).json == {'status': 'saved'}
+    with app.app_context():
+        assert counts(recipe.id, SavedRecipe) == (1, 1)
+    assert client.post('/save_recipe', json={'recipe_id': recipe.id}).json == {'status': 'unsaved'}
+    with app.app_context():
+        assert counts(recipe.id, SavedRecipe) == (0, 0)